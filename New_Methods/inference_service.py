@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Serviço de inferência por paciente: template, extração do cérebro e modelos treinados (2D, 3D e siamês)
+carregados uma única vez num processo de longa duração, com uma API HTTP local.
+
+Cada upload (NIfTI bruto, .nii ou .nii.gz) passa pela mesma cadeia do pre_processing/brain_pipeline.py
+(registro -> extração do cérebro -> máscara -> N4 -> winsorizing + normalização), só que em memória.
+Pedidos concorrentes são agrupados em lotes dinâmicos na extração do cérebro e em cada modelo.
+
+    python inference_service.py --model-2d vit2d_int8.tflite --model-3d vit3d.keras --model-siamese siamese_dynamic.tflite
+    curl --data-binary @sub-01_T1.nii.gz "http://127.0.0.1:8080/predict?models=2d,3d"
+    curl http://127.0.0.1:8080/health
+
+A resposta traz a predição de cada modelo, a latência de cada estágio (em ms, incluindo a espera na fila
+de cada lote) e o tamanho do lote em que o pedido entrou.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from scipy.ndimage import zoom
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, 'pre_processing'))
+sys.path.append(os.path.join(os.path.dirname(ROOT), 'Old_Methods'))
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"  # Desativa GPUs
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # Supressão de logs detalhados do TensorFlow
+
+import ants
+from registration import RegistrationEngine
+from normalization import normalize_volume
+from brain_extraction_service import get_model, DEFAULT_BATCH_SIZE
+from stage_profiler import stage, configure
+from brain_pipeline import pipeline_params
+from patient_inference import patient_grid, extract_pairs, minmax_per_patch
+from SaveAllSlices import SLICE_RANGE, MIN_NON_BLACK_RATIO
+from tflite_export import TFLiteModel
+
+logger = logging.getLogger()
+
+PIPELINE_PARAMS = pipeline_params() # mesmos parâmetros dos scripts de pré-processamento (t1, grid do template)
+
+DEFAULT_HOST = '127.0.0.1'  # só local: a API não tem autenticação
+DEFAULT_PORT = 8080
+DEFAULT_TEMPLATE = os.path.join(ROOT, 'pre_processing', 'mni_icbm152_nlin_asym_09c_nifti', 'mni_icbm152_nlin_asym_09c',
+                                'mni_icbm152_t1_tal_nlin_asym_09c.nii')
+
+# Lotes dinâmicos: o primeiro pedido da fila espera até MAX_WAIT_MS por outros antes do lote sair
+MAX_WAIT_MS = 50
+MAX_BATCH_REQUESTS = 8
+# Amostras (fatias, volumes ou pares) por chamada do modelo; o último lote é completado, então o grafo é traçado uma vez
+MODEL_BATCH_SIZE = 32
+MAX_UPLOAD_MB = 512
+
+# Mesma normalização do load_and_preprocess_image: imagem / (máximo + 1e-6)
+NORM_EPS = 1e-6
+
+MODEL_KINDS = ('2d', '3d', 'siamese')
+
+
+# FUNÇÕES
+@contextmanager
+def timed(timings, name, request_id=None):
+    """Mede o estágio em ms no dict timings (e no stage_profiler, se configurado)."""
+    start = time.perf_counter()
+    with stage(name, image=request_id):
+        yield
+    timings[name] = round(1000 * (time.perf_counter() - start), 1)
+
+def slice_inputs(volume, input_shape):
+    """
+    Fatias axiais do volume pré-processado com a mesma seleção do SaveAllSlices (rot90, SLICE_RANGE e
+    fração mínima de pixels não-pretos), redimensionadas pro shape do ViT 2D e normalizadas pelo máximo.
+    :return: ([fatias (n, altura, largura, canais)], números das fatias).
+    """
+    data = np.rot90(volume, k=1)
+    slice_ids = np.arange(SLICE_RANGE[0], min(SLICE_RANGE[1], data.shape[2]))
+    ratios = np.count_nonzero(data[:, :, slice_ids], axis=(0, 1)) / (data.shape[0] * data.shape[1])
+    slice_ids = slice_ids[ratios >= MIN_NON_BLACK_RATIO]
+    slices = np.moveaxis(data[:, :, slice_ids], 2, 0).astype(np.float32)
+    height, width, channels = input_shape
+    if len(slices) and slices.shape[1:] != (height, width):
+        slices = zoom(slices, (1, height / slices.shape[1], width / slices.shape[2]), order=1, mode='nearest')
+    if len(slices):
+        slices /= slices.max(axis=(1, 2), keepdims=True) + NORM_EPS
+    slices = np.broadcast_to(slices[..., np.newaxis], slices.shape + (channels,))
+    return [slices], slice_ids
+
+def volume_inputs(volume, input_shape):
+    """Volume redimensionado pro shape do ViT 3D (zoom trilinear), normalizado pelo máximo e com os canais replicados."""
+    target = input_shape[:3]
+    resized = zoom(volume.astype(np.float32), [t / s for t, s in zip(target, volume.shape)], order=1)
+    resized /= resized.max() + NORM_EPS
+    return [np.broadcast_to(resized[np.newaxis, ..., np.newaxis], (1,) + tuple(input_shape))], None
+
+def pair_inputs(volume, input_shape):
+    """Todos os pares contralaterais do paciente (mesmo grid do GridCreation), normalizados recorte a recorte."""
+    data = np.rot90(volume.astype(np.float32), k=1)
+    grids = patient_grid(data > 0, size=input_shape[0])
+    left, right = extract_pairs(data, grids, np.arange(len(grids)))
+    return [minmax_per_patch(left)[..., np.newaxis], minmax_per_patch(right)[..., np.newaxis]], grids
+
+def summarize_2d(scores, slice_ids):
+    return {'score': float(scores.max()) if len(scores) else None,
+            'positive_slices': [int(s) for s in slice_ids[scores > 0.5]],
+            'slice_scores': {int(s): round(float(score), 4) for s, score in zip(slice_ids, scores)}}
+
+def summarize_3d(scores, _):
+    return {'score': float(scores[0])}
+
+def summarize_siamese(scores, grids):
+    top = np.argsort(scores)[::-1][:5]
+    return {'score': float(scores.max()) if len(scores) else None, 'pairs': int(len(scores)),
+            'positive_pairs': int(np.count_nonzero(scores > 0.5)),
+            # slice no volume rotacionado (mesma numeração das fatias do GridCreation)
+            'top_pairs': [{'slice': int(grids.slice[i]), 'y1': int(grids.y1[i]), 'x1_left': int(grids.x1_l[i]),
+                           'x1_right': int(grids.x1_r[i]), 'score': round(float(scores[i]), 4)} for i in top]}
+
+# Entradas do modelo a partir do volume pré-processado e resumo da saída, por tipo de modelo
+ADAPTERS = {
+    '2d': (slice_inputs, summarize_2d),
+    '3d': (volume_inputs, summarize_3d),
+    'siamese': (pair_inputs, summarize_siamese),
+}
+
+
+class DynamicBatcher:
+    """
+    Agrupa pedidos concorrentes: uma thread tira o primeiro pedido da fila, espera até max_wait_ms
+    por outros (no máximo max_batch_size) e passa o lote inteiro numa chamada de process_batch.
+
+    Uso:
+        batcher = DynamicBatcher(lambda images: model.extract(images), max_batch_size=4)
+        result, info = batcher(image)  # info: batch_size, wait_s (fila), run_s (lote)
+    """
+    def __init__(self, process_batch, max_batch_size, max_wait_ms=MAX_WAIT_MS, name='batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future, time.perf_counter()))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                results = self.process_batch([item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            run = time.perf_counter() - start
+            for (_, future, queued), result in zip(batch, results):
+                future.set_result((result, {'batch_size': len(batch), 'wait_s': start - queued, 'run_s': run}))
+
+
+class ServedModel:
+    """
+    Modelo carregado uma vez: .tflite exportado pelo tflite_export (recomendado na CPU) ou modelo
+    Keras completo salvo com model.save (.keras/.h5). Lotes de tamanho fixo: o último é completado com zeros.
+    """
+    def __init__(self, path, batch_size=MODEL_BATCH_SIZE, num_threads=None):
+        self.path = path
+        self.batch_size = batch_size
+        if path.endswith('.tflite'):
+            self.model = TFLiteModel(path, num_threads)
+            details = self.model.runner.get_input_details()
+            self.input_shapes = [tuple(int(size) for size in details[name]['shape'][1:]) for name in self.model.input_names]
+            self._predict = lambda inputs: self.model.predict(inputs, batch_size)
+        else:
+            import keras
+            self.model = keras.models.load_model(path, compile=False)
+            self.input_shapes = [tuple(tensor.shape[1:]) for tensor in self.model.inputs]
+            self._predict = lambda inputs: self.model.predict_on_batch(inputs if len(inputs) > 1 else inputs[0])
+
+    def predict(self, inputs):
+        """:param inputs: Lista de arrays (n, ...), um por entrada. :return: Array (n,) com a primeira saída."""
+        n = len(inputs[0])
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.batch_size):
+            chunk = [np.asarray(x[start:start + self.batch_size], dtype=np.float32) for x in inputs]
+            count = len(chunk[0])
+            if count < self.batch_size:
+                chunk = [np.pad(x, [(0, self.batch_size - count)] + [(0, 0)] * (x.ndim - 1)) for x in chunk]
+            output = np.asarray(self._predict(chunk)).reshape(self.batch_size, -1)
+            scores[start:start + count] = output[:count, 0]
+        return scores
+
+    def predict_requests(self, requests):
+        """Junta as entradas de vários pedidos num lote só e separa as saídas de volta por pedido."""
+        counts = [len(inputs[0]) for inputs in requests]
+        merged = [np.concatenate([inputs[i] for inputs in requests]) for i in range(len(requests[0]))]
+        return np.split(self.predict(merged), np.cumsum(counts)[:-1])
+
+
+class InferenceService:
+    """
+    Estado persistente do serviço (template, extração do cérebro, modelos e filas dos lotes dinâmicos).
+    Os estágios pesados de CPU de cada pedido (leitura, registro, máscara, N4, normalização) rodam em até
+    preprocess_slots pedidos ao mesmo tempo; a extração do cérebro e os modelos passam pelos lotes.
+    """
+    def __init__(self, model_paths, template_path=DEFAULT_TEMPLATE, transform_cache=None,
+                 max_batch_volumes=DEFAULT_BATCH_SIZE, max_batch_requests=MAX_BATCH_REQUESTS, max_wait_ms=MAX_WAIT_MS,
+                 model_batch_size=MODEL_BATCH_SIZE, preprocess_slots=None, num_threads=None, warmup=True):
+        self.startup_ms = {}
+        self.started = time.time()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(preprocess_slots or os.cpu_count())
+
+        with timed(self.startup_ms, 'template'):
+            self.engine = RegistrationEngine(ants.image_read(template_path), cache_dir=transform_cache,
+                                             stages=PIPELINE_PARAMS['registered']['stages'])
+        params = PIPELINE_PARAMS['brain_masked']
+        with timed(self.startup_ms, 'brain_extraction'):
+            brain_model = get_model(params['modality'], batch_size=max_batch_volumes)
+            if warmup:
+                brain_model.extract([self.engine.template], low_thresh=params['low_thresh'])
+        self.brain_batcher = DynamicBatcher(lambda images: brain_model.extract(images, low_thresh=params['low_thresh']),
+                                            max_batch_volumes, max_wait_ms, name='brain_extraction')
+
+        self.models, self.model_batchers = {}, {}
+        for kind, path in model_paths.items():
+            with timed(self.startup_ms, f"model_{kind}"):
+                model = ServedModel(path, model_batch_size, num_threads)
+                if warmup:
+                    model.predict([np.zeros((1,) + shape, dtype=np.float32) for shape in model.input_shapes])
+            self.models[kind] = model
+            self.model_batchers[kind] = DynamicBatcher(model.predict_requests, max_batch_requests, max_wait_ms,
+                                                       name=f"model_{kind}")
+        logger.info(f"Serviço pronto: modelos {sorted(self.models)}, carga em {self.startup_ms} ms")
+
+    def preprocess(self, path, source_hash, timings, request_id):
+        """Cadeia do brain_pipeline em memória. :return: Volume normalizado (numpy float32, espaço do template)."""
+        with self.slots:
+            with timed(timings, 'read', request_id):
+                try:
+                    image = ants.image_read(path)
+                except Exception as e:
+                    raise ValueError(f"NIfTI inválido: {e}")
+            # A transformação fica no cache pelo hash do upload: o mesmo exame enviado de novo não é registrado outra vez
+            with timed(timings, 'registration', request_id):
+                image = self.engine.register(image, moving_hash=source_hash)[0]
+
+        # Fora do semáforo: a espera pelo lote não segura uma vaga de CPU
+        start = time.perf_counter()
+        mask, info = self.brain_batcher(image)
+        self._note_batch(timings, 'brain_extraction', info, start)
+
+        with self.slots:
+            with timed(timings, 'masking', request_id):
+                image = ants.mask_image(image, mask)
+            with timed(timings, 'n4', request_id):
+                image = ants.n4_bias_field_correction(image, **PIPELINE_PARAMS['n4'])
+            with timed(timings, 'normalization', request_id):
+                return normalize_volume(image.numpy(), **PIPELINE_PARAMS['normalized'])
+
+    @staticmethod
+    def _note_batch(timings, name, info, start):
+        timings[f"{name}_queue"] = round(1000 * info['wait_s'], 1)
+        timings[name] = round(1000 * info['run_s'], 1)
+        timings.setdefault('batch', {})[name] = info['batch_size']
+
+    def predict(self, data, kinds=None):
+        """
+        :param data: Bytes do NIfTI (.nii ou .nii.gz).
+        :param kinds: Modelos a rodar (padrão: todos os carregados).
+        :return: Dict com id, predições por modelo, latências por estágio (ms) e tamanhos de lote.
+        """
+        kinds = list(kinds or self.models)
+        unknown = [kind for kind in kinds if kind not in self.models]
+        if unknown:
+            raise ValueError(f"Modelos não carregados: {unknown} (disponíveis: {sorted(self.models)})")
+        request_id = uuid.uuid4().hex[:12]
+        timings = {}
+        start = time.perf_counter()
+
+        # O ANTs lê de um arquivo; a extensão decide o formato (gzip pelo número mágico)
+        suffix = '.nii.gz' if data[:2] == b'\x1f\x8b' else '.nii'
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            f.write(data)
+        try:
+            volume = self.preprocess(f.name, hashlib.sha256(data).hexdigest(), timings, request_id)
+        finally:
+            os.remove(f.name)
+
+        pending = {}
+        for kind in kinds:
+            build_inputs, _ = ADAPTERS[kind]
+            with timed(timings, f"{kind}_inputs", request_id):
+                inputs, context = build_inputs(volume, self.models[kind].input_shapes[0])
+            pending[kind] = (self.model_batchers[kind].submit(inputs), context, time.perf_counter())
+
+        predictions = {}
+        for kind, (future, context, submitted) in pending.items():
+            scores, info = future.result()
+            self._note_batch(timings, f"{kind}_model", info, submitted)
+            predictions[kind] = ADAPTERS[kind][1](scores, context)
+
+        timings['total'] = round(1000 * (time.perf_counter() - start), 1)
+        with self._lock:
+            self.requests += 1
+        batch = timings.pop('batch', {})
+        return {'id': request_id, 'predictions': predictions, 'latency_ms': timings, 'batch': batch}
+
+    def health(self):
+        return {'status': 'ok', 'models': {kind: model.path for kind, model in self.models.items()},
+                'modality': PIPELINE_PARAMS['brain_masked']['modality'], 'requests': self.requests,
+                'uptime_s': round(time.time() - self.started, 1), 'startup_ms': self.startup_ms}
+
+
+def make_handler(service, max_upload_mb=MAX_UPLOAD_MB):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/health':
+                self._send_json(200, service.health())
+            else:
+                self._send_json(404, {'error': f"Rota desconhecida: {self.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self._send_json(404, {'error': f"Rota desconhecida: {url.path}"})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            if not length:
+                self._send_json(400, {'error': "Envie o NIfTI no corpo da requisição (--data-binary @arquivo.nii.gz)"})
+                return
+            if length > max_upload_mb << 20:
+                self._send_json(413, {'error': f"Upload maior que {max_upload_mb} MB"})
+                return
+            data = self.rfile.read(length)
+            models = parse_qs(url.query).get('models', [''])[0]
+            try:
+                self._send_json(200, service.predict(data, [kind for kind in models.split(',') if kind]))
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                logger.exception(f"Erro na inferência: {e}")
+                self._send_json(500, {'error': f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            logger.info(f"{self.address_string()} - {format % args}")
+    return Handler
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, max_upload_mb=MAX_UPLOAD_MB):
+    server = ThreadingHTTPServer((host, port), make_handler(service, max_upload_mb))
+    server.daemon_threads = True
+    logger.info(f"Servindo em http://{host}:{port} (POST /predict, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serviço HTTP local de inferência por paciente (modelos e template carregados uma vez).")
+    parser.add_argument("--model-2d", help="ViT 2D (.tflite ou modelo Keras completo).")
+    parser.add_argument("--model-3d", help="ViT 3D (.tflite ou modelo Keras completo).")
+    parser.add_argument("--model-siamese", help="Modelo siamês (.tflite ou modelo Keras completo).")
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE)
+    parser.add_argument("--transform-cache", default=None, help="Pasta do cache de transformações do registro.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-batch-volumes", type=int, default=DEFAULT_BATCH_SIZE, help="Volumes por lote da extração do cérebro.")
+    parser.add_argument("--max-batch-requests", type=int, default=MAX_BATCH_REQUESTS, help="Pedidos por lote de cada modelo.")
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS, help="Espera máxima pra completar um lote.")
+    parser.add_argument("--model-batch-size", type=int, default=MODEL_BATCH_SIZE)
+    parser.add_argument("--slots", type=int, default=None, help="Pedidos em pré-processamento ao mesmo tempo (padrão: núcleos).")
+    parser.add_argument("--threads", type=int, default=None, help="Threads do interpretador TFLite.")
+    parser.add_argument("--max-upload-mb", type=int, default=MAX_UPLOAD_MB)
+    parser.add_argument("--stage-log", default=None, help="Pasta dos registros por estágio (python pre_processing/stage_profiler.py <pasta>).")
+    args = parser.parse_args()
+
+    model_paths = {kind: path for kind, path in zip(MODEL_KINDS, (args.model_2d, args.model_3d, args.model_siamese)) if path}
+    if not model_paths:
+        parser.error("Informe pelo menos um modelo (--model-2d, --model-3d ou --model-siamese)")
+    configure(args.stage_log)
+    service = InferenceService(model_paths, args.template, args.transform_cache, args.max_batch_volumes,
+                               args.max_batch_requests, args.max_wait_ms, args.model_batch_size, args.slots, args.threads)
+    serve(service, args.host, args.port, args.max_upload_mb)
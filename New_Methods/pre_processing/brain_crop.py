@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Corte automático pelo cérebro: caixa 3D (com margem) calculada uma vez a partir de uma máscara do cérebro
+(a do template, que vale pra todas as imagens registradas nele, ou a do próprio paciente) em vez de índices fixos.
+
+A caixa fica registrada junto da imagem (manifesto e sidecar JSON ao lado da saída, no padrão do BIDS), no grid
+do volume antes do corte, então quem lê o volume cortado reaproveita a caixa sem procurar as bordas pretas de novo.
+"""
+import os
+import json
+import numpy as np
+
+# Voxels livres em volta do cérebro em cada direção (folga pro N4 e pra pequenas diferenças de registro)
+DEFAULT_MARGIN = 4
+
+# Chave dos metadados do corte no manifesto e no sidecar
+CROP_KEY = 'crop'
+
+
+# FUNÇÕES
+def brain_box(mask, margin=DEFAULT_MARGIN):
+    """
+    Caixa 3D dos voxels não-zero da máscara, com margem e limitada ao volume.
+    As projeções são feitas uma vez pro plano (x, y) e uma pro eixo z, sem procurar borda fatia a fatia.
+    :param mask: Array 3D (máscara do cérebro, ou o volume já mascarado).
+    :return: Array int (3, 2) com [início, fim) de cada eixo, ou None se a máscara estiver vazia.
+    """
+    mask = np.asarray(mask) != 0
+    plane = mask.any(axis=2)
+    extents = (plane.any(axis=1), plane.any(axis=0), mask.any(axis=(0, 1)))
+    box = np.zeros((3, 2), dtype=np.int64)
+    for axis, present in enumerate(extents):
+        indices = np.flatnonzero(present)
+        if not len(indices):
+            return None
+        box[axis] = max(indices[0] - margin, 0), min(indices[-1] + 1 + margin, mask.shape[axis])
+    return box
+
+def box_slices(box):
+    return tuple(slice(int(start), int(stop)) for start, stop in box)
+
+def crop_image(image, box):
+    """
+    Corta a imagem ANTs pela caixa mantendo o espaço físico: a origem passa a ser a do primeiro voxel da caixa
+    (origem + direção · (índice · espaçamento)), então a imagem cortada continua alinhada ao template.
+    """
+    import ants
+
+    box = np.asarray(box)
+    origin = np.asarray(image.origin) + np.asarray(image.direction) @ (box[:, 0] * np.asarray(image.spacing))
+    data = np.ascontiguousarray(image.numpy()[box_slices(box)])
+    return ants.from_numpy(data, origin=tuple(origin), spacing=image.spacing, direction=image.direction)
+
+def crop_info(box, full_shape, source, margin=DEFAULT_MARGIN):
+    """Metadados do corte: caixa no grid completo, shape do grid completo e de onde veio a máscara ('template' ou 'subject')."""
+    return {'box': np.asarray(box).tolist(), 'full_shape': [int(size) for size in full_shape],
+            'source': source, 'margin': margin}
+
+def sidecar_path(image_path):
+    """Sidecar JSON da imagem: mesmo nome sem .nii/.nii.gz (ex: sub-01_T1.nii.gz -> sub-01_T1.json)."""
+    for extension in ('.nii.gz', '.nii', '.nrrd'):
+        if image_path.endswith(extension):
+            return image_path[:-len(extension)] + '.json'
+    return image_path + '.json'
+
+def read_crop(image_path):
+    """:return: Metadados do corte gravados ao lado da imagem (crop_info), ou None se ela não foi cortada."""
+    path = sidecar_path(image_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get(CROP_KEY)
+
+def uncrop(volume, crop, fill=0):
+    """Devolve o volume cortado pro grid completo (ex: mapas de predição alinhados ao template)."""
+    full = np.full(crop['full_shape'], fill, dtype=np.asarray(volume).dtype)
+    full[box_slices(crop['box'])] = volume
+    return full
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import logging
+import numpy as np
+import ants
+
+logger = logging.getLogger()
+
+# Pesos do antspynet pra cada modalidade (redes "robust", saída sigmoid com um canal)
+WEIGHTS = {
+    't1': 'brainExtractionRobustT1',
+    't2': 'brainExtractionRobustT2',
+    't2star': 'brainExtractionRobustT2Star',
+    'flair': 'brainExtractionRobustFLAIR',
+    'bold': 'brainExtractionRobustBOLD',
+    'fa': 'brainExtractionRobustFA',
+}
+
+# Volumes por forward pass
+DEFAULT_BATCH_SIZE = 4
+
+# Modelos já carregados neste processo (um por modalidade)
+_MODELS = {}
+
+
+class BrainExtractionModel:
+    """
+    Mesma rede e mesmo pré/pós-processamento do antspynet.utilities.brain_extraction,
+    mas a U-Net e o template de reorientação são carregados uma única vez e vários
+    volumes passam pela rede no mesmo forward pass.
+    """
+    def __init__(self, modality='t1', batch_size=DEFAULT_BATCH_SIZE):
+        if modality not in WEIGHTS:
+            raise ValueError(f"Modalidade sem suporte no serviço: {modality} (use antspynet.utilities.brain_extraction)")
+        # Import aqui pra que os processos que não fazem extração não carreguem o TensorFlow
+        from antspynet.architectures import create_unet_model_3d
+        from antspynet.utilities import get_pretrained_network, get_antsxnet_data
+
+        self.modality = modality
+        self.batch_size = batch_size
+
+        self.template = ants.image_read(get_antsxnet_data("S_template3"))
+        ants.set_spacing(self.template, (1.5, 1.5, 1.5))
+        self.template_center = np.asarray(ants.get_center_of_mass(self.template))
+
+        self.model = create_unet_model_3d((*self.template.shape, 1),
+            number_of_outputs=1, mode="sigmoid",
+            number_of_filters=(16, 32, 64, 128), dropout_rate=0.0,
+            convolution_kernel_size=3, deconvolution_kernel_size=2,
+            weight_decay=1e-5)
+        self.model.load_weights(get_pretrained_network(WEIGHTS[modality]))
+        logger.info(f"Modelo de extração do cérebro carregado ({modality})")
+
+    # Leva a imagem pro espaço do template (translação pelo centro de massa) e normaliza
+    def _prepare(self, image):
+        image = image.clone('float') if image.pixeltype != 'float' else image
+        translation = np.asarray(ants.get_center_of_mass(image)) - self.template_center
+        xfrm = ants.create_ants_transform(transform_type="Euler3DTransform",
+            center=self.template_center, translation=translation)
+        warped = ants.apply_ants_transform_to_image(xfrm, image, self.template)
+        return ants.iMath(warped, "Normalize").numpy(), xfrm
+
+    def predict(self, images):
+        """
+        Mapas de probabilidade do cérebro, no espaço de cada imagem.
+        :param images: Lista de imagens ANTs 3D.
+        :return: Lista de imagens ANTs de probabilidade, na mesma ordem.
+        """
+        probabilities = []
+        for start in range(0, len(images), self.batch_size):
+            chunk = images[start:start + self.batch_size]
+            prepared = [self._prepare(image) for image in chunk]
+            batch = np.stack([data for data, _ in prepared])[..., np.newaxis]
+            predicted = self.model.predict(batch, batch_size=len(chunk), verbose=0)
+
+            for image, (_, xfrm), data in zip(chunk, prepared, predicted):
+                probability = ants.from_numpy(data[..., 0].astype(np.float32), origin=self.template.origin,
+                                              spacing=self.template.spacing, direction=self.template.direction)
+                probabilities.append(xfrm.invert().apply_to_image(probability, image))
+        return probabilities
+
+    def extract(self, images, low_thresh=0.5):
+        """Máscaras binárias do cérebro (ants.get_mask sobre a probabilidade)."""
+        return [ants.get_mask(probability, low_thresh=low_thresh) for probability in self.predict(images)]
+
+
+# Modelo persistente do processo: carregado na primeira chamada e reaproveitado nas seguintes
+def get_model(modality='t1', batch_size=DEFAULT_BATCH_SIZE):
+    if modality not in _MODELS:
+        _MODELS[modality] = BrainExtractionModel(modality, batch_size=batch_size)
+    return _MODELS[modality]
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import os
+import gc
+import logging
+import ants
+from registration import RegistrationEngine, hash_file
+from manifest import ImageManifest, is_complete
+from normalization import normalize_volume, DEFAULT_BINS
+from scheduler import shared
+from stage_profiler import stage
+from brain_extraction_service import get_model, DEFAULT_BATCH_SIZE
+from brain_crop import brain_box, crop_image, crop_info, CROP_KEY, DEFAULT_MARGIN
+from multimodal import CoRegistration, mask_from_masked, COREGISTRATION_STAGES
+
+# Cadeia de pré-processamento compartilhada pelo pre_process.py e pelo pre_process_individual_mask.py
+# (registro -> extração do cérebro em lote -> [corte] -> N4 -> normalização); os scripts guardam só caminhos e configuração
+
+logger = logging.getLogger()
+
+# FUNÇÕES
+# Parâmetros de cada estágio, registrados no manifesto (mudar um deles refaz só esse estágio e os seguintes)
+def pipeline_params(modality='t1', crop_source=None):
+    """
+    :param modality: Pesos da extração do cérebro ('t1' ou 'flair').
+    :param crop_source: 'subject' corta pela caixa do cérebro do próprio paciente antes do N4; None mantém o grid do template.
+    :return: Dicionário estágio -> parâmetros.
+    """
+    params = {
+        'registered': {'stages': ['Affine']},
+        'brain_masked': {'modality': modality, 'low_thresh': 0.5},
+        'n4': {'shrink_factor': 2},
+        'normalized': {'lower_percentile': 0, 'upper_percentile': 99.9, 'bins': DEFAULT_BINS},
+    }
+    if crop_source == 'subject':
+        params['cropped'] = {'source': crop_source, 'margin': DEFAULT_MARGIN}
+    return params
+
+class BrainPipeline:
+    """
+    Estágios de um bloco de imagens, cada um no manifesto da imagem (uma nova execução continua do último estágio válido).
+    O template vem do initializer do worker (scheduler.shared); o objeto só leva parâmetros e caminhos, então os métodos
+    podem ir direto pro run_parallel.
+    :param params: Parâmetros de cada estágio (pipeline_params).
+    :param transforms_dir: Cache das transformações do registro, reaproveitadas entre execuções.
+    :param batch_size: Volumes por forward pass da extração do cérebro.
+    :param reference_modality: Modalidade registrada no template no modo multimodal (process_subjects).
+    """
+    def __init__(self, params, transforms_dir=None, batch_size=DEFAULT_BATCH_SIZE, reference_modality=None):
+        self.params = params
+        self.transforms_dir = transforms_dir
+        self.batch_size = batch_size
+        self.reference_modality = reference_modality
+
+    def engine(self):
+        return RegistrationEngine(shared('template'), cache_dir=self.transforms_dir,
+                                  stages=self.params['registered']['stages'], template_hash=shared('template_hash'))
+
+    # Parâmetros de cada modalidade no modo multimodal (a referência usa os do pipeline de uma modalidade)
+    def modality_params(self, modality):
+        if modality == self.reference_modality:
+            return self.params
+        params = dict(self.params)
+        params['registered'] = dict(self.params['registered'], reference=self.reference_modality,
+                                    coregistration=list(COREGISTRATION_STAGES))
+        params['brain_masked'] = dict(self.params['brain_masked'], mask_from=self.reference_modality)
+        return params
+
+    # Registro de uma imagem (primeira parte, antes da extração do cérebro em lote)
+    def register_image(self, img_path, loader, work_dir):
+        # Carrega a imagem (só quando algum estágio precisar ser recalculado)
+        manifest = ImageManifest(work_dir, os.path.basename(img_path), img_path, source_loader=loader)
+
+        # Registra pra padronizar shape da imagem (transformação reaproveitada do cache se já existir)
+        engine = self.engine()
+        manifest.run('registered', lambda image: engine.register(image, moving_hash=hash_file(img_path))[0],
+                     params=self.params['registered'], inputs=[engine.template_hash])
+        return manifest
+
+    # Extração do cérebro em lote: um forward pass pras imagens do bloco que ainda não têm esse estágio válido
+    # O modelo é carregado uma vez por worker e reaproveitado em todos os blocos
+    def extract_brains(self, manifests):
+        params = self.params['brain_masked']
+        pending = [img_path for img_path, manifest in manifests.items() if not manifest.is_fresh('brain_masked', params=params)]
+        if not pending:
+            return {}
+
+        images = [manifests[img_path].current() for img_path in pending]
+        with stage('brain_extraction', batch=len(pending)):
+            masks = get_model(params['modality'], batch_size=self.batch_size).extract(images, low_thresh=params['low_thresh'])
+        logger.info(f"Máscaras obtidas: {len(masks)} imagens.")
+
+        # Máscara do cérebro e extração
+        masked = {}
+        for img_path, image, mask in zip(pending, images, masks):
+            with stage('masking', image=manifests[img_path].image_id):
+                masked[img_path] = ants.mask_image(image, mask)
+        return masked
+
+    # Estágios finais de uma imagem (a extração do cérebro já vem calculada do lote)
+    # mask_inputs: hash da máscara quando ela vem de outra imagem (modo multimodal)
+    def finish_image(self, img_path, manifest, masked, output_dir, params=None, mask_inputs=None):
+        params = params or self.params
+        output_path = os.path.join(output_dir, os.path.basename(img_path))
+
+        manifest.run('brain_masked', lambda image: masked[img_path], params=params['brain_masked'], inputs=mask_inputs)
+        logger.info(f"Extração.")
+
+        # Corte pela caixa do cérebro do paciente (o fundo já foi zerado pela máscara), antes do N4
+        if 'cropped' in params:
+            def crop(image):
+                margin = params['cropped']['margin']
+                box = brain_box(image.numpy(), margin=margin)
+                if box is None:
+                    return image
+                return crop_image(image, box), {CROP_KEY: crop_info(box, image.shape, 'subject', margin)}
+            manifest.run('cropped', crop, params=params['cropped'])
+
+        # Bias Field Correction
+        manifest.run('n4', lambda image: ants.n4_bias_field_correction(image, **params['n4']),
+                     params=params['n4'])
+        logger.info(f"Bias Corrigido.")
+
+        def normalize(image):
+            # Winsorizing + Normalização (percentis só dos voxels do cérebro, em float32 e no próprio array)
+            data = normalize_volume(image.numpy(), **params['normalized'])
+            logger.info(f"Winsorized + normalizado.")
+            return ants.from_numpy(data, origin=image.origin, spacing=image.spacing, direction=image.direction)
+        manifest.run('normalized', normalize, params=params['normalized'])
+
+        logger.info(f"Imagem {img_path} processada.")
+
+        # Escrita atômica da saída final
+        manifest.export(output_path, params=params)
+        logger.info(f"Imagem salva: {os.path.basename(output_path)}")
+        return output_path
+
+    # Função para processar um bloco de imagens (registro -> extração em lote -> N4 -> normalização)
+    def process_images(self, img_paths, loaders=None, output_dir=None, work_dir=None):
+        loaders = loaders or [None] * len(img_paths)
+
+        manifests = {}
+        for img_path, loader in zip(img_paths, loaders):
+            try:
+                logger.info(f"Inicio processamento: {img_path}")
+                manifests[img_path] = self.register_image(img_path, loader, work_dir)
+            except Exception as e:
+                logger.error(f"Erro ao processar a imagem {img_path}: {e}")
+
+        try:
+            masked = self.extract_brains(manifests)
+        except Exception as e:
+            logger.error(f"Erro na extração do cérebro em lote: {e}")
+            masked = {}
+
+        results = []
+        for img_path, manifest in manifests.items():
+            try:
+                results.append(self.finish_image(img_path, manifest, masked, output_dir))
+            except Exception as e:
+                logger.error(f"Erro ao processar a imagem {img_path}: {e}")
+                results.append(None)
+
+        manifests, masked = None, None
+        gc.collect()
+        return results
+
+    # Modalidade não-referência de um paciente: registro rígido até a referência composto com referência -> template,
+    # e a máscara do cérebro da referência (lida do artefato 'brain_masked' dela só quando o estágio precisa ser refeito)
+    def finish_modality(self, img_path, modality, coregistration, reference_manifest, output_dir, work_dir):
+        params = self.modality_params(modality)
+        manifest = ImageManifest(os.path.join(work_dir, modality), os.path.basename(img_path), img_path)
+        manifest.run('registered', lambda image: coregistration.register_modality(image, moving_hash=hash_file(img_path)),
+                     params=params['registered'], inputs=[coregistration.engine.template_hash, coregistration.reference_hash])
+
+        mask_record = reference_manifest.records['brain_masked']
+        mask_inputs = [mask_record['checksum']]
+        masked = {}
+        if not manifest.is_fresh('brain_masked', params=params['brain_masked'], inputs=mask_inputs):
+            mask = mask_from_masked(ants.image_read(mask_record['output']))
+            with stage('masking', image=manifest.image_id):
+                masked[img_path] = ants.mask_image(manifest.current(), mask)
+        return self.finish_image(img_path, manifest, masked, os.path.join(output_dir, modality), params, mask_inputs)
+
+    # Função para processar um bloco de pacientes (modo multimodal): registro das referências -> extração em lote só delas
+    # -> N4 e normalização de cada modalidade, com todas as modalidades do paciente no mesmo job
+    def process_subjects(self, subjects, output_dir=None, work_dir=None):
+        reference = self.reference_modality
+        engine = self.engine()
+        coregistrations, manifests = {}, {}
+        for subject, paths in subjects:
+            reference_path = paths[reference]
+            try:
+                logger.info(f"Inicio processamento: {subject} ({', '.join(paths)})")
+                coregistration = CoRegistration(engine, reference_path, cache_dir=self.transforms_dir)
+                manifest = ImageManifest(os.path.join(work_dir, reference), os.path.basename(reference_path), reference_path)
+                manifest.run('registered', coregistration.register_reference,
+                             params=self.params['registered'], inputs=[engine.template_hash])
+                coregistrations[subject], manifests[reference_path] = coregistration, manifest
+            except Exception as e:
+                logger.error(f"Erro ao registrar a referência do paciente {subject}: {e}")
+
+        try:
+            masked = self.extract_brains(manifests)
+        except Exception as e:
+            logger.error(f"Erro na extração do cérebro em lote: {e}")
+            masked = {}
+
+        results = []
+        for subject, paths in subjects:
+            reference_path = paths[reference]
+            if reference_path not in manifests:
+                continue
+            try:
+                results.append(self.finish_image(reference_path, manifests[reference_path], masked,
+                                                 os.path.join(output_dir, reference)))
+            except Exception as e:
+                logger.error(f"Erro ao processar a imagem {reference_path}: {e}")
+                results.append(None)
+                continue
+            for modality, img_path in paths.items():
+                if modality == reference:
+                    continue
+                try:
+                    results.append(self.finish_modality(img_path, modality, coregistrations[subject],
+                                                        manifests[reference_path], output_dir, work_dir))
+                except Exception as e:
+                    logger.error(f"Erro ao processar a imagem {img_path}: {e}")
+                    results.append(None)
+
+        manifests, masked, coregistrations = None, None, None
+        gc.collect()
+        return results
+
+    # Paciente já processado: todas as modalidades com saída íntegra e com os mesmos parâmetros
+    def subject_complete(self, paths, output_dir, work_dir):
+        return all(is_complete(os.path.join(work_dir, modality), os.path.basename(path),
+                               os.path.join(output_dir, modality, os.path.basename(path)), self.modality_params(modality))
+                   for modality, path in paths.items())
@@ -1,9 +1,12 @@
 import os
+import json
+import time
 import SimpleITK as sitk
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import sys
 from datetime import datetime
 import logging
+from system_info import available_cores
 
 # CONFIGURAÇÕES DO LOG
 logging.basicConfig(
@@ -12,55 +15,143 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Índice das séries (persistido em DIR_RAW e atualizado só nas pastas que mudaram)
+INDEX_NAME = 'series_index.json'
+
+# A cada quantas séries convertidas o progresso vai pro log
+PROGRESS_EVERY = 50
+
+# Tag DICOM do Series Instance UID
+SERIES_UID_TAG = '0020|000e'
+
 # FUNÇÕES
 def get_f_dir(directory):
     sub_item = os.listdir(directory)
     directory = os.path.abspath(os.path.join(directory, sub_item[0]))
     return directory
 
-def load_dicom_series(input_folder):
+# Lê só os cabeçalhos da pasta numa única varredura do GDCM e guarda os arquivos da série na ordem de leitura
+# (sem série, o GetGDCMSeriesFileNames devolve a primeira, a mesma do GetGDCMSeriesIDs(pasta)[0]); o UID vem do
+# cabeçalho do primeiro arquivo, sem varrer a pasta de novo
+def scan_series(input_folder):
+    dicom_files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(input_folder)
+    if not dicom_files:
+        return None
+    header = sitk.ImageFileReader()
+    header.SetFileName(dicom_files[0])
+    header.ReadImageInformation()
+    return {
+        "series_id": header.GetMetaData(SERIES_UID_TAG).strip() if header.HasMetaDataKey(SERIES_UID_TAG) else None,
+        "files": list(dicom_files),
+        "bytes": sum(os.path.getsize(file) for file in dicom_files),
+        "mtime": os.path.getmtime(input_folder),
+    }
+
+def load_dicom_series(dicom_files):
     reader = sitk.ImageSeriesReader()
-    dicom_files = reader.GetGDCMSeriesFileNames(input_folder)
     reader.SetFileNames(dicom_files)
     image = reader.Execute()
     return image
 
+# Escrita atômica: grava num temporário no mesmo diretório (mantendo a extensão) e renomeia
 def save_as_nifti(image, output_file):
-    sitk.WriteImage(image, output_file)
+    directory, name = os.path.split(output_file)
+    tmp_file = os.path.join(directory, f".tmp-{os.getpid()}-{name}")
+    sitk.WriteImage(image, tmp_file)
+    os.replace(tmp_file, output_file)
 
 def reorient_image(image):
     # Reorienta a imagem para o sistema padrão RAS (Right, Anterior, Superior)
     return sitk.DICOMOrient(image, 'RAS')
 
-def convert_dicom_to_nifti(input_folder, output_folder):
-    logging.info(f"CONVERTENDO IMAGEM {input_folder}")
+def convert_dicom_to_nifti(dicom_files, output_file):
+    logging.info(f"CONVERTENDO IMAGEM {os.path.dirname(dicom_files[0])}")
 
-    # Formar nome de saída pelo 'I...'
-    output_name = os.path.basename(input_folder) + '.nii.gz'
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    # Carrega a série DICOM
-    image = load_dicom_series(input_folder)
+    # Carrega a série DICOM (arquivos já vêm do índice, sem reescanear a pasta)
+    image = load_dicom_series(dicom_files)
 
     # Reorienta a imagem para o padrão RAS
     image = reorient_image(image)
 
-    # Nome do arquivo NIfTI de saída
-    output_file = os.path.abspath(os.path.join(output_folder, output_name))
-
     # Salva no formato NIfTI
     save_as_nifti(image, output_file)
 
     # Mensagem de conclusão
-    logging.info(f"Imagem {output_name} convertida com sucesso!")
+    logging.info(f"Imagem {os.path.basename(output_file)} convertida com sucesso!")
+
+def load_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logging.warning(f"Índice corrompido, refazendo: {index_path}")
+        return {}
+
+def save_index(index, index_path):
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+def build_index(dir_base, dir_raw, executor):
+    """
+    Índice {pasta DICOM: série} de todas as subpastas/grupos.
+    Pastas que já estão no índice com o mesmo mtime não são lidas de novo; as outras
+    têm os cabeçalhos lidos em paralelo no mesmo pool da conversão.
+    """
+    index_path = os.path.join(dir_raw, INDEX_NAME)
+    old_index = load_index(index_path)
+
+    folders = {}
+    for subfolder in os.listdir(dir_base):
+        input_dir = os.path.join(dir_base, subfolder)
+        for group in os.listdir(input_dir):
+            input_folder = os.path.join(input_dir, group)
+            for file in os.listdir(input_folder):
+                # Nome de saída pela pasta 'I...'
+                folders[os.path.join(input_folder, file)] = os.path.join(dir_raw, subfolder, group, file + '.nii.gz')
+
+    index = {}
+    to_scan = []
+    for folder, output_file in folders.items():
+        entry = old_index.get(folder)
+        if entry is not None and entry.get("mtime") == os.path.getmtime(folder):
+            index[folder] = dict(entry, output=output_file)
+        else:
+            to_scan.append(folder)
+
+    logging.info(f"ÍNDICE: {len(index)} séries reaproveitadas, {len(to_scan)} pastas a ler")
+    futures = {executor.submit(scan_series, folder): folder for folder in to_scan}
+    for future in as_completed(futures):
+        folder = futures[future]
+        try:
+            entry = future.result()
+        except Exception as e:
+            logging.error(f"Erro ao ler os cabeçalhos de {folder}: {e}")
+            continue
+        if entry is None:
+            logging.warning(f"Nenhuma série DICOM em {folder}")
+            continue
+        index[folder] = dict(entry, output=folders[folder])
+
+    save_index(index, index_path)
+    return index
+
+# Progresso, séries/s, MB/s e tempo restante estimado
+def log_progress(done, total, done_bytes, total_bytes, start):
+    elapsed = max(time.monotonic() - start, 1e-6)
+    rate = done_bytes / elapsed
+    eta = (total_bytes - done_bytes) / rate if rate else float('inf')
+    logging.info(f"PROGRESSO: {done}/{total} séries | {done / elapsed:.2f} séries/s | "
+                 f"{rate / 2**20:.1f} MB/s | restante ~{eta / 60:.1f} min")
 
 # CONVERSÃO
 if __name__ == "__main__":
 
-    tot_images = 0
-
     DIR_BASE = os.path.abspath("/mnt/c/Users/Team Taiane/Desktop/ADNI/FULL_ADNI/DICOM")
     DIR_RAW = os.path.join("/mnt/c/Users/Team Taiane/Desktop/ADNI/FULL_ADNI/NIFTI_RAW")
 
@@ -71,38 +162,35 @@ if __name__ == "__main__":
     start_time = datetime.now()
     logging.info(f"Início do processamento em: {start_time}")
 
-    for subfolder in os.listdir(DIR_BASE):
-        input_dir = os.path.join(DIR_BASE, subfolder)
-        output_dir = os.path.join(DIR_RAW, subfolder)
-        for group in os.listdir(input_dir):
-            logging.info(f"\nCONVERSOES DA PASTA {group}\n")
-
-            input_folder = os.path.join(input_dir, group)
-            output_folder = os.path.join(output_dir, group)
-
-            os.makedirs(output_folder, exist_ok=True)
-
-            # Coletar todas as pastas DICOM
-            already_converted = [file for file in os.listdir(output_folder)]
-            dicom_folders = [os.path.join(input_folder, file) for file in os.listdir(input_folder) if file not in already_converted]
-
-            logging.info(f"IMAGENS PROCESSADAS: {len(already_converted)}\nIMAGENS A SEREM PROCESSADAS: {len(dicom_folders)}")
-
-            with ProcessPoolExecutor(16) as executor:
-                futures = {executor.submit(convert_dicom_to_nifti, folder, output_folder): folder for folder in dicom_folders}
-                
-                for future in futures:
-                    try:
-                        future.result()  # Relata erros
-                    except Exception as e:
-                        logging.error(f"Erro ao processar {futures[future]}: {e}")
-
-            tot_images += len(dicom_folders)
-
-            logging.info(f'\nForam convertidas {len(dicom_folders)} imagens!')
+    # Um único pool pra todas as subpastas e grupos (nada de reiniciar o pool a cada grupo)
+    with ProcessPoolExecutor(available_cores()) as executor:
+        index = build_index(DIR_BASE, DIR_RAW, executor)
+
+        # Séries ainda não convertidas, maiores primeiro (as longas não ficam sozinhas no fim)
+        pending = sorted((entry for entry in index.values() if not os.path.exists(entry["output"])),
+                         key=lambda entry: entry["bytes"], reverse=True)
+        total_bytes = sum(entry["bytes"] for entry in pending)
+
+        logging.info(f"IMAGENS PROCESSADAS: {len(index) - len(pending)}\nIMAGENS A SEREM PROCESSADAS: {len(pending)}")
+
+        start = time.monotonic()
+        futures = {executor.submit(convert_dicom_to_nifti, entry["files"], entry["output"]): entry for entry in pending}
+
+        done, done_bytes, errors = 0, 0, 0
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                future.result()  # Relata erros
+            except Exception as e:
+                errors += 1
+                logging.error(f"Erro ao processar {os.path.dirname(entry['files'][0])}: {e}")
+            done += 1
+            done_bytes += entry["bytes"]
+            if done % PROGRESS_EVERY == 0 or done == len(pending):
+                log_progress(done, len(pending), done_bytes, total_bytes, start)
 
     # Fim do processamento
-    logging.info(f'\nForam convertidas {len(dicom_folders)} imagens!')
+    logging.info(f'\nForam convertidas {done - errors} imagens! ({errors} erros)')
     end_time = datetime.now()
     logging.info(f"Término do processamento em: {end_time}")
-    logging.info(f"Duração total: {end_time - start_time}")
\ No newline at end of file
+    logging.info(f"Duração total: {end_time - start_time}")
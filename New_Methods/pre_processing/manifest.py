@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+import ants
+from registration import hash_file
+from scheduler import note_stage
+from stage_profiler import stage
+from brain_crop import sidecar_path
+
+logger = logging.getLogger()
+
+MANIFEST_NAME = 'manifest.json'
+
+# FUNÇÕES
+# Caminho temporário no mesmo diretório do destino, mantendo a extensão (o ANTs escolhe o formato por ela)
+def _tmp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".tmp-{os.getpid()}-{name}")
+
+# Escrita atômica: grava num arquivo temporário e renomeia, então nunca existe saída pela metade
+def atomic_image_write(image, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = _tmp_path(path)
+    ants.image_write(image, tmp)
+    os.replace(tmp, path)
+
+def atomic_json_write(data, path):
+    tmp = _tmp_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True, default=str)
+    os.replace(tmp, path)
+
+def atomic_copy(src, dst):
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp = _tmp_path(dst)
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+# Chave de um estágio: hashes das entradas + parâmetros
+def stage_key(name, inputs, params):
+    payload = json.dumps({"stage": name, "inputs": list(inputs), "params": params or {}}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _params_signature(params):
+    return json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+
+
+class ImageManifest:
+    """
+    Manifesto por imagem dos estágios do pré-processamento (registrada, máscara,
+    crop, N4, normalizada). Cada estágio guarda os hashes das entradas, os parâmetros,
+    o artefato intermediário e o checksum dele. Numa nova execução um estágio só é
+    recalculado se a entrada (checksum do estágio anterior) ou os parâmetros mudaram,
+    ou se o artefato sumiu/foi corrompido; caso contrário a imagem continua do último
+    estágio válido.
+    """
+    def __init__(self, work_dir, image_id, source_path, source_loader=None):
+        self.image_id = image_id
+        self.dir = os.path.join(work_dir, image_id)
+        os.makedirs(self.dir, exist_ok=True)
+        self.path = os.path.join(self.dir, MANIFEST_NAME)
+        self.records = self._load()
+
+        # Estado do "cursor": hash e imagem do último estágio percorrido
+        self._hash = hash_file(source_path)
+        self._artifact = None
+        self._image = None
+        self._loader = source_loader or (lambda: ants.image_read(source_path))
+        # Metadados dos estágios percorridos (ex: caixa do corte), gravados no sidecar da saída final
+        self.metadata = {}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Manifesto corrompido, refazendo: {self.path}")
+            return {}
+
+    def save(self):
+        atomic_json_write(self.records, self.path)
+
+    def artifact_path(self, name):
+        return os.path.join(self.dir, f"{name}.nii.gz")
+
+    def _is_valid(self, record, key):
+        if not record or record.get('key') != key:
+            return False
+        path = record.get('output')
+        return path is not None and os.path.exists(path) and hash_file(path) == record.get('checksum')
+
+    def current(self):
+        """Imagem do último estágio percorrido (carregada do artefato só quando preciso)."""
+        if self._image is None:
+            # Com a leitura antecipada do run_parallel, o tempo medido é só a espera pela leitura
+            with stage('read', image=self.image_id):
+                self._image = self._loader()
+        return self._image
+
+    def is_fresh(self, name, params=None, inputs=None):
+        """Verifica, sem executar nada, se o próximo estágio pode ser reaproveitado."""
+        key = stage_key(name, [self._hash] + list(inputs or []), params)
+        return self._is_valid(self.records.get(name), key)
+
+    def run(self, name, compute, params=None, inputs=None, metadata=None):
+        """
+        Executa (ou retoma) um estágio.
+        :param name: Nome do estágio (ex: 'registered', 'n4').
+        :param compute: Função que recebe a imagem do estágio anterior e devolve a nova imagem ANTs
+                        (ou uma tupla (imagem, metadados) quando os metadados dependem da imagem).
+        :param params: Parâmetros do estágio; mudar qualquer um invalida este estágio e os seguintes.
+        :param inputs: Hashes de entradas extras (ex: template, máscara).
+        :param metadata: Metadados do estágio (ex: caixa do corte), guardados no manifesto e no sidecar da saída.
+        :return: True se o estágio foi recalculado, False se foi reaproveitado.
+        """
+        key = stage_key(name, [self._hash] + list(inputs or []), params)
+        record = self.records.get(name)
+
+        if self._is_valid(record, key):
+            artifact = record['output']
+            self._hash = record['checksum']
+            self._artifact = artifact
+            self._image = None
+            self._loader = lambda: ants.image_read(artifact)
+            self.metadata.update(record.get('metadata') or {})
+            return False
+
+        image = self.current()
+        with stage(name, image=self.image_id):
+            image = compute(image)
+            note_stage(name)
+        if isinstance(image, tuple):
+            image, metadata = image[0], dict(metadata or {}, **image[1])
+        artifact = self.artifact_path(name)
+        with stage('write', image=self.image_id, artifact=name):
+            atomic_image_write(image, artifact)
+            checksum = hash_file(artifact)
+
+        self.records[name] = {
+            "key": key,
+            "inputs": [self._hash] + list(inputs or []),
+            "params": _params_signature(params),
+            "output": artifact,
+            "checksum": checksum,
+            "time": datetime.now().isoformat(),
+        }
+        if metadata:
+            self.records[name]["metadata"] = metadata
+            self.metadata.update(metadata)
+        self.save()
+
+        self._hash = checksum
+        self._artifact = artifact
+        self._image = image
+        return True
+
+    def export(self, output_path, params=None):
+        """
+        Copia o artefato do último estágio para a saída final (atomicamente) e registra no manifesto.
+        Os metadados dos estágios (ex: caixa do corte) vão num sidecar JSON ao lado da saída (brain_crop.sidecar_path).
+        """
+        with stage('export', image=self.image_id):
+            atomic_copy(self._artifact, output_path)
+            if self.metadata:
+                atomic_json_write(self.metadata, sidecar_path(output_path))
+        self.records['export'] = {
+            "output": output_path,
+            "checksum": self._hash,
+            "params": _params_signature(params),
+            "time": datetime.now().isoformat(),
+        }
+        if self.metadata:
+            self.records['export']["metadata"] = _params_signature(self.metadata)
+        self.save()
+
+
+def is_complete(work_dir, image_id, output_path, params=None):
+    """
+    Verifica (sem recalcular nada) se a saída final de uma imagem existe, bate com o
+    checksum registrado e foi gerada com os mesmos parâmetros do pipeline atual.
+    """
+    manifest_path = os.path.join(work_dir, image_id, MANIFEST_NAME)
+    if not os.path.exists(manifest_path) or not os.path.exists(output_path):
+        return False
+    try:
+        with open(manifest_path) as f:
+            export = json.load(f).get('export')
+    except (OSError, ValueError):
+        return False
+    if not export or export.get('output') != output_path:
+        return False
+    if export.get('params') != _params_signature(params):
+        return False
+    if export.get('metadata') and not os.path.exists(sidecar_path(output_path)):
+        return False
+    return hash_file(output_path) == export.get('checksum')
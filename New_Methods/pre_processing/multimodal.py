@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import os
+import logging
+import numpy as np
+import ants
+from registration import RegistrationEngine, hash_file
+
+logger = logging.getLogger()
+
+# Registro de cada modalidade até a referência do mesmo paciente (mesma cabeça, só posição/rotação mudam)
+COREGISTRATION_STAGES = ('Rigid',)
+
+# FUNÇÕES
+# Id do paciente pelo nome do arquivo (<paciente>_<modalidade>.nii.gz, como no GridCreation e no SaveAllSlices)
+def subject_id(file_name):
+    return file_name.split('_')[0]
+
+def find_subjects(input_dir, modalities, reference):
+    """
+    Agrupa as modalidades de cada paciente: <input_dir>/<modalidade>/<paciente>_<modalidade>.nii(.gz).
+    Pacientes sem a modalidade de referência ficam de fora (não há em que alinhar as outras).
+    :return: Lista de (paciente, {modalidade: caminho}), ordenada pelo id do paciente.
+    """
+    subjects = {}
+    for modality in modalities:
+        folder = os.path.join(input_dir, modality)
+        if not os.path.isdir(folder):
+            logger.warning(f"Pasta da modalidade {modality} não encontrada: {folder}")
+            continue
+        for file in sorted(os.listdir(folder)):
+            if file.endswith(('.nii', '.nii.gz')):
+                subjects.setdefault(subject_id(file), {})[modality] = os.path.join(folder, file)
+
+    complete = []
+    for subject, paths in sorted(subjects.items()):
+        if reference not in paths:
+            logger.warning(f"Paciente {subject} sem {reference}, pulado ({sorted(paths)})")
+            continue
+        missing = [modality for modality in modalities if modality not in paths]
+        if missing:
+            logger.warning(f"Paciente {subject} sem {missing}, processando só {sorted(paths)}")
+        complete.append((subject, paths))
+    return complete
+
+# Máscara binária a partir da imagem já mascarada (o fundo foi zerado pela extração do cérebro)
+def mask_from_masked(image):
+    return image.new_image_like((image.numpy() != 0).astype(np.float32))
+
+
+class CoRegistration:
+    """
+    Registro multimodal de um paciente. A modalidade de referência vai pro template com o RegistrationEngine
+    (cascata completa, com cache); cada outra modalidade recebe só um registro rígido até a referência, no espaço
+    nativo do paciente (também em cache). As transformações são compostas, então cada modalidade é reamostrada uma
+    única vez, direto no template (ou no grid cortado do engine).
+    """
+    def __init__(self, engine, reference_path, cache_dir=None, stages=COREGISTRATION_STAGES, reference_loader=None):
+        self.engine = engine
+        self.reference_path = reference_path
+        self.reference_hash = hash_file(reference_path)
+        self.cache_dir = cache_dir
+        self.stages = tuple(stages)
+        self._loader = reference_loader or (lambda: ants.image_read(reference_path))
+        self._reference = None
+        self._transforms = None
+
+    def reference_image(self):
+        """Referência no espaço nativo (lida só quando uma modalidade precisa ser registrada nela)."""
+        if self._reference is None:
+            self._reference = self._loader()
+        return self._reference
+
+    def reference_transforms(self):
+        """Transformações referência -> template (do cache quando a referência já foi registrada)."""
+        if self._transforms is None:
+            cache = self.engine.cache
+            cached = cache.get(self.engine.key(self.reference_hash)) if cache is not None else None
+            self._transforms = cached or self.engine.get_transforms(self.reference_image(), moving_hash=self.reference_hash)
+        return self._transforms
+
+    def register_reference(self, image):
+        """Estágio 'registered' da referência (mesmo registro do pipeline de uma modalidade)."""
+        if self._reference is None:
+            self._reference = image
+        self._transforms = self.engine.get_transforms(image, moving_hash=self.reference_hash)
+        return self.engine.apply(image, self._transforms)
+
+    def register_modality(self, image, moving_hash):
+        """Estágio 'registered' de outra modalidade: rígido até a referência, composto com referência -> template."""
+        coregistration = RegistrationEngine(self.reference_image(), cache_dir=self.cache_dir, stages=self.stages,
+                                            template_hash=self.reference_hash)
+        rigid = coregistration.get_transforms(image, moving_hash=moving_hash)
+        # O ants.apply_transforms aplica a lista de trás pra frente: modalidade -> referência, depois referência -> template
+        return self.engine.apply(image, list(self.reference_transforms()) + list(rigid))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import numpy as np
+from stage_profiler import stage
+
+# Número de bins do histograma usado pra estimar os percentis
+# (erro máximo de (max - min) / DEFAULT_BINS, reduzido pela interpolação dentro do bin)
+DEFAULT_BINS = 4096
+
+# Quantidade de fatias processadas por vez (limita os temporários a um pedaço do volume)
+CHUNK_SLICES = 16
+
+
+# FUNÇÕES
+# Máscara padrão: voxels diferentes de zero (o fundo já foi zerado pela máscara do cérebro)
+def brain_mask(data):
+    return data != 0
+
+def _as_batch(volumes):
+    # Aceita um volume só, uma lista de volumes do mesmo shape ou um array (N, ...)
+    if isinstance(volumes, np.ndarray) and volumes.dtype == np.float32:
+        return volumes
+    return np.asarray(volumes, dtype=np.float32)
+
+def _masked_min_max(batch, masks):
+    # Reduções com where= não criam cópia dos voxels mascarados
+    axes = tuple(range(1, batch.ndim))
+    lower = np.min(batch, axis=axes, where=masks, initial=np.inf)
+    upper = np.max(batch, axis=axes, where=masks, initial=-np.inf)
+    empty = lower > upper
+    lower[empty], upper[empty] = 0, 0
+    return lower, upper
+
+def batch_percentiles(batch, masks, percentiles, bins=DEFAULT_BINS):
+    """
+    Estima percentis de cada volume de um lote a partir de um histograma dos voxels da máscara.
+    Os histogramas de todos os volumes são acumulados num único bincount (bins deslocados
+    por volume), processando CHUNK_SLICES fatias por vez, sem ordenar nem copiar o volume todo.
+    :param batch: Array float32 (N, ...) com os volumes.
+    :param masks: Array booleano com o mesmo shape de batch.
+    :param percentiles: Sequência de percentis (0-100).
+    :param bins: Número de bins do histograma.
+    :return: Array (N, len(percentiles)) com os limites de intensidade de cada volume.
+    """
+    n = batch.shape[0]
+    lower, upper = _masked_min_max(batch, masks)
+    width = np.where(upper > lower, (upper - lower) / bins, 1).astype(np.float32)
+    offsets = np.arange(n) * bins
+
+    counts = np.zeros(n * bins, dtype=np.int64)
+    for start in range(0, batch.shape[1], CHUNK_SLICES):
+        chunk = batch[:, start:start + CHUNK_SLICES]
+        chunk_mask = masks[:, start:start + CHUNK_SLICES]
+        volume_idx = np.nonzero(chunk_mask)[0]
+        values = chunk[chunk_mask]
+        bin_idx = ((values - lower[volume_idx]) / width[volume_idx]).astype(np.int64)
+        np.minimum(bin_idx, bins - 1, out=bin_idx)
+        counts += np.bincount(bin_idx + offsets[volume_idx], minlength=n * bins)
+
+    counts = counts.reshape(n, bins)
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1]
+
+    result = np.zeros((n, len(percentiles)), dtype=np.float32)
+    for i in range(n):
+        if totals[i] == 0:
+            continue
+        for j, percentile in enumerate(percentiles):
+            # Posição do percentil entre os voxels ordenados (mesma convenção linear do np.percentile)
+            rank = percentile / 100 * (totals[i] - 1)
+            b = int(np.searchsorted(cumulative[i], rank, side='right'))
+            b = min(b, bins - 1)
+            before = cumulative[i, b - 1] if b > 0 else 0
+            # Interpola dentro do bin assumindo os voxels espalhados uniformemente nele
+            fraction = (rank - before + 0.5) / counts[i, b] if counts[i, b] else 0
+            result[i, j] = lower[i] + (b + min(max(fraction, 0), 1)) * width[i]
+        # Os extremos são exatos
+        result[i] = np.clip(result[i], lower[i], upper[i])
+        result[i][np.asarray(percentiles) <= 0] = lower[i]
+        result[i][np.asarray(percentiles) >= 100] = upper[i]
+    return result
+
+
+def normalize_batch(volumes, masks=None, lower_percentile=0, upper_percentile=99.9, bins=DEFAULT_BINS):
+    """
+    Winsorizing + normalização entre 0 e 1 de um lote de volumes, em float32 e no próprio array.
+    Os percentis são calculados só nos voxels do cérebro; o fundo termina em 0.
+    :param volumes: Array (N, ...) ou lista de volumes com o mesmo shape.
+    :param masks: Máscaras booleanas (mesmo shape); se None, usa os voxels diferentes de zero.
+    :param lower_percentile: Percentil inferior do winsorizing.
+    :param upper_percentile: Percentil superior do winsorizing.
+    :return: Array float32 (N, ...) normalizado (o mesmo objeto se a entrada já era float32).
+    """
+    batch = _as_batch(volumes)
+    masks = brain_mask(batch) if masks is None else np.asarray(masks, dtype=bool)
+
+    # Winsorize -> reduz outliers, limitando os percentis inf e sup
+    with stage('winsorize'):
+        bounds = batch_percentiles(batch, masks, (lower_percentile, upper_percentile), bins=bins)
+        for i in range(batch.shape[0]):
+            np.clip(batch[i], bounds[i][0], bounds[i][1], out=batch[i])
+
+    # Normalization -> valores de voxels entre 0 e 1
+    with stage('normalize'):
+        for i in range(batch.shape[0]):
+            lower, upper = bounds[i]
+            volume = batch[i]
+            volume -= lower
+            if upper > lower:
+                volume *= np.float32(1 / (upper - lower))
+            np.multiply(volume, masks[i], out=volume) # fundo em 0
+    return batch
+
+def normalize_volume(data, mask=None, lower_percentile=0, upper_percentile=99.9, bins=DEFAULT_BINS):
+    """Versão de normalize_batch pra um único volume."""
+    batch = _as_batch(data)[np.newaxis]
+    masks = None if mask is None else np.asarray(mask, dtype=bool)[np.newaxis]
+    return normalize_batch(batch, masks, lower_percentile, upper_percentile, bins)[0]
@@ -1,135 +1,104 @@
 #!/usr/bin/env python3
 import os
-from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from functools import partial
-from concurrent.futures import as_completed
-import os
-import numpy as np
 import ants
 import logging
-from antspynet.utilities import brain_extraction
-import gc
+from registration import hash_image
+from manifest import is_complete
+from scheduler import run_parallel, DEFAULT_PEAK_RSS
+from brain_extraction_service import DEFAULT_BATCH_SIZE
+from brain_pipeline import BrainPipeline, pipeline_params
+from multimodal import find_subjects
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"  # Desativa GPUs
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # Supressão de logs detalhados do TensorFlow
 
 MODALITY = 't1' #BOTE 'flair' ou 't1'
+BATCH_SIZE = DEFAULT_BATCH_SIZE # volumes por forward pass da extração do cérebro
+# 'subject': corta pela caixa da máscara do cérebro do próprio paciente logo depois da extração (N4 e normalização
+# só veem a caixa; a caixa fica no sidecar .json da saída). None mantém o grid inteiro do template, que o ViT 2D espera
+CROP_SOURCE = None
+# Modo multimodal (<DIR_INPUT>/<modalidade>/<paciente>_<modalidade>.nii.gz): só a REFERENCE_MODALITY é registrada no
+# template e passa pela extração do cérebro (com os pesos de MODALITY); as outras recebem um registro rígido até ela,
+# as transformações compostas e a mesma máscara do cérebro. None = uma modalidade por pasta, como antes
+MODALITIES = None # ex: ['T1', 'Flair', 'T2']
+REFERENCE_MODALITY = 'T1'
 
 # Configuração do logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
-# FUNÇÕES
-# Winsorize -> reduz outliers, limitando os percentis inf e sup
-def winsorize_image(image_data, lower_percentile=0, upper_percentile=99.9):
-    lower_bound = np.percentile(image_data, lower_percentile)
-    upper_bound = np.percentile(image_data, upper_percentile)
-    winsorized_data = np.clip(image_data, lower_bound, upper_bound)
-    return winsorized_data
-
-# Normalization -> valores de voxels entre 0 e 1
-def normalize_image(image_data):
-    min_val = np.min(image_data)
-    max_val = np.max(image_data)
-    normalized_data = (image_data - min_val) / (max_val - min_val)
-    return normalized_data
-
-# Função para processar uma única imagem
-def process_image(img_path, output_dir):
-    output_path = os.path.join(output_dir, os.path.basename(img_path))
-    try:
-        logger.info(f"Inicio processamento: {img_path}")
-        # Carrega a imagem
-        image = ants.image_read(img_path)
-
-        # Registra pra padronizar shape da imagem
-        registration = ants.registration(fixed=template, moving=image, type_of_transform='Affine')
-        affine_image = registration['warpedmovout']
-
-        # Cria template pra máscara
-        prob_mask = brain_extraction(affine_image, modality=MODALITY)
-        logger.info(f"Template obtido.")
-
-        # Cria a máscara
-        mask = ants.get_mask(prob_mask, low_thresh=0.5)
-        logger.info(f"Máscara aplicada.")
-
-        # Máscara do cérebro e extração
-        brain_masked = ants.mask_image(affine_image, mask)
-        logger.info(f"Extração.")
-
-        # Bias Field Correction
-        #image = ants.from_numpy(data, origin=image.origin, spacing=image.spacing, direction=image.direction)
-        image = ants.n4_bias_field_correction(brain_masked, shrink_factor=2)
-        data = image.numpy()
-        logger.info(f"Bias Corrigido.")
-
-        # Winsorizing
-        data = winsorize_image(data, 0, 99.9)
-        logger.info(f"Winsorized.")
-
-        # Normalização
-        data = normalize_image(data)
-        image = ants.from_numpy(data, origin=brain_masked.origin, spacing=brain_masked.spacing, direction=brain_masked.direction)
-
-        logger.info(f"Imagem {img_path} processada.")
-
-        ants.image_write(image, output_path)
-        logger.info(f"Imagem salva: {os.path.basename(output_path)}")
-
-        gc.collect()
-
-        return image
-        
-    except Exception as e:
-        logger.error(f"Erro ao processar a imagem {img_path}: {e}")
-        return None
-    
+# Parâmetros de cada estágio, registrados no manifesto (a cadeia em si fica no brain_pipeline.py)
+PIPELINE_PARAMS = pipeline_params(MODALITY, CROP_SOURCE)
+
 subsets = ['train', 'validation', 'test']
     
 # DIRETÓRIOS
 DIR_INPUT_BASE = f"/mnt/c/Users/Paulo Pires/Desktop/Alzheimer_cnn/NIFTI_RAW"
 DIR_OUTPUT_BASE = "/mnt/c/Users/Paulo Pires/Desktop/Alzheimer_cnn/NIFTI_PROCESSED"
-os.makedirs(DIR_OUTPUT_BASE, exist_ok=True)
+DIR_TRANSFORMS = "/mnt/c/Users/Paulo Pires/Desktop/Alzheimer_cnn/TRANSFORM_CACHE" # transformações do registro reaproveitadas entre execuções
+DIR_WORK_BASE = "/mnt/c/Users/Paulo Pires/Desktop/Alzheimer_cnn/NIFTI_WORK" # manifestos e artefatos intermediários de cada estágio
 
 template_path = "/mnt/c/Users/Paulo Pires/Desktop/Alzheimer_cnn/Alzheimer-CNN-Detection/pre_processing/mni_icbm152_nlin_asym_09c_nifti/mni_icbm152_nlin_asym_09c/mni_icbm152_t1_tal_nlin_asym_09c.nii"
-template = ants.image_read(template_path)
-
-for subset in subsets:
-    DIR_SUBSET_INPUT = f"{DIR_INPUT_BASE}/{subset}"
-    DIR_SUBSET_OUTPUT = f"{DIR_OUTPUT_BASE}/{subset}"
-    os.makedirs(DIR_SUBSET_OUTPUT, exist_ok=True)
 
-    for label in ['cn', 'emci', 'mci', 'lmci', 'ad']:
-        DIR_INPUT = f"{DIR_SUBSET_INPUT}/{label}"
-        DIR_OUTPUT = f"{DIR_SUBSET_OUTPUT}/{label}"
-        os.makedirs(DIR_OUTPUT, exist_ok=True)
+PROFILE_PATH = f"{DIR_WORK_BASE}/resource_profile.json" # picos de memória medidos por estágio, usados pra dimensionar os workers
+STAGE_LOG = f"{DIR_WORK_BASE}/stage_log" # tempo, CPU e pico de RSS de cada estágio de cada imagem (resumo: python stage_profiler.py <pasta>)
+
+# Início do processamento
+if __name__ == "__main__":
+    pipeline = BrainPipeline(PIPELINE_PARAMS, transforms_dir=DIR_TRANSFORMS, batch_size=BATCH_SIZE,
+                             reference_modality=REFERENCE_MODALITY)
+    os.makedirs(DIR_OUTPUT_BASE, exist_ok=True)
+    template = ants.image_read(template_path)
+    shared_objects = {'template': template, 'template_hash': hash_image(template)}
+
+    for subset in subsets:
+        DIR_SUBSET_INPUT = f"{DIR_INPUT_BASE}/{subset}"
+        DIR_SUBSET_OUTPUT = f"{DIR_OUTPUT_BASE}/{subset}"
+        os.makedirs(DIR_SUBSET_OUTPUT, exist_ok=True)
+
+        for label in ['cn', 'emci', 'mci', 'lmci', 'ad']:
+            DIR_INPUT = f"{DIR_SUBSET_INPUT}/{label}"
+            DIR_OUTPUT = f"{DIR_SUBSET_OUTPUT}/{label}"
+            DIR_WORK = f"{DIR_WORK_BASE}/{subset}/{label}"
+            os.makedirs(DIR_OUTPUT, exist_ok=True)
+
+            if MODALITIES:
+                # Um item por paciente, com todas as modalidades; as referências de cada bloco passam juntas pela extração
+                subjects = find_subjects(DIR_INPUT, MODALITIES, REFERENCE_MODALITY)
+                pending = [(subject, paths) for subject, paths in subjects
+                           if not pipeline.subject_complete(paths, DIR_OUTPUT, DIR_WORK)]
+                print(f"\n\nPACIENTES PROCESSADOS: {len(subjects) - len(pending)}\nPACIENTES A PROCESSAR: {len(pending)}\n\n")
+
+                start_time = datetime.now()
+                run_parallel(partial(pipeline.process_subjects, output_dir=DIR_OUTPUT, work_dir=DIR_WORK), pending,
+                             shared_objects=shared_objects, profile_path=PROFILE_PATH, default_peak_rss=DEFAULT_PEAK_RSS,
+                             chunk_size=BATCH_SIZE, batched=True, stage_log=STAGE_LOG)
+                logger.info(f"Duração total: {datetime.now() - start_time}")
+                continue
+
+            # Checa o manifesto pra ver se alguma imagem já foi processada (saída íntegra e com os mesmos parâmetros)
+            already_processed = [file for file in os.listdir(DIR_INPUT)
+                                 if is_complete(DIR_WORK, file, os.path.join(DIR_OUTPUT, file), PIPELINE_PARAMS)]
+
+            # Lista de caminhos para as imagens brutas
+            image_paths = [os.path.join(DIR_INPUT, file) for file in os.listdir(DIR_INPUT) if file not in already_processed]
 
-        # Checa o diretório de saída pra ver se alguma imagem já foi processada
-        already_processed = [file for file in os.listdir(DIR_OUTPUT)]
-
-        # Lista de caminhos para as imagens brutas
-        image_paths = [os.path.join(DIR_INPUT, file) for file in os.listdir(DIR_INPUT) if file not in already_processed]
-
-        # Início do processamento
-        if __name__ == "__main__":
             start_time = datetime.now()
             logger.info(f"Início do processamento em: {start_time}")
 
             print(f"\n\nIMAGENS PROCESSADAS: {len(already_processed)}\nIMAGENS A PROCESSAR: {len(image_paths)}\n\n")
 
-            # Função parcial para passar parâmetros fixos
-            process_func = partial(process_image, output_dir=DIR_OUTPUT)
-
-            # Processamento e salvamento de cada imagem usando ProcessPoolExecutor
-            with ProcessPoolExecutor(max_workers=16) as executor: #max_workers define o número máximo de processos paralelos
+            # Função parcial para passar parâmetros fixos (só caminhos; o template vai pelo initializer)
+            process_func = partial(pipeline.process_images, output_dir=DIR_OUTPUT, work_dir=DIR_WORK)
 
-                # dependendo do pc, é melhor fazer um proceso só, pois paralelizar pode deixar cada processo mais demorado sem hardware que aguente
-                futures = [executor.submit(process_func, img_path) for img_path in image_paths]
-                
-                for future in as_completed(futures):
-                    future.result()  # Pega o resultado para garantir que exceções sejam lançadas
+            # Processamento e salvamento de cada imagem
+            # Número de processos e threads do ITK/TensorFlow definidos pelos núcleos e pelo pico de memória medido,
+            # com as leituras adiantadas em segundo plano; cada bloco de BATCH_SIZE imagens passa junto pela extração do cérebro
+            run_parallel(process_func, image_paths, shared_objects=shared_objects,
+                         reader=ants.image_read, profile_path=PROFILE_PATH, default_peak_rss=DEFAULT_PEAK_RSS,
+                         chunk_size=BATCH_SIZE, batched=True, stage_log=STAGE_LOG)
 
             # Fim do processamento
             end_time = datetime.now()
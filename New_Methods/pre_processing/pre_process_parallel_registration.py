@@ -3,109 +3,92 @@ import os
 import numpy as np
 import ants
 import logging
-from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from functools import partial
-from concurrent.futures import as_completed
 import gc
-
-# Índices de corte para o corte NIfTI
-SLICE_NII_IDX0 = slice(24, 169)
-SLICE_NII_IDX1 = slice(24, 206)
-SLICE_NII_IDX2 = slice(6, 161)
+from registration import RegistrationEngine, DEFAULT_STAGES, hash_file, hash_image
+from manifest import ImageManifest, is_complete
+from normalization import normalize_volume, DEFAULT_BINS
+from scheduler import run_parallel, shared
+from stage_profiler import read_records, summarize, print_summary
+from brain_crop import brain_box, crop_image, crop_info, CROP_KEY, DEFAULT_MARGIN
+
+# Corte pela caixa da máscara do cérebro do template (com CROP_MARGIN voxels de folga), em vez de índices fixos:
+# a caixa é calculada uma vez e a saída do registro já é reamostrada no grid cortado
+CROP_MARGIN = DEFAULT_MARGIN
+# Orientação na leitura das imagens brutas (a mesma vale pra leitura antecipada do run_parallel e pro loader do manifesto)
+ORIENTATION = 'IRA'
 
 # Configuração do logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
 # FUNÇÕES
-# Winsorize -> reduz outliers, limitando os percentis inf e sup
-def winsorize_image(image_data, lower_percentile=0, upper_percentile=98): #reduz valores extremos
-    lower_bound = np.percentile(image_data, lower_percentile)
-    upper_bound = np.percentile(image_data, upper_percentile)
-    winsorized_data = np.clip(image_data, lower_bound, upper_bound)
-    return winsorized_data
-
-# Normalization -> valores de voxels entre 0 e 1
-def normalize_image_min(image_data): 
-    min_val = np.min(image_data)
-    max_val = np.max(image_data)
-    normalized_data = (image_data - min_val) / (max_val - min_val)
-    return normalized_data
+# Parâmetros de cada estágio, registrados no manifesto (mudar um deles refaz só esse estágio e os seguintes)
+PIPELINE_PARAMS = {
+    'registered': {'stages': list(DEFAULT_STAGES), 'crop': {'source': 'template', 'margin': CROP_MARGIN}},
+    'brain_masked': {},
+    'n4': {'shrink_factor': 2},
+    'normalized': {'lower_percentile': 0, 'upper_percentile': 99.9, 'bins': DEFAULT_BINS},
+}
 
 # Função para processar uma única imagem
-def process_image(img_path, template, mask, orient):
+# Cada estágio fica registrado no manifesto da imagem, então uma nova execução continua do último estágio válido
+# Template, template cortado, máscara (já cortada) e seus hashes vêm do initializer do worker (enviados uma vez por processo, não por tarefa)
+def process_image(img_path, orient, work_dir, cache_dir=None, loader=None):
     try:
+        template, mask = shared('template'), shared('mask')
         #logger.info(f"IMAGE_TO_READ {img_path}")
-        # Carrega a imagem
-        image = ants.image_read(img_path, reorient=orient)
+        # Carrega a imagem (só quando algum estágio precisar ser recalculado; o loader traz a leitura antecipada)
+        manifest = ImageManifest(work_dir, os.path.basename(img_path), img_path,
+                                 source_loader=loader or (lambda: ants.image_read(img_path, reorient=orient)))
         #logger.info(f"IMAGE_READ")
 
-        # Registro (Registration) com as transformações para a imagem e máscara, com intuito de melhorar o corte
-        registration = ants.registration(fixed=template, moving=image, type_of_transform='Translation')
-        warped_image = registration['warpedmovout']
-        #logger.info(f"TRANSLATION")
-
-        registration = ants.registration(fixed=template, moving=warped_image, type_of_transform='Rigid')
-        warped_image = registration['warpedmovout']
-        #logger.info(f"RIGID")
-
-        registration = ants.registration(fixed=template, moving=warped_image, type_of_transform='Affine')
-        warped_image = registration['warpedmovout']
-        #logger.info(f"AFFINE")
-
-        registration = ants.registration(fixed=template, moving=warped_image, type_of_transform='SyN')
-        warped_image = registration['warpedmovout']
+        # Registro (Registration) em cascata Translation -> Rigid -> Affine -> SyN, com intuito de melhorar o corte
+        # Cada estágio parte da transformação do anterior e a imagem só é reamostrada uma vez no final,
+        # direto no grid do template cortado pela caixa do cérebro (máscara, N4 e normalização só veem a caixa)
+        engine = RegistrationEngine(template, cache_dir=cache_dir, stages=DEFAULT_STAGES, template_hash=shared('template_hash'),
+                                    reference=shared('reference'))
+        manifest.run(
+            'registered',
+            lambda image: engine.register(image, moving_hash=hash_file(img_path), orient=orient)[0],
+            params=dict(PIPELINE_PARAMS['registered'], orient=orient),
+            inputs=[engine.template_hash, shared('reference_hash')],
+            metadata={CROP_KEY: shared('crop')},
+        )
         #logger.info(f"SYN")
 
         # Máscara do cérebro e extração
-        brain_masked = ants.mask_image(warped_image, mask)
-        data = brain_masked.numpy()
-
-        # Aplicação do crop usando slices diretamente
-        data = data[
-            SLICE_NII_IDX0,
-            SLICE_NII_IDX1,
-            SLICE_NII_IDX2
-        ]
-        
-        # Recria a imagem ANTs com os dados cortados
-        image = ants.from_numpy(
-            data,
-            origin=brain_masked.origin,
-            spacing=brain_masked.spacing,
-            direction=brain_masked.direction
-        )
+        manifest.run('brain_masked', lambda image: ants.mask_image(image, mask),
+                     params=PIPELINE_PARAMS['brain_masked'], inputs=[shared('mask_hash')])
 
         # Bias Field Correction
-        image = ants.n4_bias_field_correction(image, shrink_factor=2)
+        manifest.run('n4', lambda image: ants.n4_bias_field_correction(image, **PIPELINE_PARAMS['n4']),
+                     params=PIPELINE_PARAMS['n4'])
         #logger.info(f"BIAS")
 
-        # Winsorizing
-        data = image.numpy()
-        data = winsorize_image(data, lower_percentile=0, upper_percentile=99.9)
-
-        # Normalização
-        data = normalize_image_min(data)
-        image = ants.from_numpy(data, origin=image.origin, spacing=image.spacing, direction=image.direction)
+        # Winsorizing + Normalização (percentis só dos voxels do cérebro, em float32 e no próprio array)
+        def normalize(image):
+            data = normalize_volume(image.numpy(), **PIPELINE_PARAMS['normalized'])
+            return ants.from_numpy(data, origin=image.origin, spacing=image.spacing, direction=image.direction)
+        manifest.run('normalized', normalize, params=PIPELINE_PARAMS['normalized'])
 
-        return image
+        return manifest
         
     except Exception as e:
         logger.error(f"Erro ao processar a imagem {os.path.basename(img_path)}: {e}")
         return None
 
 # Função que processa e salva uma imagem
-def process_and_save_image(img_path, template, mask, output_dir, orient):
+def process_and_save_image(img_path, loader=None, output_dir=None, orient='IRA', work_dir=None, cache_dir=None):
     logger.info(f"Imagem em processamento: {img_path}")
-    normalized_image = process_image(img_path, template, mask, orient) #processa imagem
-    if normalized_image is not None:
-        os.makedirs(output_dir, exist_ok=True) #cria o diretório onde será salvo caso não exista
+    manifest = process_image(img_path, orient, work_dir, cache_dir, loader) #processa imagem
+    if manifest is not None:
         output_path = os.path.join(output_dir, os.path.basename(img_path)) 
-        ants.image_write(normalized_image, output_path)
+        manifest.export(output_path, params=PIPELINE_PARAMS) # escrita atômica da saída final
         logger.info(f"Imagem salva: {os.path.basename(output_path)}")
         # Liberar a memória manualmente
-        normalized_image = None
+        manifest = None
         gc.collect()
 
 # Início do processamento
@@ -115,6 +98,10 @@ if __name__ == "__main__":
     DIR_BASE = "/mnt/c/Users/Paulo Pires/Desktop/Alzheimer_cnn/OASIS-1"
     DIR_RAW = f"{DIR_BASE}/OASIS_RAW"
     DIR_OUTPUT = f"{DIR_BASE}/{os.path.basename(DIR_RAW)}_PROCESSED"
+    DIR_TRANSFORMS = f"{DIR_BASE}/TRANSFORM_CACHE" # transformações compostas do registro, reaproveitadas entre execuções
+    DIR_WORK = f"{DIR_BASE}/WORK" # manifestos e artefatos intermediários de cada estágio
+    PROFILE_PATH = f"{DIR_WORK}/resource_profile.json" # picos de memória medidos por estágio, usados pra dimensionar os workers
+    STAGE_LOG = f"{DIR_WORK}/stage_log" # tempo, CPU e pico de RSS de cada estágio de cada imagem (resumo: python stage_profiler.py <pasta>)
     os.makedirs(DIR_OUTPUT, exist_ok=True)
     DIR_MASK = "pre_processing/mni_icbm152_nlin_asym_09c_nifti/mni_icbm152_nlin_asym_09c"
     
@@ -124,6 +111,17 @@ if __name__ == "__main__":
     template = ants.image_read(template_path) 
     mask = ants.image_read(mask_path) 
 
+    # Caixa do cérebro calculada uma vez pela máscara do template (vale pra qualquer template com máscara, não só o MNI 2009c)
+    box = brain_box(mask.numpy(), margin=CROP_MARGIN)
+    crop = crop_info(box, template.shape, 'template', CROP_MARGIN)
+    reference, mask = crop_image(template, box), crop_image(mask, box)
+    logger.info(f"Caixa do cérebro: {crop['box']} ({reference.shape} de {template.shape} voxels)")
+
+    # Enviados uma vez pra cada worker (junto com os hashes, pra não recalcular a cada imagem)
+    shared_objects = {'template': template, 'reference': reference, 'mask': mask, 'crop': crop,
+                      'template_hash': hash_image(template), 'reference_hash': hash_image(reference),
+                      'mask_hash': hash_image(mask)}
+
     start_time = datetime.now()
     logger.info(f"INICIO DO PROCESSAMENTO")
 
@@ -131,25 +129,27 @@ if __name__ == "__main__":
 
         input_path = os.path.join(DIR_RAW, name)
         output_path = os.path.join(DIR_OUTPUT, name)
+        work_path = os.path.join(DIR_WORK, name)
         os.makedirs(output_path, exist_ok=True)
 
         # Caminhos das imagens
-        already_processed = [file for file in os.listdir(output_path)] #checa o diretório de saída pra ver se alguma imagem já foi processada
-        image_paths = [os.path.join(input_path, file) for file in os.listdir(input_path) if file not in already_processed] #carrega o endereço das imagens não processadas
+        # Uma imagem só conta como processada se a saída bate com o checksum e os parâmetros do manifesto
+        image_paths = [os.path.join(input_path, file) for file in os.listdir(input_path)
+                       if not is_complete(work_path, file, os.path.join(output_path, file), PIPELINE_PARAMS)] #carrega o endereço das imagens não processadas
 
-        # Função parcial para passar parâmetros fixos
-        process_func = partial(process_and_save_image, template=template, mask=mask, output_dir=output_path, orient='IRA')
+        # Função parcial para passar parâmetros fixos (só caminhos; template e máscara vão pelo initializer)
+        process_func = partial(process_and_save_image, output_dir=output_path, orient=ORIENTATION, work_dir=work_path, cache_dir=DIR_TRANSFORMS)
 
-        # Processamento e salvamento de cada imagem usando ProcessPoolExecutor
-        with ProcessPoolExecutor(max_workers=16) as executor: #max_workers define o número máximo de processos paralelos
-            # dependendo do pc, é melhor fazer um por vez, pois paralelizar pode deixar cada processo mais demorado sem hardware que aguente
-            futures = [executor.submit(process_func, img_path) for img_path in image_paths]
-            
-            for future in as_completed(futures):
-                future.result()  # Pega o resultado para garantir que exceções sejam lançadas
+        # Processamento e salvamento de cada imagem
+        # Número de processos e threads por processo definidos pelos núcleos e pelo pico de memória medido,
+        # com a leitura da próxima imagem adiantada enquanto a atual é registrada
+        run_parallel(process_func, image_paths, shared_objects=shared_objects,
+                     reader=partial(ants.image_read, reorient=ORIENTATION), profile_path=PROFILE_PATH,
+                     stage_log=STAGE_LOG)
 
 
     # Fim do processamento
     end_time = datetime.now()
     logger.info(f"FIM DO PROCESSAMENTO")
-    logger.info(f"Duração total: {end_time - start_time}")
\ No newline at end of file
+    logger.info(f"Duração total: {end_time - start_time}")
+    print_summary(summarize(read_records(STAGE_LOG)))
\ No newline at end of file
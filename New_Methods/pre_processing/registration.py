@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import ants
+from stage_profiler import stage
+
+logger = logging.getLogger()
+
+# Sequência de registros usada no pré-processamento (cada estágio parte do anterior)
+DEFAULT_STAGES = ('Translation', 'Rigid', 'Affine', 'SyN')
+
+# Nome do arquivo que guarda a ordem das transformações dentro de cada entrada do cache
+TRANSFORMS_INDEX = 'transforms.json'
+
+# FUNÇÕES
+# Hash do conteúdo de um arquivo (lido em blocos pra não carregar o volume inteiro)
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Hash de uma imagem ANTs já carregada (voxels + geometria)
+def hash_image(image):
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(image.numpy()).tobytes())
+    digest.update(repr((image.shape, image.spacing, image.origin, image.direction.tolist())).encode())
+    return digest.hexdigest()
+
+# Chave do cache: hash da entrada + hash do template + estágios + parâmetros do registro
+def transform_key(moving_hash, template_hash, stages, params=None):
+    payload = json.dumps({
+        "moving": moving_hash,
+        "template": template_hash,
+        "stages": list(stages),
+        "params": params or {},
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class TransformCache:
+    """
+    Cache em disco das transformações compostas do registro.
+    Cada entrada é uma pasta <cache_dir>/<chave>/ com os arquivos de transformação
+    e um transforms.json com a ordem em que devem ser aplicados.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        index_path = os.path.join(self._entry_dir(key), TRANSFORMS_INDEX)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path) as f:
+            names = json.load(f)
+        transforms = [os.path.join(self._entry_dir(key), name) for name in names]
+        if not all(os.path.exists(path) for path in transforms):
+            return None
+        return transforms
+
+    def put(self, key, transforms):
+        # Escreve numa pasta temporária e renomeia no fim, pra nunca deixar uma entrada pela metade
+        final_dir = self._entry_dir(key)
+        tmp_dir = f"{final_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        names = []
+        for idx, path in enumerate(transforms):
+            name = f"{idx:02d}_{os.path.basename(path)}"
+            shutil.copyfile(path, os.path.join(tmp_dir, name))
+            names.append(name)
+        with open(os.path.join(tmp_dir, TRANSFORMS_INDEX), 'w') as f:
+            json.dump(names, f)
+
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            # Outro processo já gravou a mesma chave, mantém a entrada existente
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return self.get(key)
+
+
+class RegistrationEngine:
+    """
+    Registro em cascata (ex: Translation -> Rigid -> Affine -> SyN).
+    A transformação de cada estágio entra como initial_transform do próximo, então
+    a imagem em movimento é reamostrada uma única vez no final. As transformações
+    compostas ficam no TransformCache, e uma nova execução com a mesma entrada,
+    template e parâmetros pula o registro por completo.
+
+    Com reference (ex: o template cortado pela caixa do cérebro, brain_crop.crop_image), o registro continua
+    sendo calculado no template inteiro, mas a imagem é reamostrada direto no grid cortado.
+    """
+    def __init__(self, template, cache_dir=None, stages=DEFAULT_STAGES, template_hash=None, reference=None, **registration_kwargs):
+        self.template = template
+        self.reference = template if reference is None else reference
+        self.stages = tuple(stages)
+        self.registration_kwargs = registration_kwargs
+        self.template_hash = template_hash or hash_image(template)
+        self.cache = TransformCache(cache_dir) if cache_dir else None
+
+    def key(self, moving_hash, **extra_params):
+        params = dict(self.registration_kwargs, **extra_params)
+        return transform_key(moving_hash, self.template_hash, self.stages, params)
+
+    def compute_transforms(self, image):
+        transforms = None
+        for type_of_transform in self.stages:
+            with stage(f"registration_{type_of_transform}"):
+                registration = ants.registration(
+                    fixed=self.template,
+                    moving=image,
+                    type_of_transform=type_of_transform,
+                    initial_transform=transforms,
+                    **self.registration_kwargs
+                )
+            # O antsRegistration colapsa a transformação inicial na saída,
+            # então a lista do último estágio já é a composição de todos
+            transforms = registration['fwdtransforms']
+        return transforms
+
+    def get_transforms(self, image, moving_hash=None, **extra_params):
+        """
+        Retorna a lista de transformações (ordem do ants.apply_transforms) que leva
+        a imagem para o espaço do template, usando o cache quando possível.
+        """
+        if self.cache is None:
+            return self.compute_transforms(image)
+
+        moving_hash = moving_hash or hash_image(image)
+        key = self.key(moving_hash, **extra_params)
+        transforms = self.cache.get(key)
+        if transforms is not None:
+            logger.info(f"Transformações reaproveitadas do cache: {key[:12]}")
+            return transforms
+
+        transforms = self.compute_transforms(image)
+        return self.cache.put(key, transforms)
+
+    def apply(self, image, transforms, interpolator='linear'):
+        with stage('registration_apply'):
+            return ants.apply_transforms(fixed=self.reference, moving=image, transformlist=transforms, interpolator=interpolator)
+
+    def register(self, image, moving_hash=None, interpolator='linear', **extra_params):
+        """
+        Registra a imagem no template e reamostra uma única vez.
+        :param image: Imagem ANTs a ser registrada.
+        :param moving_hash: Hash do arquivo de origem (se None, usa o hash dos voxels).
+        :param extra_params: Parâmetros que mudam a entrada (ex: orientação na leitura) e entram na chave.
+        :return: Tupla (imagem registrada, lista de transformações).
+        """
+        transforms = self.get_transforms(image, moving_hash=moving_hash, **extra_params)
+        return self.apply(image, transforms, interpolator=interpolator), transforms
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import logging
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import stage_profiler
+from system_info import available_cores
+
+try:
+    import psutil
+except ImportError:  # opcional: sem psutil a memória livre vem do /proc/meminfo
+    psutil = None
+
+logger = logging.getLogger()
+
+# Pico de memória assumido por worker enquanto ainda não existe perfil medido (o brain_extraction carrega a rede do TensorFlow)
+DEFAULT_PEAK_RSS = 4 << 30
+
+# Fração da memória disponível que os workers podem ocupar (o resto fica de folga pro sistema)
+MEMORY_FRACTION = 0.85
+
+# Variáveis lidas pelo ITK/ANTs, OpenMP/BLAS e TensorFlow na criação dos pools de threads
+THREAD_ENV_VARS = (
+    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'TF_NUM_INTRAOP_THREADS',
+)
+
+ResourcePlan = namedtuple('ResourcePlan', ['workers', 'threads'])
+
+# Objetos compartilhados do worker (template, máscara...), definidos uma vez no initializer
+_SHARED = {}
+
+# Pico de RSS do processo ao fim de cada estágio (preenchido por note_stage)
+_STAGE_PEAKS = {}
+
+
+# FUNÇÕES
+# Memória disponível em bytes (None se não der pra descobrir)
+def available_memory():
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# Pico de memória residente do processo atual em bytes (None se o SO não informar, ver stage_profiler)
+def current_peak_rss():
+    return stage_profiler.process_peak_rss()
+
+# Registra o pico do processo ao fim de um estágio (o ru_maxrss é acumulado, então é um limite superior)
+# Sem pico disponível no SO o perfil não é atualizado e os workers seguem dimensionados pelo default_peak_rss
+def note_stage(name):
+    peak = current_peak_rss()
+    if peak is not None:
+        _STAGE_PEAKS[name] = max(_STAGE_PEAKS.get(name, 0), peak)
+
+
+class ResourceProfile:
+    """
+    Perfil em disco com o maior pico de RSS medido em cada estágio do pipeline.
+    É atualizado ao fim de cada execução e usado na próxima pra dimensionar os workers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.peaks = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Perfil de recursos corrompido, ignorando: {self.path}")
+            return {}
+
+    def peak(self, default=DEFAULT_PEAK_RSS):
+        return max(self.peaks.values()) if self.peaks else default
+
+    def update(self, peaks):
+        for name, value in peaks.items():
+            self.peaks[name] = max(self.peaks.get(name, 0), value)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp, 'w') as f:
+            json.dump(self.peaks, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def plan_resources(n_tasks, peak_rss=DEFAULT_PEAK_RSS, max_workers=None, cores=None, memory=None):
+    """
+    Define quantos processos rodar e quantas threads cada um pode usar.
+    O número de workers é limitado pelos núcleos, pela memória (pico medido por worker)
+    e pela quantidade de tarefas; os núcleos que sobram viram threads de cada worker,
+    assim processos x threads nunca passa do número de núcleos.
+    :param n_tasks: Número de imagens a processar.
+    :param peak_rss: Pico de memória esperado por worker, em bytes.
+    :param max_workers: Limite opcional de processos.
+    :return: ResourcePlan(workers, threads).
+    """
+    cores = cores or available_cores()
+    memory = memory if memory is not None else available_memory()
+
+    workers = min(cores, max(n_tasks, 1))
+    if memory is not None and peak_rss:
+        workers = min(workers, max(1, int(memory * MEMORY_FRACTION // peak_rss)))
+    if max_workers:
+        workers = min(workers, max_workers)
+    workers = max(1, workers)
+    return ResourcePlan(workers=workers, threads=max(1, cores // workers))
+
+# Limita as threads do ITK/ANTs, OpenMP e TensorFlow no processo atual (e nos filhos criados depois)
+def limit_threads(threads):
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+
+    # Se o TensorFlow já foi importado (ex: pelo antspynet), configura direto antes do runtime iniciar
+    if 'tensorflow' in sys.modules:
+        tf = sys.modules['tensorflow']
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError:
+            logger.warning("TensorFlow já inicializado, mantendo a configuração de threads atual")
+
+# Initializer dos workers: limita as threads, guarda os objetos compartilhados uma vez por processo
+# e liga a instrumentação por estágio (um stages-<host>-<pid>.jsonl por worker em stage_log)
+def init_worker(threads, shared_objects, stage_log=None):
+    limit_threads(threads)
+    _SHARED.update(shared_objects or {})
+    stage_profiler.configure(stage_log, threads=threads)
+
+# Objeto compartilhado do worker (ex: shared('template'))
+def shared(name):
+    return _SHARED[name]
+
+
+class _Prefetcher:
+    """
+    Leitura antecipada preguiçosa de um bloco: a imagem i só é lida quando o loader dela é chamado (os estágios
+    reaproveitados do manifesto não chamam), e aí a i+1 já começa a ser lida em segundo plano. Fica no máximo uma
+    imagem adiantada em memória, além da que está sendo usada, e as adiantadas que não foram pedidas são descartadas.
+    """
+    def __init__(self, reader, items, executor):
+        self.reader = reader
+        self.items = items
+        self.executor = executor
+        self.futures = {}
+
+    def _submit(self, idx):
+        if idx < len(self.items) and idx not in self.futures:
+            self.futures[idx] = self.executor.submit(self.reader, self.items[idx])
+
+    def load(self, idx):
+        self._submit(idx)
+        self._submit(idx + 1)
+        future = self.futures.pop(idx)
+        for stale in [key for key in self.futures if key < idx]:
+            self.futures.pop(stale).cancel()
+        return future.result()
+
+    def loader(self, idx):
+        return lambda: self.load(idx)
+
+# Executa um bloco de imagens no worker, lendo a próxima numa thread enquanto a atual é processada
+# (com batched=True a função recebe o bloco inteiro e cada imagem só é lida quando pedida, com a seguinte adiantada)
+def _run_chunk(func, reader, items, batched=False):
+    _STAGE_PEAKS.clear()
+    results = []
+    if reader is None:
+        results = func(items) if batched else [func(item) for item in items]
+    elif batched:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            prefetch = _Prefetcher(reader, items, executor)
+            results = func(items, [prefetch.loader(idx) for idx in range(len(items))])
+    else:
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            pending = prefetch.submit(reader, items[0])
+            for idx, item in enumerate(items):
+                current = pending
+                if idx + 1 < len(items):
+                    pending = prefetch.submit(reader, items[idx + 1])
+                results.append(func(item, current.result))
+    return results, dict(_STAGE_PEAKS)
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def run_parallel(func, items, shared_objects=None, reader=None, profile_path=None,
+                 default_peak_rss=DEFAULT_PEAK_RSS, max_workers=None, chunks_per_worker=4,
+                 chunk_size=None, batched=False, stage_log=None):
+    """
+    Processa as imagens num ProcessPoolExecutor dimensionado pelos recursos da máquina.
+    :param func: Função de nível de módulo chamada como func(item) ou, com reader, func(item, loader),
+                 onde loader() devolve a imagem já lida em segundo plano.
+    :param items: Lista de caminhos das imagens.
+    :param shared_objects: Dict com objetos enviados uma vez por worker (ex: template e máscara),
+                           acessados dentro do worker com shared(nome).
+    :param reader: Função que lê uma imagem (ex: ants.image_read); habilita a leitura antecipada.
+    :param profile_path: JSON com os picos de RSS medidos por estágio (lido antes e atualizado depois).
+    :param default_peak_rss: Pico por worker assumido enquanto não houver perfil.
+    :param max_workers: Limite opcional de processos.
+    :param chunks_per_worker: Blocos por worker (mais blocos equilibram melhor, menos blocos aproveitam mais a leitura antecipada).
+    :param chunk_size: Tamanho fixo dos blocos (ex: o tamanho do lote da inferência); se None, usa chunks_per_worker.
+    :param batched: Se True, func recebe o bloco inteiro: func(items) ou func(items, loaders), e devolve uma lista.
+    :param stage_log: Pasta dos registros por estágio (tempo, CPU e pico de RSS de cada imagem, ver stage_profiler).
+    :return: Lista com os resultados de func, na ordem em que os blocos terminaram.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    profile = ResourceProfile(profile_path)
+    plan = plan_resources(len(items), profile.peak(default_peak_rss), max_workers=max_workers)
+    logger.info(f"Workers: {plan.workers} | Threads por worker: {plan.threads} | "
+                f"Pico estimado por worker: {profile.peak(default_peak_rss) / (1 << 30):.1f} GB")
+
+    # As variáveis de ambiente são herdadas pelos workers antes de importarem o ITK/TensorFlow
+    limit_threads(plan.threads)
+
+    chunk_size = chunk_size or max(1, math.ceil(len(items) / (plan.workers * chunks_per_worker)))
+    results = []
+    # spawn: cada worker começa limpo (o TensorFlow não suporta fork depois de inicializado)
+    with ProcessPoolExecutor(max_workers=plan.workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(plan.threads, shared_objects, stage_log)) as executor:
+        futures = [executor.submit(_run_chunk, func, reader, chunk, batched) for chunk in _chunks(items, chunk_size)]
+        try:
+            for future in as_completed(futures):
+                chunk_results, peaks = future.result()  # Pega o resultado para garantir que exceções sejam lançadas
+                results.extend(chunk_results)
+                profile.update(peaks)
+        finally:
+            profile.save()
+    return results
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Instrumentação por estágio do pré-processamento: tempo de parede, tempo de CPU e pico de RSS
+de cada estágio de cada imagem, gravados em JSON lines (um arquivo por worker).
+
+Nos workers do run_parallel basta passar stage_log=<pasta>; fora dele, chamar configure(<pasta>).
+Resumo dos registros (percentis por estágio e imagens mais lentas):
+
+    python stage_profiler.py <pasta> [--percentiles 50 90 99] [--factor 2] [--top 10]
+"""
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+import numpy as np
+
+# Fontes do pico de RSS, todas opcionais: sem nenhuma o profiler continua medindo tempo e só deixa o pico vazio
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# /proc/self/status e /proc/self/clear_refs só existem no Linux
+_LINUX = sys.platform.startswith('linux')
+
+# Percentis do resumo e quantas vezes a mediana do estágio uma imagem precisa levar pra ser um straggler
+DEFAULT_PERCENTILES = (50, 90, 99)
+STRAGGLER_FACTOR = 2.0
+# Estágios mais curtos que isso não entram como straggler (ruído de estágios de milissegundos)
+STRAGGLER_MIN_SECONDS = 1.0
+
+LOG_PATTERN = 'stages-*.jsonl'
+
+# Configuração do processo (preenchida por configure) e pilha de estágios abertos por thread
+_CONFIG = {'path': None, 'threads': None, 'peak_scope': None}
+_LOCAL = threading.local()
+_WRITE_LOCK = threading.Lock()
+
+
+# FUNÇÕES
+def _read_hwm():
+    """Pico de RSS (VmHWM) do processo em bytes, ou None fora do Linux."""
+    if not _LINUX:
+        return None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_hwm():
+    """Zera o pico de RSS do processo (Linux >= 4.0); devolve False se o SO não permitir."""
+    if not _LINUX:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def process_peak_rss():
+    """
+    Pico de memória residente do processo em bytes, ou None se o SO não informar.
+    ru_maxrss vem em KB no Linux e em bytes no macOS; no Windows (sem o módulo resource) usa o peak_wset do psutil.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', None) or info.rss
+    return None
+
+def _peak():
+    return (_read_hwm() if _CONFIG['peak_scope'] == 'stage' else None) or process_peak_rss() or 0
+
+def _peak_scope():
+    if _read_hwm() is not None and _reset_hwm():
+        return 'stage'
+    return 'process' if process_peak_rss() is not None else None
+
+def configure(log_dir, threads=None):
+    """
+    Liga a instrumentação no processo atual (log_dir=None desliga).
+    O pico de RSS é por estágio quando o kernel permite zerar o VmHWM; senão fica o pico acumulado
+    do processo (campo peak_scope dos registros: 'stage' ou 'process'); sem nenhuma fonte de RSS no SO
+    o pico fica None e peak_scope também.
+    Com o VmHWM zerado a cada estágio, o ru_maxrss lido pelo note_stage também passa a ser o pico do estágio.
+    :param threads: Threads do ITK/OpenMP do worker (se None, lidas do ambiente).
+    """
+    if not log_dir:
+        _CONFIG.update(path=None, threads=None, peak_scope=None)
+        return
+    os.makedirs(log_dir, exist_ok=True)
+    if threads is None:
+        threads = int(os.environ.get('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 0)) or None
+    _CONFIG.update(path=os.path.join(log_dir, f"stages-{socket.gethostname()}-{os.getpid()}.jsonl"),
+                   threads=threads, peak_scope=_peak_scope())
+
+def enabled():
+    return _CONFIG['path'] is not None
+
+def _stack():
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+def _write(record):
+    line = json.dumps(record, default=str) + '\n'
+    with _WRITE_LOCK, open(_CONFIG['path'], 'a') as f:
+        f.write(line)
+
+@contextmanager
+def stage(name, image=None, **extra):
+    """
+    Mede um estágio: with stage('n4', image=img_id): ...
+    Estágios podem ser aninhados (ex: cada registro dentro de 'registered'); o interno herda a imagem
+    e registra o externo em 'parent'. Sem configure() não mede nada.
+    :param extra: Campos extras do registro (ex: batch=4 na extração do cérebro em lote).
+    """
+    if not enabled():
+        yield
+        return
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    if image is None and parent is not None:
+        image = parent['image']
+    if _CONFIG['peak_scope'] == 'stage':
+        # Guarda o pico do estágio externo até aqui antes de zerar o contador pro interno
+        if parent is not None:
+            parent['peak'] = max(parent['peak'], _peak())
+        _reset_hwm()
+    frame = {'name': name, 'image': image, 'peak': 0}
+    stack.append(frame)
+    error = None
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        stack.pop()
+        peak = max(frame['peak'], _peak())
+        if parent is not None:
+            parent['peak'] = max(parent['peak'], peak)
+        record = {
+            'time': datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'worker': os.getpid(),
+            'threads': _CONFIG['threads'],
+            'image': image,
+            'stage': name,
+            'parent': parent['name'] if parent else None,
+            'wall_s': round(wall, 6),
+            # tempo de CPU do processo inteiro (todas as threads do ITK, e a leitura antecipada se estiver rodando)
+            'cpu_s': round(cpu, 6),
+            'peak_rss_mb': round(peak / (1 << 20), 1) if _CONFIG['peak_scope'] else None,
+            'peak_scope': _CONFIG['peak_scope'],
+        }
+        if error:
+            record['error'] = error
+        record.update(extra)
+        _write(record)
+
+def read_records(paths):
+    """Lê os registros de arquivos .jsonl ou de pastas com os logs dos workers."""
+    files = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        files.extend(sorted(glob.glob(os.path.join(path, LOG_PATTERN))) if os.path.isdir(path) else [path])
+    records = []
+    for file in files:
+        with open(file) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+def summarize(records, percentiles=DEFAULT_PERCENTILES, straggler_factor=STRAGGLER_FACTOR,
+              min_seconds=STRAGGLER_MIN_SECONDS):
+    """
+    Resumo por estágio e imagens lentas.
+    :return: Dict com 'stages' ({estágio: contagem, percentis de parede/CPU/pico e fração do tempo total}),
+             'stragglers' (imagem/estágio acima de straggler_factor x a mediana do estágio e de min_seconds,
+             mais lentos primeiro)
+             e 'images' (tempo total por imagem, somando só os estágios de nível mais alto).
+    """
+    by_stage = {}
+    for record in records:
+        by_stage.setdefault(record['stage'], []).append(record)
+    top_level_total = sum(record['wall_s'] for record in records if record.get('parent') is None) or 1.0
+
+    stages = {}
+    for name, items in by_stage.items():
+        wall = np.array([record['wall_s'] for record in items])
+        cpu = np.array([record['cpu_s'] for record in items])
+        # Registros sem pico (SO sem fonte de RSS) ficam de fora dos percentis de memória
+        peak = np.array([record['peak_rss_mb'] for record in items if record.get('peak_rss_mb') is not None] or [np.nan])
+        stages[name] = {
+            'count': len(items),
+            'parent': items[0].get('parent'),
+            'total_s': float(wall.sum()),
+            'fraction': float(wall.sum() / top_level_total),
+            'wall_s': {p: float(v) for p, v in zip(percentiles, np.percentile(wall, percentiles))},
+            'cpu_s': {p: float(v) for p, v in zip(percentiles, np.percentile(cpu, percentiles))},
+            'peak_rss_mb': {p: float(v) for p, v in zip(percentiles, np.percentile(peak, percentiles))},
+            # CPU/parede perto de 1 = uma thread ocupada; perto do número de threads = paralelismo aproveitado
+            'cpu_per_wall': float(cpu.sum() / wall.sum()) if wall.sum() else 0.0,
+            'errors': sum(1 for record in items if 'error' in record),
+        }
+
+    stragglers = []
+    for name, items in by_stage.items():
+        median = float(np.median([record['wall_s'] for record in items]))
+        for record in items:
+            if record.get('image') is not None and record['wall_s'] >= min_seconds and \
+                    record['wall_s'] > straggler_factor * median:
+                stragglers.append({'image': record['image'], 'stage': name, 'wall_s': record['wall_s'],
+                                   'median_s': median, 'ratio': record['wall_s'] / median, 'worker': record['worker']})
+    stragglers.sort(key=lambda item: item['ratio'], reverse=True)
+
+    images = {}
+    for record in records:
+        if record.get('parent') is None and record.get('image') is not None:
+            images[record['image']] = images.get(record['image'], 0.0) + record['wall_s']
+    return {'stages': stages, 'stragglers': stragglers,
+            'images': dict(sorted(images.items(), key=lambda item: item[1], reverse=True))}
+
+def print_summary(summary, top=10, straggler_factor=STRAGGLER_FACTOR):
+    stages = summary['stages']
+    if not stages:
+        print("Nenhum registro encontrado.")
+        return
+    percentiles = list(next(iter(stages.values()))['wall_s'])
+    header = ''.join(f"{'p' + str(p) + ' (s)':>11}" for p in percentiles)
+    print(f"{'estágio':<28}{'n':>6}{'total (s)':>11}{'%':>7}{header}{'CPU/parede':>12}{'pico p' + str(percentiles[-1]) + ' (MB)':>16}")
+    # Estágios de nível mais alto por tempo total, cada um seguido dos seus subestágios
+    ordered = sorted(stages, key=lambda name: (stages[name]['parent'] is not None, -stages[name]['total_s']))
+    for name in [name for name in ordered if stages[name]['parent'] is None] + \
+                [name for name in ordered if stages[name]['parent'] is not None]:
+        info = stages[name]
+        label = name if info['parent'] is None else f"  {info['parent']}/{name}"
+        row = ''.join(f"{info['wall_s'][p]:>11.2f}" for p in percentiles)
+        errors = f"  ({info['errors']} erros)" if info['errors'] else ''
+        print(f"{label:<28}{info['count']:>6}{info['total_s']:>11.1f}{100 * info['fraction']:>6.1f}%{row}"
+              f"{info['cpu_per_wall']:>12.2f}{info['peak_rss_mb'][percentiles[-1]]:>16.0f}{errors}")
+
+    if summary['stragglers']:
+        print(f"\nStragglers (mais de {straggler_factor:g}x a mediana do estágio):")
+        for item in summary['stragglers'][:top]:
+            print(f"  {item['image']} | {item['stage']}: {item['wall_s']:.1f} s ({item['ratio']:.1f}x a mediana de "
+                  f"{item['median_s']:.1f} s, worker {item['worker']})")
+    if summary['images']:
+        print("\nImagens mais lentas (tempo total):")
+        for image, total in list(summary['images'].items())[:top]:
+            print(f"  {image}: {total:.1f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumo da instrumentação por estágio do pré-processamento.")
+    parser.add_argument("paths", nargs='+', help="Pastas com os stages-*.jsonl ou arquivos .jsonl.")
+    parser.add_argument("--percentiles", type=float, nargs='+', default=list(DEFAULT_PERCENTILES))
+    parser.add_argument("--factor", type=float, default=STRAGGLER_FACTOR, help="Limiar de straggler (x a mediana).")
+    parser.add_argument("--min-seconds", type=float, default=STRAGGLER_MIN_SECONDS,
+                        help="Duração mínima pra um estágio contar como straggler.")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Imprime o resumo em JSON.")
+    args = parser.parse_args()
+
+    percentiles = [int(p) if float(p).is_integer() else p for p in args.percentiles]
+    summary = summarize(read_records(args.paths), percentiles, args.factor, args.min_seconds)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        print_summary(summary, args.top, args.factor)
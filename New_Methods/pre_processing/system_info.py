@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+import os
+
+# Consultas ao sistema sem dependências além da biblioteca padrão (usadas pelo scheduler e pelo dicom_to_nii,
+# que não precisa do scheduler nem do stage_profiler só pra saber quantos processos abrir)
+
+
+# FUNÇÕES
+# Núcleos que o processo pode usar (respeita taskset/cgroups quando o SO informa)
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
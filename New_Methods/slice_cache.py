@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import zoom
+
+# Arquivos do cache: shards TFRecord + índice JSON
+INDEX_NAME = 'index.json'
+SHARD_PATTERN = 'shard-{:05d}.tfrecord'
+
+# Fatias por shard (~1000 fatias 233x197 em float16 dão ~90 MB por arquivo)
+DEFAULT_SHARD_SIZE = 1024
+
+# Mesma normalização do load_and_preprocess_image: imagem / (máximo + 1e-6)
+NORM_EPS = 1e-6
+
+
+# FUNÇÕES
+def _source_key(file_list, shape):
+    """Chave do cache: caminhos, tamanhos e mtimes das fatias + shape alvo."""
+    digest = hashlib.sha256(json.dumps(list(shape)).encode())
+    for item in file_list:
+        stat = os.stat(item["image"])
+        digest.update(f"{item['image']}|{stat.st_size}|{stat.st_mtime_ns}|{item['label']}\n".encode())
+    return digest.hexdigest()
+
+def _read_slice(path, shape):
+    """Lê a fatia NIfTI, garante 2D no shape alvo e normaliza pelo máximo. Retorna (fatia float16, máximo)."""
+    image = np.squeeze(nib.load(path).get_fdata(dtype=np.float32))
+    if image.ndim != 2:
+        raise ValueError(f"Imagem não é 2D após squeeze: {path} com shape {image.shape}")
+    if image.shape != tuple(shape):
+        image = zoom(image, [shape[0] / image.shape[0], shape[1] / image.shape[1]], order=1, mode='nearest')
+    max_value = float(image.max())
+    image /= max_value + NORM_EPS
+    return image.astype(np.float16), max_value
+
+def _serialize(image, label):
+    import tensorflow as tf
+    feature = {
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+def load_index(cache_dir):
+    path = os.path.join(cache_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f"Aviso: índice corrompido em {cache_dir}, o cache será refeito.")
+        return None
+
+def build_slice_cache(file_list, cache_dir, shape=(233, 197), shard_size=DEFAULT_SHARD_SIZE, workers=None):
+    """
+    Converte a lista de fatias do load_data (image, label, paciente) em shards TFRecord com as
+    fatias já normalizadas em float16, e grava um índice com a posição de cada fatia e o máximo
+    original (estatística da normalização). Se o índice já existe com a mesma chave
+    (mesmos arquivos, mtimes, labels e shape), nada é relido.
+    :param file_list: Lista de dicts do load_data.
+    :param cache_dir: Pasta do cache (um por conjunto: treino, validação, teste).
+    :param shape: (altura, largura) das fatias no cache.
+    :param shard_size: Fatias por shard.
+    :param workers: Threads de leitura dos NIfTI (a descompressão libera o GIL).
+    :return: Índice do cache.
+    """
+    import tensorflow as tf
+
+    key = _source_key(file_list, shape)
+    index = load_index(cache_dir)
+    if index is not None and index["key"] == key:
+        return index
+
+    os.makedirs(cache_dir, exist_ok=True)
+    shards, entries = [], []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for start in range(0, len(file_list), shard_size):
+            items = file_list[start:start + shard_size]
+            shard_name = SHARD_PATTERN.format(len(shards))
+            tmp_path = os.path.join(cache_dir, f".tmp-{os.getpid()}-{shard_name}")
+            # map mantém a ordem, então a posição no shard é a posição na lista
+            with tf.io.TFRecordWriter(tmp_path) as writer:
+                for position, (item, (image, max_value)) in enumerate(
+                        zip(items, executor.map(lambda item: _read_slice(item["image"], shape), items))):
+                    writer.write(_serialize(image, item["label"]))
+                    entries.append({"image": item["image"], "label": int(item["label"]), "paciente": item["paciente"],
+                                    "shard": len(shards), "position": position, "max": max_value})
+            os.replace(tmp_path, os.path.join(cache_dir, shard_name))
+            shards.append({"file": shard_name, "count": len(items)})
+
+    index = {"key": key, "shape": list(shape), "dtype": "float16", "normalization": "max",
+             "shards": shards, "entries": entries}
+    tmp_index = os.path.join(cache_dir, f".tmp-{os.getpid()}-{INDEX_NAME}")
+    with open(tmp_index, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_index, os.path.join(cache_dir, INDEX_NAME))
+    print(f"Cache de fatias em {cache_dir}: {len(entries)} fatias em {len(shards)} shards.")
+    return index
+
+def slice_dataset(cache_dir, batch_size=16, shuffle=False, seed=42, cache=None, shuffle_buffer=None):
+    """
+    Dataset tf.data lendo o cache direto em TF (sem py_function): shards intercalados em paralelo,
+    decode_raw do float16 e shape estático (altura, largura, 1).
+    :param cache_dir: Pasta criada pelo build_slice_cache.
+    :param shuffle: Embaralha os shards e as fatias, de forma determinística pela seed
+                    (a ordem muda a cada época, mas é a mesma entre execuções).
+    :param cache: None, 'memory' (mantém as fatias decodificadas na RAM após a primeira época)
+                  ou um caminho para snapshot em disco.
+    :param shuffle_buffer: Fatias no buffer do shuffle; None usa o conjunto inteiro, como o shuffle(len(train_paths))
+                           do pipeline antigo. As fatias vêm do índice na ordem de paciente/fatia (e com cache a ordem
+                           dos shards fica congelada), então um buffer menor monta cada lote com poucos pacientes vizinhos.
+    :return: tf.data.Dataset de (imagem, label) em lotes.
+    """
+    import tensorflow as tf
+
+    index = load_index(cache_dir)
+    if index is None:
+        raise FileNotFoundError(f"Cache de fatias não encontrado em {cache_dir}; rode build_slice_cache antes.")
+    height, width = index["shape"]
+    files = [os.path.join(cache_dir, shard["file"]) for shard in index["shards"]]
+
+    description = {
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, description)
+        image = tf.io.decode_raw(example["image"], tf.float16)
+        image = tf.cast(tf.reshape(image, [height, width, 1]), tf.float32)
+        return image, tf.cast(example["label"], tf.int32)
+
+    # Sem shuffle os shards são lidos em sequência, então a ordem é a do índice (cached_labels)
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    cycle_length = 1
+    if shuffle and not cache:  # com cache a ordem dos shards fica congelada na primeira época; embaralha só depois
+        dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+        cycle_length = max(1, min(len(files), 4))
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=cycle_length,
+                                 num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+    if cache == 'memory':
+        dataset = dataset.cache()
+    elif cache:
+        dataset = dataset.snapshot(cache)
+
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer or len(index["entries"]), seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def cached_labels(cache_dir):
+    """Labels na ordem do dataset sem shuffle (para o classification_report)."""
+    return [entry["label"] for entry in load_index(cache_dir)["entries"]]
@@ -0,0 +1,199 @@
+import os
+import time
+import json
+import numpy as np
+import tensorflow as tf
+
+try:
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:  # opcional: nas versões mais antigas o interpretador só existe dentro do TensorFlow
+    Interpreter = tf.lite.Interpreter
+
+# Modos de exportação:
+#   float32 -> sem quantização (referência do próprio runtime do TFLite)
+#   float16 -> pesos em float16 (metade do tamanho, mesma conta em float32 na CPU)
+#   dynamic -> pesos em int8 e ativações quantizadas em tempo de execução (sem calibração)
+#   int8    -> pesos e ativações em int8, com as faixas calibradas num conjunto representativo
+QUANTIZATION_MODES = ('float32', 'float16', 'dynamic', 'int8')
+
+# Amostras usadas na calibração do int8 (fatias/recortes representativos do treino)
+DEFAULT_CALIBRATION_SAMPLES = 200
+
+
+# FUNÇÕES
+def _as_inputs(inputs):
+    """Entradas como lista de arrays float32 (o modelo siamês recebe [esquerda, direita])."""
+    if isinstance(inputs, (list, tuple)):
+        return [np.asarray(x, dtype=np.float32) for x in inputs]
+    return [np.asarray(inputs, dtype=np.float32)]
+
+def representative_dataset(inputs, num_samples=DEFAULT_CALIBRATION_SAMPLES, batch_size=1, seed=42):
+    """
+    Gerador de calibração do int8: amostras sorteadas (sem reposição) do conjunto, em lotes de batch_size.
+    :param inputs: Array (N, ...) ou lista de arrays (um por entrada do modelo).
+    :param batch_size: Lotes maiores que 1 calibram também as faixas que dependem do lote
+                       (ex: máscaras de padding do ViT 2D com poda de tokens).
+    :return: Função sem argumentos que devolve o gerador, como o TFLiteConverter espera.
+    """
+    inputs = _as_inputs(inputs)
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(inputs[0]), size=min(num_samples, len(inputs[0])), replace=False)
+
+    def generator():
+        for start in range(0, len(indices), batch_size):
+            batch = np.sort(indices[start:start + batch_size])
+            yield [x[batch] for x in inputs]
+    return generator
+
+def convert(model, mode='dynamic', calibration=None, num_calibration=DEFAULT_CALIBRATION_SAMPLES, calibration_batch=1,
+            allow_float_fallback=True):
+    """
+    Converte um modelo Keras para TFLite.
+    :param model: Modelo Keras (build_vit_2d_classic, build_vit_3d_classic, build_siamese_model...).
+    :param mode: Um de QUANTIZATION_MODES.
+    :param calibration: Dados de calibração (obrigatório no int8): array ou lista de arrays com as entradas.
+    :param calibration_batch: Tamanho dos lotes de calibração (ver representative_dataset).
+    :param allow_float_fallback: No int8, deixa em float32 as operações sem kernel int8 (ex: partes do softmax/GELU
+                                 do ViT); se False a conversão falha nelas.
+    :return: Bytes do modelo .tflite.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Modo desconhecido: {mode} (use {QUANTIZATION_MODES})")
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if mode == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif mode == 'int8':
+        if calibration is None:
+            raise ValueError("A quantização int8 precisa de um conjunto de calibração (fatias/recortes representativos)")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(calibration, num_calibration, calibration_batch)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if allow_float_fallback:
+            converter.target_spec.supported_ops.append(tf.lite.OpsSet.TFLITE_BUILTINS)
+    return converter.convert()
+
+def export_tflite(model, output_path, mode='dynamic', calibration=None, **kwargs):
+    """Converte e grava o .tflite (escrita atômica). :return: Caminho gravado."""
+    content = convert(model, mode, calibration, **kwargs)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp = os.path.join(os.path.dirname(output_path), f".tmp-{os.getpid()}-{os.path.basename(output_path)}")
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, output_path)
+    # A assinatura do TFLite identifica as entradas só pelo nome; a ordem do Keras ([esquerda, direita]) fica ao lado
+    with open(f"{output_path}.json", 'w') as f:
+        json.dump({"inputs": [tensor.name for tensor in model.inputs], "mode": mode}, f)
+    return output_path
+
+
+class TFLiteModel:
+    """
+    Modelo .tflite com a mesma interface de predição do Keras (predict em lotes, uma ou várias entradas).
+
+    Uso:
+        model = TFLiteModel("vit2d_int8.tflite", num_threads=4)
+        scores = model.predict(slices, batch_size=32)
+        scores = TFLiteModel("siamese_dynamic.tflite").predict([left, right])
+    """
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self.input_names = list(self.runner.get_input_details())
+        # Ordem das entradas do Keras gravada pelo export_tflite (com uma entrada só não faz diferença)
+        if os.path.exists(f"{path}.json"):
+            with open(f"{path}.json") as f:
+                self.input_names = json.load(f)["inputs"]
+        self.output_name = next(iter(self.runner.get_output_details()))
+
+    @property
+    def size_mb(self):
+        return os.path.getsize(self.path) / 2 ** 20
+
+    def predict(self, inputs, batch_size=32):
+        """
+        :param inputs: Array (N, ...) ou lista de arrays (N, ...), como no model.predict do Keras.
+        :return: Array (N, ...) com as saídas em float32.
+        """
+        inputs = _as_inputs(inputs)
+        outputs = []
+        for start in range(0, len(inputs[0]), batch_size):
+            batch = {name: x[start:start + batch_size] for name, x in zip(self.input_names, inputs)}
+            outputs.append(self.runner(**batch)[self.output_name])
+        return np.concatenate(outputs).astype(np.float32)
+
+
+def _time_predict(predict, inputs, batch_size, repeats):
+    """Mediana do tempo de um lote em `repeats` execuções (depois de um aquecimento), em segundos."""
+    single = [x[:batch_size] for x in inputs]
+    predict(single)  # aquecimento (traçado do grafo / alocação dos tensores)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(single)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def compare_models(keras_model, tflite_model, inputs, labels=None, batch_size=32, repeats=5):
+    """
+    Compara o modelo float32 do Keras com o .tflite: latência por lote, vazão, diferença das saídas
+    e drift da AUC/concordância de classe quando há labels.
+    :param inputs: Conjunto de avaliação (array ou lista de arrays, como no predict).
+    :param labels: Labels binários (opcional) pra AUC e concordância no limiar 0.5.
+    :return: Dict com as métricas.
+    """
+    from sklearn.metrics import roc_auc_score
+
+    inputs = _as_inputs(inputs)
+    keras_inputs = inputs if len(inputs) > 1 else inputs[0]
+    reference = np.asarray(keras_model.predict(keras_inputs, batch_size=batch_size, verbose=0), dtype=np.float32).reshape(len(inputs[0]), -1)
+    quantized = tflite_model.predict(inputs, batch_size=batch_size).reshape(len(inputs[0]), -1)
+
+    keras_latency = _time_predict(lambda x: keras_model.predict_on_batch(x if len(x) > 1 else x[0]), inputs, batch_size, repeats)
+    tflite_latency = _time_predict(lambda x: tflite_model.predict(x, batch_size), inputs, batch_size, repeats)
+    n = min(batch_size, len(inputs[0]))
+    report = {
+        'model_size_mb': tflite_model.size_mb,
+        'keras_latency_ms': 1000 * keras_latency,
+        'tflite_latency_ms': 1000 * tflite_latency,
+        'keras_throughput': n / keras_latency,
+        'tflite_throughput': n / tflite_latency,
+        'speedup': keras_latency / tflite_latency,
+        'max_abs_diff': float(np.abs(reference - quantized).max()),
+        'mean_abs_diff': float(np.abs(reference - quantized).mean()),
+    }
+    if labels is not None and reference.shape[1] == 1:
+        labels = np.asarray(labels).reshape(-1)
+        report['agreement'] = float(np.mean((reference[:, 0] > 0.5) == (quantized[:, 0] > 0.5)))
+        if len(np.unique(labels)) == 2:
+            report['keras_auc'] = float(roc_auc_score(labels, reference[:, 0]))
+            report['tflite_auc'] = float(roc_auc_score(labels, quantized[:, 0]))
+            report['auc_drift'] = report['tflite_auc'] - report['keras_auc']
+    return report
+
+def export_and_compare(model, output_dir, name, calibration, inputs, labels=None, modes=('dynamic', 'int8'),
+                       batch_size=32, num_threads=None, repeats=5, **convert_kwargs):
+    """
+    Exporta o modelo em cada modo e compara com o float32 do Keras, imprimindo uma tabela.
+    Grava <output_dir>/<name>_<modo>.tflite e <output_dir>/<name>_report.json.
+    :param calibration: Amostras representativas do treino (usadas só no int8).
+    :param inputs: Conjunto de avaliação (validação/teste).
+    :param convert_kwargs: Repassados ao convert (ex: calibration_batch, allow_float_fallback).
+    :return: Dict {modo: métricas}.
+    """
+    reports = {}
+    for mode in modes:
+        path = export_tflite(model, os.path.join(output_dir, f"{name}_{mode}.tflite"), mode, calibration, **convert_kwargs)
+        reports[mode] = compare_models(model, TFLiteModel(path, num_threads), inputs, labels, batch_size, repeats)
+
+    print(f"{'modo':<10}{'MB':>8}{'Keras (ms)':>12}{'TFLite (ms)':>13}{'speedup':>9}{'máx |Δ|':>10}{'Δ AUC':>9}")
+    for mode, report in reports.items():
+        drift = f"{report['auc_drift']:+.4f}" if 'auc_drift' in report else '-'
+        print(f"{mode:<10}{report['model_size_mb']:>8.1f}{report['keras_latency_ms']:>12.1f}{report['tflite_latency_ms']:>13.1f}"
+              f"{report['speedup']:>9.2f}{report['max_abs_diff']:>10.4f}{drift:>9}")
+    with open(os.path.join(output_dir, f"{name}_report.json"), 'w') as f:
+        json.dump(reports, f, indent=1)
+    return reports
@@ -0,0 +1,112 @@
+import os
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import zoom
+
+# Mesma normalização do load_and_preprocess_image: imagem / (máximo + 1e-6)
+NORM_EPS = 1e-6
+
+
+# FUNÇÕES
+def hash_file(path, chunk_size=1 << 20):
+    """Hash SHA-256 do conteúdo do arquivo (identifica o volume mesmo se ele for copiado/renomeado)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(cache_dir, source_hash, target_shape):
+    """Arquivo do volume no cache: chave = hash da origem + shape alvo."""
+    shape_tag = 'x'.join(str(size) for size in target_shape)
+    return os.path.join(cache_dir, f"{source_hash[:32]}_{shape_tag}.npy")
+
+def resample_volume(path, target_shape):
+    """Lê o NIfTI e redimensiona para target_shape com zoom trilinear (order=1), como no notebook."""
+    image = nib.load(path).get_fdata().astype(np.float32)
+    zoom_factors = [target / original for target, original in zip(target_shape, image.shape)]
+    return zoom(image, zoom_factors, order=1)
+
+def _cache_volume(path, cache_dir, target_shape):
+    output = cache_path(cache_dir, hash_file(path), target_shape)
+    if os.path.exists(output):
+        return output
+    volume = resample_volume(path, target_shape)
+    # Escrita atômica: grava num temporário e renomeia
+    tmp = os.path.join(cache_dir, f".tmp-{os.getpid()}-{os.path.basename(output)}")
+    np.save(tmp, volume)
+    os.replace(tmp, output)
+    return output
+
+def build_volume_cache(paths, cache_dir, target_shape, workers=None):
+    """
+    Redimensiona cada volume para target_shape uma única vez e guarda como .npy (lido depois com mmap).
+    Volumes já presentes no cache (mesmo hash da origem e mesmo shape) não são recalculados.
+    :param paths: Caminhos dos NIfTI.
+    :param cache_dir: Pasta do cache.
+    :param target_shape: Shape alvo (ex: TARGET_SHAPE_3D).
+    :param workers: Processos para o zoom (padrão: núcleos da máquina).
+    :return: Caminhos dos arquivos do cache, na ordem de paths.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    target_shape = tuple(target_shape)
+    # spawn: o notebook já importou o TensorFlow, que não suporta fork depois de inicializado (como no scheduler.run_parallel)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        cached = list(executor.map(_cache_volume, paths, [cache_dir] * len(paths), [target_shape] * len(paths)))
+    print(f"Cache de volumes em {cache_dir}: {len(cached)} volumes {target_shape}.")
+    return cached
+
+
+class VolumeCache:
+    """
+    Volumes do cache abertos com mmap: volume(i) devolve uma view (sem cópia) do arquivo.
+    """
+    def __init__(self, cached_paths):
+        self.paths = list(cached_paths)
+        self._volumes = [np.load(path, mmap_mode='r') for path in self.paths]
+        shapes = {volume.shape for volume in self._volumes}
+        if len(shapes) > 1:
+            raise ValueError(f"Volumes do cache com shapes diferentes: {shapes}")
+        self.shape = shapes.pop() if shapes else None
+
+    def __len__(self):
+        return len(self._volumes)
+
+    def volume(self, i):
+        return self._volumes[i]
+
+    def dataset(self, labels, channels=1, batch_size=4, shuffle=False, seed=42):
+        """
+        Dataset tf.data de (volume, label). Cada volume vem da view do mmap (o TF copia só ao montar o
+        tensor), é normalizado pelo máximo e os canais são replicados só no fim, no lote já montado.
+        :param labels: Labels na mesma ordem dos volumes.
+        :param channels: Canais de entrada do modelo (ex: INPUT_SHAPE[3]).
+        :param shuffle: Embaralha de forma determinística pela seed (ordem muda a cada época).
+        :return: tf.data.Dataset com lotes (batch, *shape, channels).
+        """
+        import tensorflow as tf
+
+        shape = list(self.shape)
+
+        def load(i, label):
+            volume = tf.numpy_function(lambda idx: np.asarray(self._volumes[idx]), [i], tf.float32)
+            volume.set_shape(shape)
+            volume = volume / (tf.reduce_max(volume) + NORM_EPS)
+            return tf.expand_dims(volume, axis=-1), label
+
+        def expand_channels(volumes, label):
+            # Mesma saída do tf.repeat, mas feita uma vez por lote e só quando o modelo pede mais de um canal
+            return tf.broadcast_to(volumes, tf.concat([tf.shape(volumes)[:-1], [channels]], axis=0)), label
+
+        dataset = tf.data.Dataset.from_tensor_slices((np.arange(len(self)), np.asarray(labels)))
+        if shuffle:
+            dataset = dataset.shuffle(len(self), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.batch(batch_size)
+        if channels > 1:
+            dataset = dataset.map(expand_channels, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        return dataset.prefetch(tf.data.AUTOTUNE)
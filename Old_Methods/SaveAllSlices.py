@@ -1,7 +1,26 @@
 import nibabel as nib
 import numpy as np
 import os
+import json
+import gzip
+import argparse
 import nrrd
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'New_Methods', 'pre_processing'))
+from brain_crop import read_crop
+
+# Fatias axiais exportadas (mesmo intervalo de antes: 10 < slice < 150) e fração mínima de pixels não-pretos
+SLICE_RANGE = (11, 150)
+MIN_NON_BLACK_RATIO = 0.05
+
+# Compressão gzip dos .nii.gz (1 = rápido, 9 = menor); o nibabel usa 1 por padrão
+DEFAULT_COMPRESSLEVEL = 1
+
+# Arquivos do formato em bloco (um por paciente em vez de um por fatia)
+BULK_IMAGE_FILE = "slices.nii.gz"
+BULK_MASK_FILE = "mask_bits.npy.gz"
+BULK_INDEX_FILE = "slices.json"
 
 def calculate_label(subimage, threshold=0.003125):
     """
@@ -16,7 +35,7 @@ def calculate_label(subimage, threshold=0.003125):
     non_zero_pixels = np.count_nonzero(subimage)
     # Proporção de pixels não-preto
     non_black_ratio = non_zero_pixels / total_pixels if total_pixels > 0 else 0
-    
+
     # Verifica se há lesão e se o fundo não-preto é maior que o limiar
     if np.any(subimage == 1) and non_black_ratio >= threshold:
         return "label1"
@@ -54,62 +73,139 @@ def adjust_unique_lesion_pieces_with_neighbors(subimages, current_index, total_s
 
     return subimages
 
-imagens = "New_Methods/Patients_Displasya/T1"
-mascara = "New_Methods/Mascaras"
-
-excluded_patients = ["sub-54K08", "sub-87G01", "sub-89A03", "sub-90K10"]
-
-for img, mask in zip([f for f in sorted(os.listdir(imagens)) if f.endswith(('.nii', '.nii.gz'))], [f for f in sorted(os.listdir(mascara)) if f.endswith(('.nrrd', '.nii', '.nii.gz'))]):    
-    #print(f"{img}, {mask}")
-    if img.split('_')[0] in excluded_patients:
-        continue
-    data = nib.load(os.path.join(imagens, img)).get_fdata()
-    lesion_data, _ = nrrd.read(os.path.join(mascara, mask))
-    
-    # Rotacionar as imagens e as máscaras 180 graus
-    data = np.rot90(data, k=1)  # Rotaciona a imagem 90 graus
-    lesion_data = np.rot90(lesion_data, k=1)  # Rotaciona a máscara 90 graus
-    
-    # Verifica o formato das imagens
-    print(data[2].shape)
-    print(lesion_data[2].shape)
-
-    if (lesion_data.shape[2]>data.shape[2]):
-        continue
-
-    # Contador para acompanhar quantas fatias foram processadas
-    processed_slices = 0
-
-    # Diretório de saída para salvar as fatias
-    output_dir = f"New_Methods/Fatias_Patients/{img.split('_')[0]}"
-    output_dir_lesion = f"New_Methods/Fatias_Mask/{mask.split(' ')[0]}"
+def read_mask_lazy(path):
+    """
+    Abre a máscara sem carregar o volume inteiro quando possível: .nrrd com dados 'raw' no próprio arquivo
+    vira um memmap (só as fatias usadas são lidas do disco); NIfTI vira o proxy do nibabel (lê só a faixa pedida);
+    nos outros casos (gzip, dados separados) cai na leitura normal.
+    :return: Array (x, y, z) fatiável com slices contíguos, na mesma orientação do nrrd.read.
+    """
+    if not path.endswith('.nrrd'):
+        return nib.load(path).dataobj
+    with open(path, 'rb') as fh:
+        header = nrrd.read_header(fh)
+        offset = fh.tell()
+    if header.get('encoding') == 'raw' and 'data file' not in header and 'datafile' not in header \
+            and not header.get('byte skip') and not header.get('line skip'):
+        dtype = nrrd.reader._determine_datatype(header)
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(header['sizes']), order='F')
+    data, _ = nrrd.read(path)
+    return data
+
+def _save_nifti(array, path, dtype=None):
+    # Escrita atômica: grava num temporário e renomeia (um export interrompido não deixa arquivo truncado)
+    tmp = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{os.path.basename(path)}")
+    nib.save(nib.Nifti1Image(array, affine=np.eye(4), dtype=dtype), tmp)
+    os.replace(tmp, path)
+
+def export_patient(image_path, mask_path, output_dir, output_dir_lesion, bulk=False, compresslevel=DEFAULT_COMPRESSLEVEL):
+    """
+    Exporta as fatias axiais de um paciente (imagem + máscara), com a mesma seleção de fatias de antes.
+    A imagem fica no tipo original do NIfTI (não em float64) e a máscara em uint8 (antes int64).
+    Se o pré-processamento cortou a imagem pela caixa do cérebro (sidecar do brain_crop), a caixa gravada é
+    reaproveitada: fatias numeradas e selecionadas no grid completo do template e máscara cortada pela mesma caixa.
+    :param bulk: Se True, grava tudo de uma vez por paciente: um NIfTI (altura, largura, fatias) com as fatias
+                 selecionadas, a máscara compactada em bits (np.packbits + gzip) e um índice JSON com o número de cada fatia.
+                 Se False, mantém um .nii.gz por fatia (formato lido pelo load_data do Transformers2D).
+    :param compresslevel: Nível do gzip (1-9).
+    :return: Número de fatias exportadas, ou None se o paciente foi pulado.
+    """
+    nib.openers.Opener.default_compresslevel = compresslevel
+    image = nib.load(image_path)
+    # Tipo do arquivo (ex: float32/int16), em vez do get_fdata que devolve float64
+    data = np.asanyarray(image.dataobj)
+    lesion_data = read_mask_lazy(mask_path)
+
+    # Caixa do corte no grid completo (sem corte: o volume inteiro)
+    crop = read_crop(image_path)
+    box = np.asarray(crop['box']) if crop else np.array([[0, size] for size in data.shape])
+    full_shape = tuple(crop['full_shape']) if crop else data.shape
+    if lesion_data.shape[2] > full_shape[2]:
+        return None
+
+    # Rotacionar as imagens e as máscaras 90 graus (só a view; as fatias são lidas depois)
+    data = np.rot90(data, k=1)
+    first, last = max(SLICE_RANGE[0], box[2, 0]), min(SLICE_RANGE[1], lesion_data.shape[2], box[2, 1])
+    slice_ids = np.arange(first, last)
+    if len(slice_ids) == 0:
+        return 0
+
+    # Seleção vetorizada das fatias com fundo não-preto suficiente (fração sobre a fatia do grid completo,
+    # então a seleção não muda com o corte)
+    slices = data[:, :, first - box[2, 0]:last - box[2, 0]]
+    non_black_ratio = np.count_nonzero(slices, axis=(0, 1)) / (full_shape[0] * full_shape[1])
+    keep = non_black_ratio >= MIN_NON_BLACK_RATIO
+    slice_ids = slice_ids[keep]
+    # Só a faixa [first, last) da máscara é lida (memmap ou proxy do NIfTI, que não aceitam índices em array);
+    # as fatias mantidas são escolhidas em memória e binarizadas direto em uint8
+    lesion_slices = np.asarray(lesion_data[box[0, 0]:box[0, 1], box[1, 0]:box[1, 1], first:last])[:, :, keep]
+    lesion_slices = (np.rot90(lesion_slices, k=1) > 0.9).astype(np.uint8)
+    slices = np.ascontiguousarray(slices[:, :, keep])
+
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(output_dir_lesion, exist_ok=True)
-    
-    # Loop para cada fatia axial
-    for slice_idx in range(lesion_data.shape[2]):
-        if slice_idx>10 and slice_idx<150:
-            lesion_slice_data = lesion_data[:, :, slice_idx]
-            lesion_slice_data = np.where(lesion_slice_data>0.9, 1, 0)
-                    
-            slice_data = data[:, :, slice_idx]            
-                    
-            total_pixels = slice_data.size
-            non_zero_pixels = np.count_nonzero(slice_data)
-            non_black_ratio = non_zero_pixels / total_pixels if total_pixels > 0 else 0
-            
-            if non_black_ratio >= 0.05:
-                output_dir_lesion_slice = os.path.join(output_dir_lesion, f"Slice_{slice_idx:03}.nii.gz")
-                output_dir_slice = os.path.join(output_dir, f"Slice_{slice_idx:03}.nii.gz")
-
-                processed_slices += 1
-
-                subimage_nii = nib.Nifti1Image(lesion_slice_data, affine=np.eye(4), dtype=np.int64)
-                if (lesion_slice_data.size>0 and lesion_slice_data is not None):
-                    nib.save(subimage_nii, output_dir_lesion_slice)
-
-                subimage_nii = nib.Nifti1Image(slice_data, affine=np.eye(4))
-                if (slice_data.size>0 and slice_data is not None):
-                    nib.save(subimage_nii, output_dir_slice)
-        
-    print(f"Total de fatias processadas do paciente {img.split('_')[0]}: {processed_slices}")
\ No newline at end of file
+    if bulk:
+        _save_nifti(slices, os.path.join(output_dir, BULK_IMAGE_FILE))
+        tmp = os.path.join(output_dir_lesion, f".tmp-{os.getpid()}-{BULK_MASK_FILE}")
+        # Bits compactados (8 voxels por byte) e ainda comprimidos com gzip
+        with gzip.open(tmp, 'wb', compresslevel=compresslevel) as f:
+            np.save(f, np.packbits(lesion_slices, axis=None))
+        os.replace(tmp, os.path.join(output_dir_lesion, BULK_MASK_FILE))
+        with open(os.path.join(output_dir_lesion, BULK_INDEX_FILE), 'w') as f:
+            json.dump({"slices": slice_ids.tolist(), "shape": list(lesion_slices.shape), "crop": crop}, f)
+    else:
+        for position, slice_idx in enumerate(slice_ids):
+            _save_nifti(lesion_slices[:, :, position], os.path.join(output_dir_lesion, f"Slice_{slice_idx:03}.nii.gz"), np.uint8)
+            _save_nifti(slices[:, :, position], os.path.join(output_dir, f"Slice_{slice_idx:03}.nii.gz"))
+    return len(slice_ids)
+
+def load_bulk_slices(output_dir, output_dir_lesion):
+    """
+    Lê um paciente exportado com bulk=True.
+    :return: (imagens (altura, largura, fatias), máscaras uint8 no mesmo shape, números das fatias).
+    """
+    with open(os.path.join(output_dir_lesion, BULK_INDEX_FILE)) as f:
+        index = json.load(f)
+    shape = tuple(index["shape"])
+    images = np.asanyarray(nib.load(os.path.join(output_dir, BULK_IMAGE_FILE)).dataobj)
+    with gzip.open(os.path.join(output_dir_lesion, BULK_MASK_FILE), 'rb') as f:
+        packed = np.load(f)
+    masks = np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape)
+    return images, masks, index["slices"]
+
+def export_all(imagens, mascara, output_root, output_root_lesion, excluded_patients=(), bulk=False,
+               compresslevel=DEFAULT_COMPRESSLEVEL, workers=None):
+    """Exporta todos os pacientes em paralelo (um processo por paciente)."""
+    image_files = [f for f in sorted(os.listdir(imagens)) if f.endswith(('.nii', '.nii.gz'))]
+    mask_files = [f for f in sorted(os.listdir(mascara)) if f.endswith(('.nrrd', '.nii', '.nii.gz'))]
+    jobs = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for img, mask in zip(image_files, mask_files):
+            patient_id = img.split('_')[0]
+            if patient_id in excluded_patients:
+                continue
+            future = executor.submit(export_patient, os.path.join(imagens, img), os.path.join(mascara, mask),
+                                     os.path.join(output_root, patient_id), os.path.join(output_root_lesion, mask.split(' ')[0]),
+                                     bulk, compresslevel)
+            jobs[future] = patient_id
+        for future in as_completed(jobs):
+            processed_slices = future.result()
+            if processed_slices is None:
+                print(f"Paciente {jobs[future]} pulado: máscara com mais fatias que a imagem.")
+            else:
+                print(f"Total de fatias processadas do paciente {jobs[future]}: {processed_slices}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporta as fatias axiais das imagens e máscaras dos pacientes.")
+    parser.add_argument("--imagens", default="New_Methods/Patients_Displasya/T1")
+    parser.add_argument("--mascara", default="New_Methods/Mascaras")
+    parser.add_argument("--saida", default="New_Methods/Fatias_Patients")
+    parser.add_argument("--saida-mascara", default="New_Methods/Fatias_Mask")
+    parser.add_argument("--bulk", action="store_true", help="Um arquivo por paciente em vez de um por fatia.")
+    parser.add_argument("--compresslevel", type=int, default=DEFAULT_COMPRESSLEVEL, choices=range(1, 10))
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    excluded_patients = ["sub-54K08", "sub-87G01", "sub-89A03", "sub-90K10"]
+    export_all(args.imagens, args.mascara, args.saida, args.saida_mascara, excluded_patients,
+               args.bulk, args.compresslevel, args.workers)
@@ -0,0 +1,123 @@
+import math
+import numpy as np
+import tensorflow as tf
+
+# Combinações (rotate, flip, swap) na mesma ordem do augment_single_image dos notebooks
+TRANSFORMS = [
+    (True, False, False),   # só rotate
+    (False, True, False),   # só flip
+    (False, False, True),   # só swap
+    (True, True, False),    # rotate + flip
+    (True, False, True),    # rotate + swap
+    (False, True, True),    # flip + swap
+    (True, True, True)      # rotate + flip + swap
+]
+IDENTITY = (False, False, False)
+
+
+# FUNÇÕES
+# Rotação de 180° exata: inverte linhas e colunas (sem interpolação, devolve uma view)
+def rotate_180(img, axes=(0, 1)):
+    return np.flip(img, axis=axes)
+
+# Flip vertical (espelha as colunas, como o np.fliplr), também uma view
+def flip_vertical(img, axis=1):
+    return np.flip(img, axis=axis)
+
+def apply_transform(img_left, img_right, mask_left, mask_right, transform, batched=False):
+    """
+    Aplica uma combinação (rotate, flip, swap) ao par e às máscaras, mantendo esquerda/direita consistentes.
+    Nada é copiado: as saídas são views das entradas.
+    :param batched: Se True, as entradas são lotes (N, altura, largura[, canais]) e a mesma transformação vale pro lote todo.
+    :return: (img_left, img_right, mask_left, mask_right) transformados (máscaras None continuam None).
+    """
+    rotate, flip, swap = transform
+    axes = (1, 2) if batched else (0, 1)
+    arrays = [img_left, img_right, mask_left, mask_right]
+    if rotate:
+        arrays = [None if a is None else rotate_180(a, axes) for a in arrays]
+    if flip:
+        arrays = [None if a is None else flip_vertical(a, axes[1]) for a in arrays]
+    l_img, r_img, l_mask, r_mask = arrays
+    if swap:
+        l_img, r_img = r_img, l_img
+        l_mask, r_mask = r_mask, l_mask
+    return l_img, r_img, l_mask, r_mask
+
+def augment_image(img_left, img_right, mask_left, mask_right):
+    """
+    Gera as 7 variações do par (sem a original) aplicando rotação 180°, flip vertical e troca de lado.
+    Mesma saída do augment_image dos notebooks, mas com views em vez de cópias.
+    """
+    results_left, results_right, masks_left, masks_right = [], [], [], []
+    for rotate in [False, True]:
+        for flip in [False, True]:
+            for swap in [False, True]:
+                if not (rotate or flip or swap):  # pula a imagem padrão
+                    continue
+                l_img, r_img, l_mask, r_mask = apply_transform(img_left, img_right, mask_left, mask_right, (rotate, flip, swap))
+                results_left.append(l_img)
+                results_right.append(r_img)
+                masks_left.append(l_mask)
+                masks_right.append(r_mask)
+    return results_left, results_right, masks_left, masks_right
+
+def augment_single_image(img_left, img_right, mask_left, mask_right, rng):
+    """Aplica uma única combinação aleatória entre as 7 (mesmo sorteio do augment_single_image dos notebooks)."""
+    transform = tuple(rng.choice(TRANSFORMS))
+    return apply_transform(img_left, img_right, mask_left, mask_right, transform)
+
+
+class AugmentedPairSequence(tf.keras.utils.Sequence):
+    """
+    Lotes de pares (esquerda, direita) aumentados na hora, para o model.fit.
+    Substitui as augment_factor cópias materializadas: cada época percorre os pares augment_factor vezes
+    (mesmo número de amostras que antes), e cada lote sorteia uma transformação que vale para o lote
+    inteiro (a identidade com probabilidade 1/augment_factor, como a proporção de originais do esquema antigo).
+    A memória do treino fica só a do conjunto original.
+
+    Uso:
+        train_sequence = AugmentedPairSequence(train_left, train_right, y_train, batch_size=128, augment_factor=3)
+        model.fit(train_sequence, validation_data=([valid_left, valid_right], y_valid), epochs=...)
+    """
+    def __init__(self, images_left, images_right, labels, batch_size=128, augment_factor=3,
+                 masks_left=None, masks_right=None, shuffle=True, seed=42):
+        super().__init__()
+        self.images_left = images_left
+        self.images_right = images_right
+        self.labels = np.asarray(labels)
+        self.masks_left = masks_left
+        self.masks_right = masks_right
+        self.batch_size = batch_size
+        self.augment_factor = max(1, int(augment_factor))
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(len(self.order) / self.batch_size)
+
+    def on_epoch_end(self):
+        # Índices repetidos augment_factor vezes (só os índices, as imagens não são copiadas)
+        order = np.tile(np.arange(len(self.labels)), self.augment_factor)
+        if self.shuffle:
+            self.rng.shuffle(order)
+        self.order = order
+        # Uma transformação por lote, sorteada uma vez por época (reprodutível pela seed)
+        n_batches = math.ceil(len(order) / self.batch_size)
+        keep_original = self.rng.random(n_batches) < 1 / self.augment_factor
+        self.batch_transforms = [IDENTITY if keep else TRANSFORMS[choice]
+                                 for keep, choice in zip(keep_original, self.rng.integers(len(TRANSFORMS), size=n_batches))]
+
+    def batch(self, idx):
+        """Lote idx com as máscaras: (esquerda, direita, máscara esquerda, máscara direita, labels)."""
+        indices = np.sort(self.order[idx * self.batch_size:(idx + 1) * self.batch_size])
+        take = lambda data: None if data is None else np.take(data, indices, axis=0)
+        l_img, r_img, l_mask, r_mask = apply_transform(
+            take(self.images_left), take(self.images_right), take(self.masks_left), take(self.masks_right),
+            self.batch_transforms[idx], batched=True)
+        return l_img, r_img, l_mask, r_mask, self.labels[indices]
+
+    def __getitem__(self, idx):
+        l_img, r_img, _, _, labels = self.batch(idx)
+        return (np.ascontiguousarray(l_img), np.ascontiguousarray(r_img)), labels
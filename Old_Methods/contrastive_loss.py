@@ -0,0 +1,125 @@
+import tensorflow as tf
+
+# Temperatura padrão (a mesma do nt_xent_loss do Contrastive_SSCL)
+DEFAULT_TEMPERATURE = 0.1
+
+# Linhas da matriz de similaridade calculadas por vez: a memória do passo fica em chunk x (2B + fila)
+DEFAULT_CHUNK_SIZE = 256
+
+# Logit usado para tirar a similaridade de cada vista com ela mesma do denominador
+_MASK_VALUE = -1e9
+
+
+# FUNÇÕES
+def _row_losses(queries, positives, row_ids, keys, negatives, temperature, include_self):
+    """
+    Perda de cada linha: logsumexp(logits) - logit do positivo, sem montar a softmax nem as labels one-hot.
+    :param queries: Projeções (c, dim) das linhas do bloco.
+    :param positives: Projeções (c, dim) dos pares positivos dessas linhas.
+    :param row_ids: Posição (c,) de cada linha dentro de keys (para mascarar a auto-similaridade).
+    :param keys: Todas as projeções do lote (2B, dim).
+    :param negatives: Negativos extras (fila) (K, dim) ou None.
+    """
+    logits = tf.matmul(queries, keys, transpose_b=True) / temperature
+    if not include_self:
+        self_mask = tf.equal(row_ids[:, None], tf.range(tf.shape(keys)[0])[None, :])
+        logits = tf.where(self_mask, tf.cast(_MASK_VALUE, logits.dtype), logits)
+    if negatives is not None:
+        logits = tf.concat([logits, tf.matmul(queries, negatives, transpose_b=True) / temperature], axis=1)
+    positive_logits = tf.reduce_sum(queries * positives, axis=1) / temperature
+    return tf.reduce_logsumexp(logits, axis=1) - positive_logits
+
+def nt_xent_loss(projections, temperature=DEFAULT_TEMPERATURE, chunk_size=DEFAULT_CHUNK_SIZE, negatives=None, include_self=False):
+    """
+    NT-Xent (Normalized Temperature-scaled Cross-Entropy) com logsumexp fundido e similaridade em blocos.
+    O par positivo de projections[i] é projections[i + B] (esquerda e direita concatenadas, como no SSCLModel).
+    Cada bloco de linhas é recalculado no backward (tf.recompute_grad), então a matriz 2B x 2B
+    nunca fica inteira na memória, nem no forward nem no gradiente.
+    :param projections: Tensor (2B, dim).
+    :param chunk_size: Linhas por bloco (None ou 0 calcula tudo de uma vez).
+    :param negatives: Negativos extras (K, dim), ex: NegativeQueue.negatives (sem gradiente).
+    :param include_self: Se True, mantém a auto-similaridade no denominador, como o nt_xent_loss antigo
+                         (softmax sobre a linha inteira); o padrão é a NT-Xent usual, sem ela.
+    :return: Perda média (escalar).
+    """
+    projections = tf.math.l2_normalize(projections, axis=1)
+    total = tf.shape(projections)[0]
+    positives = tf.roll(projections, shift=total // 2, axis=0)
+    if negatives is not None:
+        negatives = tf.stop_gradient(tf.math.l2_normalize(tf.cast(negatives, projections.dtype), axis=1))
+
+    if not chunk_size:
+        return tf.reduce_mean(_row_losses(projections, positives, tf.range(total), projections, negatives,
+                                          temperature, include_self))
+
+    # Completa o lote até um múltiplo de chunk_size e percorre os blocos com map_fn (tamanho do lote dinâmico)
+    n_chunks = (total + chunk_size - 1) // chunk_size
+    padding = n_chunks * chunk_size - total
+    dim = tf.shape(projections)[1]
+    queries = tf.reshape(tf.pad(projections, [[0, padding], [0, 0]]), [n_chunks, chunk_size, dim])
+    paired = tf.reshape(tf.pad(positives, [[0, padding], [0, 0]]), [n_chunks, chunk_size, dim])
+    row_ids = tf.reshape(tf.range(n_chunks * chunk_size), [n_chunks, chunk_size])
+
+    if negatives is None:
+        @tf.recompute_grad
+        def chunk_losses(chunk_queries, chunk_positives, chunk_rows, keys):
+            return _row_losses(chunk_queries, chunk_positives, chunk_rows, keys, None, temperature, include_self)
+        losses = tf.map_fn(lambda args: chunk_losses(args[0], args[1], args[2], projections),
+                           (queries, paired, row_ids), fn_output_signature=projections.dtype)
+    else:
+        @tf.recompute_grad
+        def chunk_losses(chunk_queries, chunk_positives, chunk_rows, keys, extra):
+            return _row_losses(chunk_queries, chunk_positives, chunk_rows, keys, extra, temperature, include_self)
+        losses = tf.map_fn(lambda args: chunk_losses(args[0], args[1], args[2], projections, negatives),
+                           (queries, paired, row_ids), fn_output_signature=projections.dtype)
+
+    # As linhas de preenchimento são descartadas antes da média
+    return tf.reduce_mean(tf.reshape(losses, [-1])[:total])
+
+
+class NegativeQueue(tf.Module):
+    """
+    Fila circular (memory bank) de projeções de lotes anteriores, usadas como negativos extras na NT-Xent.
+    Começa vazia: só as posições já preenchidas entram na perda.
+    """
+    def __init__(self, size, dim, name="negative_queue"):
+        super().__init__(name=name)
+        self.size = size
+        self.queue = tf.Variable(tf.zeros([size, dim]), trainable=False, name="queue")
+        self.pointer = tf.Variable(0, trainable=False, dtype=tf.int32, name="pointer")
+        self.filled = tf.Variable(0, trainable=False, dtype=tf.int32, name="filled")
+
+    @property
+    def negatives(self):
+        return self.queue[:self.filled]
+
+    def enqueue(self, keys):
+        """Grava as projeções do lote (sem gradiente) sobrescrevendo as mais antigas."""
+        keys = tf.stop_gradient(tf.math.l2_normalize(tf.cast(keys, self.queue.dtype), axis=1))[-self.size:]
+        count = tf.shape(keys)[0]
+        positions = (self.pointer + tf.range(count)) % self.size
+        self.queue.scatter_nd_update(positions[:, None], keys)
+        self.pointer.assign((self.pointer + count) % self.size)
+        self.filled.assign(tf.minimum(self.filled + count, self.size))
+
+
+def clone_momentum(model):
+    """
+    Cópia do modelo (mesmos pesos, sem treino por gradiente) para ser o encoder de momento.
+    Camadas sem pesos (ex: o Lambda do l2_normalize, que não pode ser desserializado) são reaproveitadas.
+    O modelo precisa estar construído (ex: projection_head.build(encoder.output_shape)).
+    """
+    def clone_layer(layer):
+        return layer.__class__.from_config(layer.get_config()) if layer.weights else layer
+
+    momentum_model = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    if not momentum_model.built:
+        momentum_model.build(model.input_shape)
+    momentum_model.set_weights(model.get_weights())
+    momentum_model.trainable = False
+    return momentum_model
+
+def momentum_update(model, momentum_model, momentum=0.999):
+    """Média móvel exponencial dos pesos: momento = m * momento + (1 - m) * online."""
+    for weight, momentum_weight in zip(model.weights, momentum_model.weights):
+        momentum_weight.assign(momentum * momentum_weight + (1.0 - momentum) * weight)
@@ -0,0 +1,268 @@
+import os
+import re
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from patch_store import PatchStore, SIDES, INDEX_FILE
+
+logger = logging.getLogger(__name__)
+
+# Catálogo padrão, gravado na raiz da árvore escaneada
+CATALOG_NAME = 'catalog.sqlite'
+# Versão do esquema (PRAGMA user_version); um catálogo mais antigo é recriado e reescaneado no próximo update
+SCHEMA_VERSION = 2
+
+# Pastas de lado do formato antigo (<modalidade>/<paciente>/<lado>/Slice_NNN/<lado>_NNN.nii.gz)
+LEGACY_SIDES = ('left', 'lesion_left', 'right', 'lesion_right')
+
+# O que cada linha guarda: no formato antigo imagem e máscara são arquivos separados ('image'/'mask');
+# num PatchStore cada linha tem o recorte e a máscara juntos ('pair')
+KINDS = ('image', 'mask', 'pair')
+
+# Uma linha por recorte. No formato antigo cada arquivo é um recorte (path = arquivo);
+# num PatchStore cada linha do índice é um recorte (path = <pasta do store>#<linha>).
+# side é sempre o lado do cérebro ('left'/'right', como no PatchStore); a pasta lesion_<lado> do formato
+# antigo vira side=<lado> e kind='mask', então as consultas são as mesmas nos dois formatos.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    side TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    slice INTEGER,
+    patch INTEGER,
+    height INTEGER,
+    width INTEGER,
+    lesion_voxels INTEGER,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_slice ON files (patient, modality, side, kind, slice);
+CREATE INDEX IF NOT EXISTS files_source ON files (source);
+"""
+
+COLUMNS = ('path', 'source', 'patient', 'modality', 'side', 'kind', 'slice', 'patch', 'height', 'width',
+           'lesion_voxels', 'mtime_ns', 'size')
+
+
+# FUNÇÕES
+def split_side(side):
+    """
+    Lado do cérebro e tipo de recorte de uma pasta do formato antigo ou de um filtro: 'lesion_left' -> ('left', 'mask'),
+    'left' -> ('left', None) (None = qualquer tipo). Aceita os dois vocabulários nas consultas.
+    """
+    if side is not None and side.startswith('lesion_'):
+        return side[len('lesion_'):], 'mask'
+    return side, None
+
+# Tipos de linha que contam como cada tipo pedido (a linha de um PatchStore é imagem e máscara ao mesmo tempo)
+def _kinds(kind):
+    return (kind, 'pair') if kind in ('image', 'mask') else (kind,)
+
+def _number(name):
+    numbers = re.findall(r'\d+', name)
+    return int(numbers[-1]) if numbers else None
+
+def _list_patient(patient_path, patient, modality):
+    """
+    Lista as unidades de leitura de um paciente/modalidade sem abrir nenhum arquivo: cada arquivo .nii/.nii.gz
+    do formato antigo, ou o índice do PatchStore. Só faz os os.scandir/stat.
+    :return: Lista de (caminho, tipo 'nifti'|'store', paciente, modalidade, lado, slice, mtime_ns, tamanho).
+    """
+    if PatchStore.exists(patient_path):
+        stat = os.stat(os.path.join(patient_path, INDEX_FILE))
+        return [(patient_path, 'store', patient, modality, None, None, stat.st_mtime_ns, stat.st_size)]
+    sources = []
+    for side in LEGACY_SIDES:
+        side_path = os.path.join(patient_path, side)
+        if not os.path.isdir(side_path):
+            continue
+        for slice_entry in os.scandir(side_path):
+            if not slice_entry.is_dir():
+                continue
+            for entry in os.scandir(slice_entry.path):
+                if entry.is_file() and entry.name.endswith(('.nii', '.nii.gz')):
+                    stat = entry.stat()
+                    sources.append((entry.path, 'nifti', patient, modality, side, _number(slice_entry.name),
+                                    stat.st_mtime_ns, stat.st_size))
+    return sources
+
+def _list_sources(root, executor):
+    """Lista as fontes de todos os pacientes de todas as modalidades, um paciente por thread."""
+    patient_dirs = []
+    for modality in sorted(os.listdir(root)):
+        modality_path = os.path.join(root, modality)
+        if not os.path.isdir(modality_path):
+            continue
+        for patient in sorted(os.listdir(modality_path)):
+            patient_path = os.path.join(modality_path, patient)
+            if os.path.isdir(patient_path):
+                patient_dirs.append((patient_path, patient, modality))
+    listed = executor.map(lambda args: _list_patient(*args), patient_dirs)
+    return [source for sources in listed for source in sources]
+
+def _read_nifti(source):
+    """Linha do catálogo de um arquivo do formato antigo (só as máscaras de lesão são decodificadas)."""
+    import nibabel as nib
+
+    path, _, patient, modality, folder, slice_idx, mtime_ns, size = source
+    side, kind = split_side(folder)
+    image = nib.load(path)
+    height, width = image.shape[:2]
+    lesion_voxels = None
+    if kind == 'mask':
+        lesion_voxels = int(np.count_nonzero(np.asarray(image.dataobj) == 1))
+    patch_idx = _number(os.path.basename(path).split('.')[0])
+    return [(path, path, patient, modality, side, kind or 'image', slice_idx, None if patch_idx is None else patch_idx - 1,
+             height, width, lesion_voxels, mtime_ns, size)]
+
+def _read_store(source):
+    """Linhas do catálogo de um PatchStore (uma por recorte), com a contagem de lesão tirada do masks.npy."""
+    path, _, patient, modality, _, _, mtime_ns, size = source
+    store = PatchStore(path)
+    if store.uniform:
+        lesion_voxels = np.count_nonzero(np.asarray(store.masks) == 1, axis=(1, 2))
+    else:
+        lesion_voxels = [np.count_nonzero(store.mask(i) == 1) for i in range(len(store))]
+    return [(f"{path}#{i}", path, patient, modality, SIDES[row['side']], 'pair', int(row['slice']), int(row['patch']),
+             int(row['height']), int(row['width']), int(lesion), mtime_ns, size)
+            for i, (row, lesion) in enumerate(zip(store.index, lesion_voxels))]
+
+def _read_source(source):
+    try:
+        return _read_store(source) if source[1] == 'store' else _read_nifti(source)
+    except Exception as e:
+        logger.warning(f"Erro ao abrir {source[0]}: {e}")
+        return []
+
+
+class DatasetCatalog:
+    """
+    Catálogo SQLite da árvore Novo_Contralateral (formato antigo e PatchStores): paciente, modalidade, lado,
+    slice, recorte, shape, voxels de lesão e mtime de cada recorte. Escaneado uma vez e atualizado só nos
+    arquivos novos ou com mtime/tamanho diferente; as checagens viram consultas em vez de abrir os arquivos.
+
+    Uso:
+        catalog = DatasetCatalog.build("Novo_Contralateral")
+        catalog.slice_inconsistencies()
+        catalog.has_lesion("sub-00H10", "Contralateral_T1", "left", 42)
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Catálogo de uma versão anterior (lados 'lesion_*', sem kind): recriado e reescaneado no update
+            self.connection.execute("DROP TABLE IF EXISTS files")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @classmethod
+    def build(cls, root, db_path=None, workers=None):
+        """Abre (ou cria) o catálogo de root e atualiza com o estado atual da árvore."""
+        catalog = cls(db_path or os.path.join(root, CATALOG_NAME))
+        catalog.update(root, workers)
+        return catalog
+
+    def update(self, root, workers=None):
+        """
+        Atualização incremental: relê só as fontes novas ou com mtime/tamanho diferente do catálogo,
+        em paralelo (threads: a descompressão dos .nii.gz libera o GIL), e apaga as que sumiram.
+        :return: Dict com o número de fontes novas/alteradas, removidas e inalteradas.
+        """
+        known = dict(((source, (mtime_ns, size)) for source, mtime_ns, size in
+                      self.connection.execute("SELECT source, MAX(mtime_ns), MAX(size) FROM files GROUP BY source")))
+        # Threads também na listagem: em disco de rede o custo é a latência de cada listdir/stat
+        with ThreadPoolExecutor(max_workers=workers or min(16, (os.cpu_count() or 1) * 4)) as executor:
+            sources = _list_sources(root, executor)
+            current = {source[0] for source in sources}
+            changed = [source for source in sources if known.get(source[0]) != (source[6], source[7])]
+            removed = [source for source in known if source not in current and source.startswith(root)]
+
+            with self.connection:
+                self.connection.executemany("DELETE FROM files WHERE source = ?", [(source,) for source in removed])
+                for source, rows in zip(changed, executor.map(_read_source, changed)):
+                    self.connection.execute("DELETE FROM files WHERE source = ?", (source[0],))
+                    self.connection.executemany(
+                        f"INSERT INTO files ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+
+        stats = {"alterados": len(changed), "removidos": len(removed), "inalterados": len(sources) - len(changed)}
+        print(f"Catálogo {self.db_path}: {stats['alterados']} novos/alterados, {stats['removidos']} removidos, "
+              f"{stats['inalterados']} inalterados.")
+        return stats
+
+    def query(self, sql, params=()):
+        return self.connection.execute(sql, params).fetchall()
+
+    def patients(self, modality=None):
+        sql = "SELECT DISTINCT patient FROM files" + (" WHERE modality = ?" if modality else "") + " ORDER BY patient"
+        return [row[0] for row in self.query(sql, (modality,) if modality else ())]
+
+    def modalities(self):
+        return [row[0] for row in self.query("SELECT DISTINCT modality FROM files ORDER BY modality")]
+
+    def patches(self, patient=None, modality=None, side=None, slice_idx=None, kind=None):
+        """
+        Recortes que atendem aos filtros, como dicts, em ordem de slice e recorte.
+        :param side: 'left'/'right' (ou 'lesion_left'/'lesion_right', que equivale a side + kind='mask').
+        :param kind: 'image' ou 'mask' (as linhas 'pair' de um PatchStore entram nos dois); None = todos.
+        """
+        side, side_kind = split_side(side)
+        kind = kind or side_kind
+        filters = {"patient": patient, "modality": modality, "side": side, "slice": slice_idx}
+        where = [f"{column} = ?" for column, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+        if kind is not None:
+            kinds = _kinds(kind)
+            where.append(f"kind IN ({', '.join('?' * len(kinds))})")
+            params.extend(kinds)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM files"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY patient, modality, side, slice, patch"
+        return [dict(zip(COLUMNS, row)) for row in self.query(sql, params)]
+
+    def has_lesion(self, patient, modality, side, slice_idx):
+        """
+        Se algum recorte do slice tem voxel de lesão (== 1), sem abrir nenhum arquivo.
+        Só as linhas com máscara têm lesion_voxels (kind 'mask' ou 'pair'), então a consulta vale pros dois formatos.
+        """
+        side, _ = split_side(side)
+        row = self.query("SELECT 1 FROM files WHERE patient = ? AND modality = ? AND side = ? AND slice = ? "
+                         "AND lesion_voxels > 0 LIMIT 1", (patient, modality, side, slice_idx))
+        return bool(row)
+
+    def slice_counts(self, patient=None):
+        """
+        Número de recortes por (paciente, lado, tipo, slice, modalidade), com tipo 'image' ou 'mask'.
+        Cada linha de um PatchStore conta uma vez em cada tipo, como o par de arquivos do formato antigo.
+        """
+        where, params = "", []
+        if patient is not None:
+            where, params = " AND patient = ?", [patient, patient]
+        sql = (f"SELECT patient, side, 'image' AS kind, slice, modality FROM files WHERE kind IN ('image', 'pair'){where} "
+               f"UNION ALL SELECT patient, side, 'mask', slice, modality FROM files WHERE kind IN ('mask', 'pair'){where}")
+        return self.query(f"SELECT patient, side, kind, slice, modality, COUNT(*) FROM ({sql}) "
+                          "GROUP BY patient, side, kind, slice, modality ORDER BY patient, side, kind, slice, modality", params)
+
+    def slice_inconsistencies(self, patient=None):
+        """
+        Slices cujo número de recortes difere entre as modalidades (a checagem do InconsistencyAnalyzes).
+        :return: Lista de (paciente, lado, tipo, slice, {modalidade: contagem}).
+        """
+        grouped = {}
+        for patient_id, side, kind, slice_idx, modality, count in self.slice_counts(patient):
+            grouped.setdefault((patient_id, side, kind, slice_idx), {})[modality] = count
+        return [(patient_id, side, kind, slice_idx, counts) for (patient_id, side, kind, slice_idx), counts in grouped.items()
+                if len(counts) >= 2 and len(set(counts.values())) > 1]
@@ -0,0 +1,262 @@
+import os
+import json
+import numpy as np
+from patch_store import SIDES
+from patient_loader import open_patient_store
+from patient_inference import minmax_per_patch
+
+# Arquivos do store de embeddings (matriz e metadados em .npy abertos com mmap, info gravado por último)
+EMBEDDINGS_FILE = 'embeddings.npy'
+META_FILE = 'meta.npy'
+INFO_FILE = 'info.json'
+
+# Uma linha por recorte, na mesma ordem das linhas da matriz de embeddings
+META_DTYPE = np.dtype([
+    ('patient', 'U16'),
+    ('slice', np.int16),
+    ('side', np.int8),      # 0 = left, 1 = right
+    ('patch', np.int16),
+    ('y1', np.int16), ('y2', np.int16), ('x1', np.int16), ('x2', np.int16),
+    ('label', np.int8),
+])
+
+# Recortes por chamada do encoder (o último lote é completado, então o grafo é traçado uma única vez)
+DEFAULT_BATCH_SIZE = 512
+
+# Linhas da matriz de similaridade calculadas por vez (limita a memória do k-NN a chunk x treino)
+DEFAULT_CHUNK_SIZE = 2048
+
+
+# FUNÇÕES
+def _save_npy(path, array):
+    tmp = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{os.path.basename(path)}")
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+def encode_batches(encoder, images, batch_size=DEFAULT_BATCH_SIZE, normalize=minmax_per_patch, flip=None, out=None):
+    """
+    Roda o encoder congelado em lotes de tamanho fixo.
+    :param images: Recortes (n, altura, largura) ou (n, altura, largura, 1); pode ser um memmap.
+    :param flip: Array booleano (n,) com os recortes a espelhar antes do encoder (ex: lado direito).
+    :param out: Array (n, dim) onde gravar (ex: a região da matriz do store); se None, é alocado.
+    :return: Embeddings (n, dim) float32.
+    """
+    n = len(images)
+    for start in range(0, n, batch_size):
+        batch = np.array(images[start:start + batch_size], dtype=np.float32)
+        if flip is not None:
+            rows = flip[start:start + batch_size]
+            batch[rows] = batch[rows][:, :, ::-1]
+        if normalize is not None:
+            batch = normalize(batch)
+        if batch.ndim == 3:
+            batch = batch[..., np.newaxis]
+        count = len(batch)
+        if count < batch_size:
+            batch = np.pad(batch, [(0, batch_size - count)] + [(0, 0)] * (batch.ndim - 1))
+        embeddings = np.asarray(encoder(batch, training=False)).reshape(batch_size, -1)[:count]
+        if out is None:
+            out = np.empty((n, embeddings.shape[1]), dtype=np.float32)
+        out[start:start + count] = embeddings
+    return out
+
+def build_embedding_store(encoder, folder, patient_ids, store_path, batch_size=DEFAULT_BATCH_SIZE,
+                          normalize=minmax_per_patch, flip_right=True, cache_dir=None):
+    """
+    Passa o encoder uma única vez por todos os recortes dos pacientes e grava os embeddings numa matriz
+    (n_recortes, dim) em .npy, com os metadados de cada linha (paciente, slice, lado, coordenadas, label).
+    :param encoder: Encoder já treinado (ex: o build_encoder após o pré-treino do SSCLModel).
+    :param folder: Pasta dos pacientes (PatchStore ou formato antigo, como no load_patient).
+    :param flip_right: Espelha os recortes do lado direito, como no treino (load_patient).
+    :return: EmbeddingStore.
+    """
+    stores = {}
+    for patient_id in patient_ids:
+        store = open_patient_store(folder, patient_id, cache_dir)
+        if store is None:
+            print(f"Paciente {patient_id} não encontrado na pasta {folder}.")
+            continue
+        if len(store) and not store.uniform:
+            raise ValueError(f"Recortes de tamanhos diferentes no paciente {patient_id}")
+        stores[patient_id] = store
+    total = sum(len(store) for store in stores.values())
+
+    os.makedirs(store_path, exist_ok=True)
+    meta = np.zeros(total, dtype=META_DTYPE)
+    tmp_embeddings = os.path.join(store_path, f".tmp-{os.getpid()}-{EMBEDDINGS_FILE}")
+    embeddings = None
+    start = 0
+    for patient_id, store in stores.items():
+        count = len(store)
+        if not count:
+            continue
+        flip = store.index['side'] == SIDES.index('right') if flip_right else None
+        if embeddings is None:
+            # Matriz gravada direto no disco, uma região por paciente
+            embeddings = np.lib.format.open_memmap(tmp_embeddings, mode='w+', dtype=np.float32,
+                                                   shape=(total, encoder.output_shape[-1]))
+        encode_batches(encoder, store.images, batch_size, normalize, flip, out=embeddings[start:start + count])
+        for field in META_DTYPE.names[1:]:
+            meta[field][start:start + count] = store.index[field]
+        meta['patient'][start:start + count] = patient_id
+        start += count
+        print(f"Paciente {patient_id}: {count} recortes codificados.")
+
+    if embeddings is None:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        np.save(tmp_embeddings, embeddings)
+    else:
+        embeddings.flush()
+        del embeddings
+    # O info é gravado por último: se ele existe, a matriz e os metadados estão completos
+    os.replace(tmp_embeddings, os.path.join(store_path, EMBEDDINGS_FILE))
+    _save_npy(os.path.join(store_path, META_FILE), meta)
+    info = {"count": int(total), "patients": list(stores), "folder": folder, "flip_right": flip_right}
+    tmp_info = os.path.join(store_path, f".tmp-{os.getpid()}-{INFO_FILE}")
+    with open(tmp_info, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_info, os.path.join(store_path, INFO_FILE))
+    print(f"Store de embeddings em {store_path}: {total} recortes de {len(stores)} pacientes.")
+    return EmbeddingStore(store_path)
+
+def l2_normalize(embeddings, eps=1e-12):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, eps)
+
+def top_k_similar(queries, keys, k, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Os k vizinhos mais próximos (similaridade de cosseno) de cada consulta, calculando a matriz de
+    similaridade em blocos de linhas e com argpartition (sem ordenar a linha inteira).
+    :param queries: Embeddings (n, dim) já normalizados (l2_normalize).
+    :param keys: Embeddings (m, dim) já normalizados.
+    :return: (índices (n, k) em keys, similaridades (n, k)), do mais parecido para o menos.
+    """
+    k = min(k, len(keys))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    similarities = np.empty((len(queries), k), dtype=np.float32)
+    for start in range(0, len(queries), chunk_size):
+        scores = queries[start:start + chunk_size] @ keys.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        indices[start:start + len(scores)] = np.take_along_axis(top, order, axis=1)
+        similarities[start:start + len(scores)] = np.take_along_axis(top_scores, order, axis=1)
+    return indices, similarities
+
+def knn_scores(train_embeddings, train_labels, query_embeddings, k=20, temperature=0.1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Probabilidade da classe 1 por k-NN ponderado (peso exp(similaridade / temperatura) de cada vizinho).
+    :return: Array (n,) de scores em [0, 1].
+    """
+    train_labels = np.asarray(train_labels)
+    neighbours, similarities = top_k_similar(l2_normalize(query_embeddings), l2_normalize(train_embeddings), k, chunk_size)
+    weights = np.exp((similarities - similarities[:, :1]) / temperature)
+    return (weights * train_labels[neighbours]).sum(axis=1) / weights.sum(axis=1)
+
+def linear_probe(train_embeddings, train_labels, query_embeddings, C=1.0, max_iter=1000):
+    """
+    Regressão logística sobre os embeddings congelados (features padronizadas, classes balanceadas).
+    :return: (scores da classe 1 para as consultas, modelo treinado).
+    """
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    probe = make_pipeline(StandardScaler(), LogisticRegression(C=C, max_iter=max_iter, class_weight='balanced'))
+    probe.fit(train_embeddings, train_labels)
+    return probe.predict_proba(query_embeddings)[:, 1], probe
+
+
+class EmbeddingStore:
+    """
+    Embeddings de todos os recortes abertos com mmap, com os metadados de cada linha.
+
+    Uso:
+        store = build_embedding_store(encoder, "Contralateral", patient_ids, "Embeddings_SSCL")
+        result = store.evaluate(train_patients, test_patients)
+        indices, similarities = store.nearest(store.lesions(test_patients)[0], k=10)
+    """
+    def __init__(self, path):
+        if not EmbeddingStore.exists(path):
+            raise FileNotFoundError(f"Store de embeddings não encontrado em {path}; rode build_embedding_store antes.")
+        self.path = path
+        with open(os.path.join(path, INFO_FILE)) as f:
+            self.info = json.load(f)
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode='r')
+        self.meta = np.load(os.path.join(path, META_FILE))
+        self._normalized = None
+
+    def __len__(self):
+        return len(self.meta)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INFO_FILE))
+
+    @property
+    def labels(self):
+        return self.meta['label']
+
+    @property
+    def normalized(self):
+        """Embeddings normalizados (L2), calculados uma vez e mantidos em memória."""
+        if self._normalized is None:
+            self._normalized = l2_normalize(np.asarray(self.embeddings, dtype=np.float32))
+        return self._normalized
+
+    def select(self, patients=None, side=None):
+        """Índices das linhas dos pacientes (e do lado 'left'/'right') pedidos."""
+        keep = np.ones(len(self), dtype=bool)
+        if patients is not None:
+            keep &= np.isin(self.meta['patient'], list(patients))
+        if side is not None:
+            keep &= self.meta['side'] == SIDES.index(side)
+        return np.flatnonzero(keep)
+
+    def lesions(self, patients=None):
+        """Índices dos recortes com lesão (label 1)."""
+        indices = self.select(patients)
+        return indices[self.labels[indices] == 1]
+
+    def nearest(self, query, k=10, candidates=None, exclude_patient=True):
+        """
+        Recortes mais parecidos com a consulta ("recortes mais parecidos com esta lesão").
+        :param query: Índice de uma linha do store ou um embedding (dim,).
+        :param candidates: Índices onde procurar (padrão: todo o store).
+        :param exclude_patient: Se a consulta é uma linha do store, ignora os recortes do mesmo paciente.
+        :return: (índices no store, similaridades de cosseno), do mais parecido para o menos.
+        """
+        candidates = np.arange(len(self)) if candidates is None else np.asarray(candidates)
+        if np.isscalar(query) or np.ndim(query) == 0:
+            if exclude_patient:
+                candidates = candidates[self.meta['patient'][candidates] != self.meta['patient'][query]]
+            vector = self.normalized[int(query)][np.newaxis]
+        else:
+            vector = l2_normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))
+        neighbours, similarities = top_k_similar(vector, self.normalized[candidates], k)
+        return candidates[neighbours[0]], similarities[0]
+
+    def evaluate(self, train_patients, test_patients, k=20, temperature=0.1, probe=True):
+        """
+        Avalia a representação sem fine-tune: k-NN e linear probe treinados nos recortes de train_patients
+        e testados nos de test_patients (AUC da curva Precision-Recall, como no notebook).
+        :return: Dict com labels, scores e PR-AUC de cada método.
+        """
+        from sklearn.metrics import auc, precision_recall_curve
+
+        def pr_auc(labels, scores):
+            precision, recall, _ = precision_recall_curve(labels, scores)
+            return auc(recall, precision)
+
+        train, test = self.select(train_patients), self.select(test_patients)
+        train_embeddings, test_embeddings = self.normalized[train], self.normalized[test]
+        labels = self.labels[test]
+        result = {"labels": labels}
+        result["knn_scores"] = knn_scores(train_embeddings, self.labels[train], test_embeddings, k, temperature)
+        result["knn_auc_pr"] = pr_auc(labels, result["knn_scores"])
+        print(f"k-NN (k={k}): AUC PR = {result['knn_auc_pr']:.4f}")
+        if probe:
+            result["probe_scores"], _ = linear_probe(train_embeddings, self.labels[train], test_embeddings)
+            result["probe_auc_pr"] = pr_auc(labels, result["probe_scores"])
+            print(f"Linear probe: AUC PR = {result['probe_auc_pr']:.4f}")
+        return result
@@ -0,0 +1,202 @@
+import numpy as np
+
+# Até quantas vezes a altura as faixas de linhas podem somar antes de compensar a tabela de somas acumuladas
+BAND_ROWS_FACTOR = 4
+
+# FUNÇÕES
+def summed_area_table(volume):
+    """
+    Tabela de somas acumuladas (integral image) dos pixels não-pretos de cada slice.
+    :param volume: Array (n_slices, altura, largura).
+    :return: Array int32 (n_slices, altura + 1, largura + 1), com zeros na primeira linha/coluna,
+             de forma que a soma de [y1:y2, x1:x2] é sat[y2, x2] - sat[y1, x2] - sat[y2, x1] + sat[y1, x1].
+    """
+    n, height, width = volume.shape
+    sat = np.zeros((n, height + 1, width + 1), dtype=np.int32)
+    np.cumsum(volume != 0, axis=1, dtype=np.int32, out=sat[:, 1:, 1:])
+    np.cumsum(sat[:, 1:, 1:], axis=2, out=sat[:, 1:, 1:])
+    return sat
+
+def window_counts(sat, y1, x1, size_y, size_x):
+    """Número de pixels não-pretos em cada janela (y1, x1, tamanho) de todos os slices: (n_slices, n_janelas)."""
+    y2, x2 = y1 + size_y, x1 + size_x
+    return sat[:, y2, x2] - sat[:, y1, x2] - sat[:, y2, x1] + sat[:, y1, x1]
+
+def band_counts(nonzero, rows, x1, size_y, size_x):
+    """
+    Mesmo resultado do window_counts sem montar a tabela do volume inteiro: soma só as faixas
+    de linhas das janelas e faz a soma acumulada em uma dimensão. Mais barato quando as faixas
+    não se sobrepõem (grids grossos, ex: tamanho 40 com passo 35).
+    :param nonzero: Volume booleano (n_slices, altura, largura).
+    :param rows: Linhas iniciais distintas das janelas.
+    :param x1: Colunas iniciais (as mesmas pra todas as linhas).
+    :return: Array (n_slices, len(rows) * len(x1)), na ordem linha -> coluna.
+    """
+    n_slices, _, width = nonzero.shape
+    counts = np.empty((n_slices, len(rows), len(x1)), dtype=np.int32)
+    cumulative = np.zeros((n_slices, width + 1), dtype=np.int32)
+    for k, y in enumerate(rows):
+        np.cumsum(nonzero[:, y:y + size_y, :].sum(axis=1, dtype=np.int32), axis=1, out=cumulative[:, 1:])
+        counts[:, k, :] = cumulative[:, x1 + size_x] - cumulative[:, x1]
+    return counts.reshape(n_slices, -1)
+
+def grid_counts(volume, rows, x1, size):
+    """
+    Pixels não-pretos de cada janela (rows x x1) de todos os slices, escolhendo entre as faixas
+    (grids grossos) e a tabela de somas acumuladas (grids densos, com muitas faixas sobrepostas).
+    """
+    height = volume.shape[1]
+    # As faixas somam len(rows) * size linhas; a tabela faz duas somas acumuladas (bem mais lentas) na altura toda
+    if len(rows) * size <= BAND_ROWS_FACTOR * height:
+        return band_counts(volume != 0, rows, x1, size, size)
+    sat = summed_area_table(volume)
+    return window_counts(sat, np.repeat(rows, len(x1)), np.tile(x1, len(rows)), size, size)
+
+def _slices_first(volume, axis):
+    volume = np.asarray(volume)
+    if volume.ndim == 2:
+        return volume[np.newaxis]
+    return np.moveaxis(volume, axis, 0)
+
+
+class PairGrid:
+    """
+    Pares contralaterais de um volume inteiro em arrays (uma posição por linha, na mesma
+    ordem dos loops do create_left_right_grid). Coordenadas inclusivas, como nos notebooks.
+    """
+    FIELDS = ('slice', 'y1', 'y2', 'x1_l', 'x2_l', 'x1_r', 'x2_r',
+              'occupancy_l', 'occupancy_r', 'lesion_l', 'lesion_r')
+
+    def __init__(self, **arrays):
+        for name in self.FIELDS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.slice)
+
+    def rects(self, slice_idx):
+        """Grids do slice no formato dos notebooks: ([[y1, y2, x1, x2], ...] esquerda, idem direita)."""
+        keep = self.slice == slice_idx
+        y1, y2 = self.y1[keep], self.y2[keep]
+        grid_l = np.stack([y1, y2, self.x1_l[keep], self.x2_l[keep]], axis=1).tolist()
+        grid_r = np.stack([y1, y2, self.x1_r[keep], self.x2_r[keep]], axis=1).tolist()
+        return grid_l, grid_r
+
+
+def left_right_grid(volume, size, overlap, threshold, lesion=None, axis=2):
+    """
+    Versão vetorizada do create_left_right_grid para todos os slices de uma vez.
+    As janelas esquerda/direita são espelhadas em relação ao centro da largura; um par entra
+    se algum dos lados tem mais que threshold de pixels não-pretos.
+    :param volume: Volume (altura, largura, slices) com os slices no eixo `axis`, ou um slice 2D.
+    :param size: Lado da janela.
+    :param overlap: Passo entre janelas.
+    :param threshold: Fração mínima de pixels não-pretos.
+    :param lesion: Máscara de lesão com o mesmo shape (opcional), pra fração de lesão de cada janela.
+    :return: PairGrid com coordenadas, ocupação e fração de lesão de cada par mantido.
+    """
+    data = _slices_first(volume, axis)
+    n_slices, height, width_full = data.shape
+    width_half = width_full // 2
+
+    if height < size or width_full < size:
+        rows, offsets = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    else:
+        rows = np.arange(0, height - size + 1, overlap)
+        offsets = np.arange(0, max(width_half - size + 1, 0), overlap)
+
+    # Todas as janelas candidatas (mesmas pra todos os slices), na ordem i -> j_offset
+    y1 = np.repeat(rows, len(offsets))
+    j_offset = np.tile(offsets, len(rows))
+    x1_l = width_half - size - j_offset
+    x1_r = width_half + j_offset
+
+    area = size * size
+    # Esquerda e direita contadas de uma vez: colunas [esquerda..., direita...] em cada linha
+    columns = np.concatenate([width_half - size - offsets, width_half + offsets])
+
+    def split_sides(counts):
+        counts = counts.reshape(n_slices, len(rows), 2, len(offsets))
+        return counts[:, :, 0].reshape(n_slices, -1), counts[:, :, 1].reshape(n_slices, -1)
+
+    counts_l, counts_r = split_sides(grid_counts(data, rows, columns, size))
+
+    if lesion is not None:
+        lesion_l, lesion_r = split_sides(grid_counts(_slices_first(lesion, axis), rows, columns, size) / area)
+    else:
+        lesion_l = lesion_r = np.zeros(counts_l.shape)
+
+    # Mesma comparação do loop: count_nonzero > square.size * threshold
+    keep = (counts_l > area * threshold) | (counts_r > area * threshold)
+    slice_idx, window_idx = np.nonzero(keep)
+
+    return PairGrid(
+        slice=slice_idx,
+        y1=y1[window_idx], y2=y1[window_idx] + size - 1,
+        x1_l=x1_l[window_idx], x2_l=x1_l[window_idx] + size - 1,
+        x1_r=x1_r[window_idx], x2_r=x1_r[window_idx] + size - 1,
+        occupancy_l=counts_l[keep] / area, occupancy_r=counts_r[keep] / area,
+        lesion_l=lesion_l[keep], lesion_r=lesion_r[keep],
+    )
+
+def half_vertical_grid(volume, size, overlap, threshold, axis=2):
+    """
+    Versão vetorizada do create_grid_half_vertical (metade esquerda, linhas com passo `size`,
+    colunas a partir do centro com passo `overlap`) para todos os slices.
+    :return: Tupla (slices, coords) com coords (n, 4) = [y1, y2, x1, x2] inclusivos.
+    """
+    data = _slices_first(volume, axis)
+    n_slices, height, width_full = data.shape
+    if height < size or width_full < size // 2:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.int64)
+    width = width_full // 2
+
+    rows = np.arange(0, height - size + 1, size)
+    right_edges = np.arange(width, 0, -overlap)
+    right_edges = right_edges[right_edges - size >= 0]  # o loop para no primeiro x1 negativo
+
+    y1 = np.repeat(rows, len(right_edges))
+    x1 = np.tile(right_edges - size, len(rows))
+    counts = grid_counts(data, rows, right_edges - size, size)
+    slice_idx, window_idx = np.nonzero(counts > size * size * threshold)
+
+    coords = np.stack([y1[window_idx], y1[window_idx] + size - 1, x1[window_idx], x1[window_idx] + size - 1], axis=1)
+    return slice_idx, coords
+
+def crop_bounds(volume, axis=2):
+    """
+    Retângulo ajustado ao cérebro de cada slice (mesma convenção do crop_black_slices_2d).
+    :return: Array (n_slices, 4) com [xmin, xmax, ymin, ymax] e máscara dos slices não vazios.
+    """
+    data = _slices_first(volume, axis) != 0
+    rows = data.any(axis=2)  # (n, altura)
+    cols = data.any(axis=1)  # (n, largura)
+    not_empty = rows.any(axis=1)
+
+    height, width = rows.shape[1], cols.shape[1]
+    ymin = rows.argmax(axis=1)
+    ymax = height - 1 - rows[:, ::-1].argmax(axis=1)
+    xmin = cols.argmax(axis=1)
+    xmax = width - 1 - cols[:, ::-1].argmax(axis=1)
+    return np.stack([xmin, xmax, ymin, ymax], axis=1), not_empty
+
+
+# Mesma interface das funções do GridCreation, agora em cima das versões vetorizadas
+def create_left_right_grid(data, size, overlap, threshold):
+    if data.ndim != 2:
+        return [], []
+    return left_right_grid(data, size, overlap, threshold).rects(0)
+
+def create_grid_half_vertical(data, size, overlap, threshold):
+    if data.ndim != 2:
+        return []
+    _, coords = half_vertical_grid(data, size, overlap, threshold)
+    return coords.tolist()
+
+# corta imagem 2d, de modo a eliminar pixels pretos, deixando só um retângulo ajustado ao cérebro
+def crop_black_slices_2d(data):
+    bounds, not_empty = crop_bounds(data)
+    if not not_empty[0]:
+        return data, []
+    xmin, xmax, ymin, ymax = bounds[0]
+    return data[ymin:ymax + 1, xmin:xmax + 1], [xmin, xmax, ymin, ymax]
@@ -0,0 +1,189 @@
+import os
+import numpy as np
+
+# Arquivos do store de um paciente/modalidade (todos .npy, abertos com mmap)
+IMAGES_FILE = 'images.npy'
+MASKS_FILE = 'masks.npy'
+INDEX_FILE = 'index.npy'
+
+SIDES = ('left', 'right')
+
+# Uma linha por recorte: posição no slice, coordenadas do grid (inclusivas), onde ficam os pixels e o label
+INDEX_DTYPE = np.dtype([
+    ('slice', np.int16),
+    ('side', np.int8),      # 0 = left, 1 = right
+    ('patch', np.int16),    # índice do recorte no grid do lado (left_001 -> 0)
+    ('y1', np.int16), ('y2', np.int16), ('x1', np.int16), ('x2', np.int16),
+    ('offset', np.int64),   # início do recorte no array plano de pixels
+    ('height', np.int16), ('width', np.int16),
+    ('label', np.int8),
+])
+
+# Mesmo limiar do calculate_label dos notebooks
+LABEL_THRESHOLD = 0.05
+
+
+# FUNÇÕES
+def calculate_label(mask, threshold=LABEL_THRESHOLD):
+    """
+    Label do recorte: 1 se há lesão e a proporção de pixels de lesão passa do limiar.
+    Mesma regra do calculate_label dos notebooks.
+    """
+    total_pixels = mask.size
+    non_black_ratio = np.count_nonzero(mask) / total_pixels if total_pixels > 0 else 0
+    return int(np.any(mask > 0.5) and non_black_ratio >= threshold)
+
+def _save_npy(path, array):
+    # Escrita atômica: grava o .npy num temporário e renomeia
+    tmp = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{os.path.basename(path)}")
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+class PatchStoreWriter:
+    """
+    Acumula os recortes (imagem + lesão) de um paciente numa modalidade e grava, no close(),
+    um único array contíguo de pixels (float32 pras imagens, int8 pras lesões) e um índice
+    com (slice, lado, recorte, coordenadas, label). Substitui os milhares de .nii.gz por recorte.
+
+    Uso:
+        with PatchStoreWriter("Novo_Contralateral/Contralateral_T1/sub-00H10") as writer:
+            writer.add(slice_idx, "left", patch_idx, (y1, y2, x1, x2), subimage, subimage_lesion)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._images, self._masks, self._rows = [], [], []
+        self._offset = 0
+
+    def add(self, slice_idx, side, patch_idx, rect, image, mask):
+        image = np.asarray(image, dtype=np.float32)
+        mask = np.asarray(mask, dtype=np.int8)
+        if image.shape != mask.shape:
+            raise ValueError(f"Recorte e lesão com shapes diferentes: {image.shape} x {mask.shape}")
+        y1, y2, x1, x2 = rect
+        self._rows.append((slice_idx, SIDES.index(side), patch_idx, y1, y2, x1, x2,
+                           self._offset, image.shape[0], image.shape[1], calculate_label(mask)))
+        self._images.append(image.ravel())
+        self._masks.append(mask.ravel())
+        self._offset += image.size
+
+    def __len__(self):
+        return len(self._rows)
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        images = np.concatenate(self._images) if self._images else np.zeros(0, dtype=np.float32)
+        masks = np.concatenate(self._masks) if self._masks else np.zeros(0, dtype=np.int8)
+        # O índice é gravado por último: se ele existe, os pixels já estão completos
+        _save_npy(os.path.join(self.path, IMAGES_FILE), images)
+        _save_npy(os.path.join(self.path, MASKS_FILE), masks)
+        _save_npy(os.path.join(self.path, INDEX_FILE), np.array(self._rows, dtype=INDEX_DTYPE))
+        self._images, self._masks = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class PatchStore:
+    """
+    Leitura dos recortes de um paciente/modalidade sem copiar: os pixels são um memmap
+    e cada recorte é uma view dele. Quando todos os recortes têm o mesmo tamanho,
+    images/masks são views (N, altura, largura) do arquivo inteiro.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = np.load(os.path.join(path, INDEX_FILE))
+        self._images = np.load(os.path.join(path, IMAGES_FILE), mmap_mode='r')
+        self._masks = np.load(os.path.join(path, MASKS_FILE), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INDEX_FILE))
+
+    @property
+    def uniform(self):
+        return len(self.index) > 0 and len(np.unique(self.index['height'])) == 1 and len(np.unique(self.index['width'])) == 1
+
+    def _view(self, flat, i):
+        row = self.index[i]
+        return flat[row['offset']:row['offset'] + row['height'] * row['width']].reshape(row['height'], row['width'])
+
+    def image(self, i):
+        return self._view(self._images, i)
+
+    def mask(self, i):
+        return self._view(self._masks, i)
+
+    def _stack(self, flat):
+        if not self.uniform:
+            raise ValueError("Recortes com tamanhos diferentes; use image(i)/mask(i)")
+        return flat.reshape(len(self.index), self.index['height'][0], self.index['width'][0])
+
+    @property
+    def images(self):
+        return self._stack(self._images)
+
+    @property
+    def masks(self):
+        return self._stack(self._masks)
+
+    @property
+    def labels(self):
+        return self.index['label']
+
+    def select(self, side=None, slice_idx=None):
+        """Índices das linhas de um lado e/ou de um slice, na ordem de gravação."""
+        keep = np.ones(len(self.index), dtype=bool)
+        if side is not None:
+            keep &= self.index['side'] == SIDES.index(side)
+        if slice_idx is not None:
+            keep &= self.index['slice'] == slice_idx
+        return np.nonzero(keep)[0]
+
+    def pairs(self):
+        """
+        Índices (esquerda, direita) dos recortes contralaterais: mesmo slice e mesma posição no grid.
+        :return: Dois arrays de índices, alinhados.
+        """
+        left, right = self.select('left'), self.select('right')
+        right_by_key = {(s, p): i for s, p, i in zip(self.index['slice'][right], self.index['patch'][right], right)}
+        matched = [(i, right_by_key[(s, p)]) for s, p, i in zip(self.index['slice'][left], self.index['patch'][left], left)
+                   if (s, p) in right_by_key]
+        if not matched:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        left_idx, right_idx = np.array(matched).T
+        return left_idx, right_idx
+
+
+def import_nifti_patches(patient_folder, store_path):
+    """
+    Converte o formato antigo (<paciente>/<left|right|lesion_left|lesion_right>/Slice_NNN/<lado>_NNN.nii.gz)
+    num PatchStore. As coordenadas do grid não existem nesse formato e ficam como -1.
+    """
+    import re
+    import nibabel as nib
+
+    with PatchStoreWriter(store_path) as writer:
+        for side in SIDES:
+            side_dir = os.path.join(patient_folder, side)
+            lesion_dir = os.path.join(patient_folder, f"lesion_{side}")
+            if not os.path.isdir(side_dir):
+                continue
+            for slice_name in sorted(os.listdir(side_dir)):
+                slice_idx = int(re.findall(r'\d+', slice_name)[-1])
+                for patch_name in sorted(os.listdir(os.path.join(side_dir, slice_name))):
+                    lesion_path = os.path.join(lesion_dir, slice_name, patch_name)
+                    if not os.path.exists(lesion_path):
+                        continue
+                    patch_idx = int(re.findall(r'\d+', patch_name)[-1]) - 1
+                    image = nib.load(os.path.join(side_dir, slice_name, patch_name)).get_fdata()
+                    mask = nib.load(lesion_path).get_fdata()
+                    writer.add(slice_idx, side, patch_idx, (-1, -1, -1, -1), image, mask)
+    return PatchStore(store_path)
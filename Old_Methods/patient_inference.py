@@ -0,0 +1,171 @@
+import os
+import numpy as np
+import nibabel as nib
+from numpy.lib.stride_tricks import sliding_window_view
+from grid_engine import PairGrid, left_right_grid, _slices_first
+
+# Mesmos parâmetros do grid do GridCreation
+GRID_SIZE = 40
+GRID_OVERLAP = 35
+GRID_THRESHOLD = 0.05
+MIN_SLICE_RATIO = 0.05
+
+# Pares por chamada do modelo (o último lote é completado, então o grafo é traçado uma única vez)
+DEFAULT_BATCH_SIZE = 512
+
+
+# FUNÇÕES
+def minmax_per_patch(batch):
+    """Normalização min-max de cada recorte do lote (como o normalize_minmax aplicado recorte a recorte)."""
+    axes = tuple(range(1, batch.ndim))
+    min_val = batch.min(axis=axes, keepdims=True)
+    span = batch.max(axis=axes, keepdims=True) - min_val
+    return np.divide(batch - min_val, span, out=np.zeros_like(batch), where=span > 0)
+
+def grid_from_store(store):
+    """
+    PairGrid com as coordenadas salvas num PatchStore (os mesmos recortes usados no treino).
+    :return: PairGrid, ou None se o store não tem coordenadas (convertido do formato antigo em .nii.gz).
+    """
+    idx_left, idx_right = store.pairs()
+    left, right = store.index[idx_left], store.index[idx_right]
+    if (left['y1'] < 0).any() or (right['y1'] < 0).any():
+        return None
+    zeros = np.zeros(len(left))
+    return PairGrid(slice=left['slice'].astype(np.int64),
+                    y1=left['y1'].astype(np.int64), y2=left['y2'].astype(np.int64),
+                    x1_l=left['x1'].astype(np.int64), x2_l=left['x2'].astype(np.int64),
+                    x1_r=right['x1'].astype(np.int64), x2_r=right['x2'].astype(np.int64),
+                    occupancy_l=zeros, occupancy_r=zeros, lesion_l=zeros, lesion_r=zeros)
+
+def patient_grid(grid_volume, size=GRID_SIZE, overlap=GRID_OVERLAP, threshold=GRID_THRESHOLD, min_ratio=MIN_SLICE_RATIO):
+    """
+    Pares contralaterais de todas as fatias do volume (grid_volume já na orientação do grid, fatias no eixo 2),
+    só nas fatias com pelo menos min_ratio de pixels não-pretos, como no GridCreation.
+    """
+    grids = left_right_grid(grid_volume, size, overlap, threshold)
+    ratios = np.count_nonzero(grid_volume, axis=(0, 1)) / (grid_volume.shape[0] * grid_volume.shape[1])
+    keep = ratios[grids.slice] >= min_ratio
+    return PairGrid(**{name: getattr(grids, name)[keep] for name in PairGrid.FIELDS})
+
+def extract_pairs(volume, grids, indices, flip_right=True):
+    """
+    Recortes (esquerda, direita) dos pares `indices` de uma vez, a partir de uma view de janelas deslizantes.
+    :param volume: Volume (altura, largura, fatias) na orientação do grid.
+    :return: Dois arrays (n, size, size) float32.
+    """
+    size = int(grids.y2[0] - grids.y1[0] + 1)
+    windows = sliding_window_view(_slices_first(volume, 2), (size, size), axis=(1, 2))
+    slices, rows = grids.slice[indices], grids.y1[indices]
+    left = windows[slices, rows, grids.x1_l[indices]].astype(np.float32)
+    right = windows[slices, rows, grids.x1_r[indices]].astype(np.float32)
+    if flip_right:
+        right = right[:, :, ::-1]
+    return left, np.ascontiguousarray(right)
+
+def predict_pairs(model, images_left, images_right, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Roda o modelo siamês em lotes de tamanho fixo (o último é completado com zeros e descartado),
+    chamando o modelo direto em vez de um predict por fatia.
+    :return: Array (n,) com a saída do modelo para cada par.
+    """
+    n = len(images_left)
+    if images_left.ndim == 3:
+        images_left, images_right = images_left[..., np.newaxis], images_right[..., np.newaxis]
+    scores = np.empty(n, dtype=np.float32)
+    for start in range(0, n, batch_size):
+        left = images_left[start:start + batch_size]
+        right = images_right[start:start + batch_size]
+        count = len(left)
+        if count < batch_size:
+            pad = [(0, batch_size - count)] + [(0, 0)] * (left.ndim - 1)
+            left, right = np.pad(left, pad), np.pad(right, pad)
+        output = model([left, right], training=False)
+        scores[start:start + count] = np.asarray(output).reshape(batch_size, -1)[:count, 0]
+    return scores
+
+def scatter_scores(shape, grids, scores, reduce='max'):
+    """
+    Espalha o score de cada par nas duas janelas (esquerda e direita) de um mapa 3D.
+    :param shape: Shape do volume (altura, largura, fatias) na orientação do grid.
+    :param reduce: 'max' (maior score entre janelas sobrepostas) ou 'mean'.
+    :return: Mapa float32 com o shape do volume.
+    """
+    size = int(grids.y2[0] - grids.y1[0] + 1) if len(grids) else 0
+    heatmap = np.zeros(shape, dtype=np.float32)
+    if not len(grids):
+        return heatmap
+    offsets = np.arange(size)
+    rows = (grids.y1[:, None, None] + offsets[None, :, None])
+    rows = np.broadcast_to(rows, (len(grids), size, size))
+    slices = np.broadcast_to(grids.slice[:, None, None], rows.shape)
+    values = np.broadcast_to(scores.astype(np.float32)[:, None, None], rows.shape)
+    counts = np.zeros(shape, dtype=np.float32) if reduce == 'mean' else None
+    for x1 in (grids.x1_l, grids.x1_r):
+        cols = np.broadcast_to(x1[:, None, None] + offsets[None, None, :], rows.shape)
+        if reduce == 'mean':
+            np.add.at(heatmap, (rows, cols, slices), values)
+            np.add.at(counts, (rows, cols, slices), 1)
+        else:
+            np.maximum.at(heatmap, (rows, cols, slices), values)
+    if reduce == 'mean':
+        np.divide(heatmap, counts, out=heatmap, where=counts > 0)
+    return heatmap
+
+def predict_patient(model, image, grid_volume=None, grids=None, batch_size=DEFAULT_BATCH_SIZE,
+                    normalize=minmax_per_patch, score_fn=None, flip_right=True, reduce='max', rot90=1):
+    """
+    Inferência do paciente inteiro: gera todos os pares contralaterais de todas as fatias, roda o modelo
+    em lotes grandes e devolve um mapa 3D de probabilidade alinhado aos voxels do volume original.
+    :param model: Modelo siamês (entradas [esquerda, direita]).
+    :param image: Volume pré-processado da modalidade do modelo (ex: T1), como lido do NIfTI.
+    :param grid_volume: Volume usado pra decidir o grid (ex: T1 | Flair | T2 binário); padrão: image > 0.
+    :param grids: PairGrid pronto (ex: grid_from_store) já na orientação do grid; se None, é gerado aqui.
+    :param normalize: Função aplicada a cada lote de recortes (None para não normalizar).
+    :param score_fn: Converte a saída do modelo em probabilidade (ex: lambda d: np.exp(-d) para distâncias).
+    :param rot90: Rotação aplicada antes do grid (o GridCreation usa np.rot90(k=1)); o mapa volta pra orientação original.
+    :return: (mapa 3D float32, grids, scores por par).
+    """
+    image = np.rot90(np.asarray(image, dtype=np.float32), k=rot90)
+    if grids is None:
+        grid_volume = image > 0 if grid_volume is None else np.rot90(np.asarray(grid_volume), k=rot90)
+        grids = patient_grid(grid_volume)
+
+    scores = np.empty(len(grids), dtype=np.float32)
+    # Os recortes são extraídos por bloco, então a memória não cresce com o número de pares do paciente
+    for start in range(0, len(grids), batch_size):
+        indices = np.arange(start, min(start + batch_size, len(grids)))
+        left, right = extract_pairs(image, grids, indices, flip_right)
+        if normalize is not None:
+            left, right = normalize(left), normalize(right)
+        scores[indices] = predict_pairs(model, left, right, batch_size)
+    if score_fn is not None:
+        scores = np.asarray(score_fn(scores), dtype=np.float32)
+
+    heatmap = scatter_scores(image.shape, grids, scores, reduce)
+    return np.rot90(heatmap, k=-rot90), grids, scores
+
+def save_heatmap(heatmap, reference_path, output_path):
+    """Salva o mapa como NIfTI com o affine/cabeçalho do volume de referência (escrita atômica)."""
+    reference = nib.load(reference_path)
+    output = nib.Nifti1Image(np.ascontiguousarray(heatmap, dtype=np.float32), reference.affine, reference.header)
+    output.set_data_dtype(np.float32)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp = os.path.join(os.path.dirname(output_path), f".tmp-{os.getpid()}-{os.path.basename(output_path)}")
+    nib.save(output, tmp)
+    os.replace(tmp, output_path)
+
+def predict_patient_to_nifti(model, image_path, output_path, grid_paths=None, **kwargs):
+    """
+    Lê o volume, roda predict_patient e salva o mapa 3D ao lado do volume original.
+    :param grid_paths: Volumes usados no grid (ex: T1, Flair e T2 do paciente); padrão: o próprio image_path.
+    """
+    image = nib.load(image_path).get_fdata(dtype=np.float32)
+    grid_volume = None
+    if grid_paths:
+        grid_volume = np.zeros(image.shape, dtype=bool)
+        for path in grid_paths:
+            grid_volume |= nib.load(path).get_fdata(dtype=np.float32) > 0
+    heatmap, grids, scores = predict_patient(model, image, grid_volume=grid_volume, **kwargs)
+    save_heatmap(heatmap, image_path, output_path)
+    return heatmap, grids, scores
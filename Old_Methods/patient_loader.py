@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from patch_store import PatchStore, import_nifti_patches, calculate_label
+
+# Arquivo com a impressão digital da pasta de origem, gravado junto do cache de cada paciente
+FINGERPRINT_FILE = 'source.json'
+
+
+# FUNÇÕES
+def source_fingerprint(path):
+    """Hash de todos os arquivos da pasta do paciente (caminho relativo, tamanho e mtime)."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def _read_fingerprint(cache_path):
+    try:
+        with open(os.path.join(cache_path, FINGERPRINT_FILE)) as f:
+            return json.load(f).get("fingerprint")
+    except (OSError, ValueError):
+        return None
+
+def _write_fingerprint(cache_path, fingerprint):
+    tmp = os.path.join(cache_path, f".tmp-{os.getpid()}-{FINGERPRINT_FILE}")
+    with open(tmp, 'w') as f:
+        json.dump({"fingerprint": fingerprint}, f)
+    os.replace(tmp, os.path.join(cache_path, FINGERPRINT_FILE))
+
+def open_patient_store(folder, patient_id, cache_dir=None):
+    """
+    PatchStore do paciente. Se a pasta já é um PatchStore (GridCreation atual), usa direto;
+    se está no formato antigo (um .nii.gz por recorte), converte uma vez para um PatchStore em
+    cache_dir/<paciente>, refeito só quando algum arquivo da pasta de origem muda.
+    :return: PatchStore ou None se o paciente não existe.
+    """
+    patient_path = os.path.join(folder, patient_id)
+    if PatchStore.exists(patient_path):
+        return PatchStore(patient_path)
+    if not os.path.isdir(patient_path):
+        return None
+
+    cache_path = os.path.join(cache_dir or os.path.join(folder, '.cache'), patient_id)
+    fingerprint = source_fingerprint(patient_path)
+    if PatchStore.exists(cache_path) and _read_fingerprint(cache_path) == fingerprint:
+        return PatchStore(cache_path)
+
+    store = import_nifti_patches(patient_path, cache_path)
+    _write_fingerprint(cache_path, fingerprint)
+    return store
+
+
+class PatientData:
+    """
+    Pares contralaterais de um paciente em arrays contíguos (alocados uma vez), com os metadados
+    de cada par (linha do índice do PatchStore do lado esquerdo: slice, recorte, coordenadas).
+    """
+    def __init__(self, patient_id, images_left, images_right, mask_left, mask_right, meta):
+        self.patient_id = patient_id
+        self.images_left = images_left
+        self.images_right = images_right
+        self.mask_left = mask_left
+        self.mask_right = mask_right
+        self.meta = meta
+        self.labels_left = np.array([calculate_label(mask) for mask in mask_left], dtype=np.int8)
+        self.labels_right = np.array([calculate_label(mask) for mask in mask_right], dtype=np.int8)
+        self.labels_pair = (self.labels_left | self.labels_right).astype(np.int8)
+
+    def __len__(self):
+        return len(self.labels_pair)
+
+    def by_slice(self):
+        """Índices dos pares de cada slice, em ordem de slice e de recorte: {slice: array de índices}."""
+        order = np.lexsort((self.meta['patch'], self.meta['slice']))
+        slices, starts = np.unique(self.meta['slice'][order], return_index=True)
+        return dict(zip(slices.tolist(), np.split(order, starts[1:])))
+
+    def as_dict(self):
+        """Mesmo formato do patient_data dos notebooks (arrays em vez de listas)."""
+        return {
+            "images_left": self.images_left,
+            "images_right": self.images_right,
+            "mask_left": self.mask_left,
+            "mask_right": self.mask_right,
+            "labels_left": self.labels_left.tolist(),
+            "labels_right": self.labels_right.tolist(),
+            "labels_pair": self.labels_pair.tolist(),
+        }
+
+    def as_slices(self):
+        """Formato do load_patient_data_per_slice: listas por slice de recortes, máscaras e labels."""
+        data = {key: [] for key in ("images_left", "images_right", "mask_left", "mask_right", "labels_left", "labels_right")}
+        labels_total = []
+        for indices in self.by_slice().values():
+            for key in ("images_left", "images_right", "mask_left", "mask_right"):
+                data[key].append(list(getattr(self, key)[indices]))
+            data["labels_left"].append(self.labels_left[indices].tolist())
+            data["labels_right"].append(self.labels_right[indices].tolist())
+            labels_total.append(self.labels_pair[indices].tolist())
+        data["labels_pair"] = labels_total
+        return data, labels_total
+
+
+def load_patient(folder, patient_id, cache_dir=None, flip_right=True):
+    """
+    Carrega os pares de um paciente em arrays contíguos.
+    :param folder: Pasta com os pacientes (PatchStore ou formato antigo em .nii.gz).
+    :param cache_dir: Onde guardar o PatchStore convertido do formato antigo.
+    :param flip_right: Espelha o lado direito (como o load_patient_data); o load_patient_data_per_slice não espelhava.
+    :return: PatientData ou None se o paciente não foi encontrado.
+    """
+    store = open_patient_store(folder, patient_id, cache_dir)
+    if store is None:
+        print(f"Paciente {patient_id} não encontrado na pasta {folder}.")
+        return None
+    if len(store) and not store.uniform:
+        raise ValueError(f"Recortes de tamanhos diferentes no paciente {patient_id}")
+
+    idx_left, idx_right = store.pairs()
+    if len(store):
+        images, masks = store.images, store.masks
+    else:
+        images = masks = np.zeros((0, 0, 0), dtype=np.float32)
+
+    # np.take aloca o array de saída uma única vez (cópia contígua a partir do memmap)
+    images_left = np.take(images, idx_left, axis=0)
+    images_right = np.take(images, idx_right, axis=0)
+    mask_left = np.take(masks, idx_left, axis=0)
+    mask_right = np.take(masks, idx_right, axis=0)
+    if flip_right:
+        images_right = np.ascontiguousarray(images_right[:, :, ::-1])
+        mask_right = np.ascontiguousarray(mask_right[:, :, ::-1])
+
+    patient = PatientData(patient_id, images_left, images_right, mask_left, mask_right, store.index[idx_left])
+    print(f"Paciente {patient_id} carregado com sucesso.")
+    print(f"Total de recortes: {len(patient)}")
+    return patient
+
+def load_patients(folder, patient_ids, cache_dir=None, flip_right=True, workers=None):
+    """
+    Carrega vários pacientes em paralelo (threads: a leitura do memmap e a descompressão
+    dos .nii.gz liberam o GIL).
+    :return: Dict {paciente: PatientData}, sem os pacientes não encontrados.
+    """
+    with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+        loaded = executor.map(lambda patient_id: load_patient(folder, patient_id, cache_dir, flip_right), patient_ids)
+        return {patient_id: patient for patient_id, patient in zip(patient_ids, loaded) if patient is not None}
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Benchmarks do pipeline com dados sintéticos (sem acesso à coorte privada).
+
+Cada etapa roda num processo próprio (pico de memória isolado), com uma execução de aquecimento
+e `repeats` execuções medidas. O relatório JSON pode ser comparado com um baseline salvo:
+
+    python benchmarks/run_benchmarks.py --profile quick --output bench.json
+    python benchmarks/run_benchmarks.py --profile quick --save-baseline benchmarks/baseline_quick.json
+    python benchmarks/run_benchmarks.py --profile quick --baseline benchmarks/baseline_quick.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tracemalloc
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+from synthetic import ROOT, VOLUME_SHAPE, TARGET_SHAPE_3D
+
+# Tamanhos de cada perfil: 'quick' para rodar em minutos num notebook, 'full' próximo do uso real
+PROFILES = {
+    "quick": {"n_patients": 2, "n_slices": 256, "n_volumes": 4, "pairs": 4096, "vit_layers": 2, "repeats": 3},
+    "full": {"n_patients": 8, "n_slices": 2048, "n_volumes": 16, "pairs": 32768, "vit_layers": None, "repeats": 5},
+}
+
+# Aumento relativo (tempo mediano ou pico de memória) a partir do qual a etapa é marcada como regressão
+DEFAULT_TOLERANCE = 0.20
+# Memória da etapa abaixo disso é ruído do alocador (não entra na comparação de memória)
+MIN_STAGE_MEMORY_MB = 8
+# Métricas de memória comparadas com o baseline: pico do tracemalloc (alocações do Python/NumPy da etapa) e
+# quanto a etapa subiu o pico de RSS depois do preparo (memória nativa, ex: TensorFlow). O pico de RSS absoluto
+# inclui imports e preparo e não entra: uma etapa que dobra a própria memória quase não o move
+MEMORY_METRICS = ("traced_peak_mb", "stage_rss_mb")
+
+STAGES = {}
+
+
+# FUNÇÕES
+def stage(name):
+    """Registra uma etapa: a função faz o preparo (não medido) e devolve o callable medido."""
+    def register(func):
+        STAGES[name] = func
+        return func
+    return register
+
+def _volume(data_dir):
+    return synthetic.synthetic_brain(VOLUME_SHAPE, seed=1)
+
+@stage("normalization_volume")
+def bench_normalization_volume(data_dir, profile):
+    from normalization import normalize_volume
+    volume = _volume(data_dir)
+    return lambda: normalize_volume(volume.copy())
+
+@stage("normalization_batch")
+def bench_normalization_batch(data_dir, profile):
+    from normalization import normalize_batch
+    volumes = np.stack([synthetic.synthetic_brain(VOLUME_SHAPE, seed=i) for i in range(4)])
+    return lambda: normalize_batch(volumes.copy())
+
+@stage("grid_left_right")
+def bench_grid_left_right(data_dir, profile):
+    from grid_engine import left_right_grid
+    binary = np.rot90(_volume(data_dir), k=1) > 0
+    return lambda: left_right_grid(binary, 40, 35, 0.05)
+
+@stage("grid_half_vertical")
+def bench_grid_half_vertical(data_dir, profile):
+    from grid_engine import half_vertical_grid, crop_bounds
+    volume = np.rot90(_volume(data_dir), k=1)
+    return lambda: (half_vertical_grid(volume, 40, 35, 0.05), crop_bounds(volume))
+
+@stage("augmentation")
+def bench_augmentation(data_dir, profile):
+    from augmentation import augment_image, AugmentedPairSequence
+    rng = np.random.default_rng(0)
+    n = profile["pairs"]
+    left = rng.random((n, 40, 40, 1), dtype=np.float32)
+    right = rng.random((n, 40, 40, 1), dtype=np.float32)
+    labels = rng.integers(0, 2, n)
+    sequence = AugmentedPairSequence(left, right, labels, batch_size=128, augment_factor=3)
+
+    def run():
+        for i in range(256):
+            augment_image(left[i], right[i], None, None)
+        for idx in range(len(sequence)):
+            sequence[idx]
+    return run
+
+@stage("patient_loader")
+def bench_patient_loader(data_dir, profile):
+    from patient_loader import load_patients
+    folder = os.path.join(data_dir, "patch_stores")
+    patient_ids = sorted(os.listdir(folder))
+    return lambda: load_patients(folder, patient_ids)
+
+@stage("slice_cache_build")
+def bench_slice_cache_build(data_dir, profile):
+    from slice_cache import build_slice_cache
+    file_list = _slice_list(data_dir)
+    cache_dir = os.path.join(data_dir, "bench_slice_cache")
+
+    def run():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        build_slice_cache(file_list, cache_dir)
+    return run
+
+@stage("slice_dataset_epoch")
+def bench_slice_dataset_epoch(data_dir, profile):
+    from slice_cache import build_slice_cache, slice_dataset
+    cache_dir = os.path.join(data_dir, "slice_cache")
+    build_slice_cache(_slice_list(data_dir), cache_dir)
+    dataset = slice_dataset(cache_dir, batch_size=16, shuffle=True)
+    return lambda: sum(1 for _ in dataset)
+
+@stage("volume_cache_build")
+def bench_volume_cache_build(data_dir, profile):
+    from volume_cache import build_volume_cache
+    paths = _volume_paths(data_dir, profile)
+    cache_dir = os.path.join(data_dir, "bench_volume_cache")
+
+    def run():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        build_volume_cache(paths, cache_dir, TARGET_SHAPE_3D)
+    return run
+
+@stage("volume_dataset_epoch")
+def bench_volume_dataset_epoch(data_dir, profile):
+    from volume_cache import build_volume_cache, VolumeCache
+    cached = build_volume_cache(_volume_paths(data_dir, profile), os.path.join(data_dir, "volume_cache"), TARGET_SHAPE_3D)
+    dataset = VolumeCache(cached).dataset(np.zeros(len(cached), dtype=np.int32), channels=2, batch_size=2, shuffle=True)
+    return lambda: sum(1 for _ in dataset)
+
+@stage("slice_export")
+def bench_slice_export(data_dir, profile):
+    from SaveAllSlices import export_patient
+    source = os.path.join(data_dir, "patients")
+    patient_id = sorted(os.listdir(os.path.join(source, "T1")))[0].split('_')[0]
+    output = os.path.join(data_dir, "bench_export")
+
+    def run():
+        shutil.rmtree(output, ignore_errors=True)
+        export_patient(os.path.join(source, "T1", f"{patient_id}_T1.nii.gz"),
+                       os.path.join(source, "Mascaras", f"{patient_id} mask.nrrd"),
+                       os.path.join(output, "Fatias_Patients", patient_id), os.path.join(output, "Fatias_Mask", patient_id))
+    return run
+
+def _vit2d(profile, prune_background):
+    namespace = synthetic.load_notebook_functions(os.path.join(ROOT, "New_Methods", "Transformers2D.ipynb"), ["build_vit_2d_classic"])
+    kwargs = {"transformer_layers": profile["vit_layers"]} if profile["vit_layers"] else {}
+    model = namespace["build_vit_2d_classic"](namespace["INPUT_SHAPE_2D"], prune_background=prune_background, **kwargs)
+    # Fatias axiais do cérebro sintético (com fundo zerado, como as do SaveAllSlices) normalizadas por imagem / máximo
+    volume = synthetic.synthetic_brain(synthetic.SLICE_SHAPE + (16,), seed=2)
+    batch = (np.moveaxis(volume, 2, 0)[..., np.newaxis] / volume.max()).astype(np.float32)
+    return lambda: model.predict_on_batch(batch)
+
+@stage("vit2d_forward")
+def bench_vit2d_forward(data_dir, profile):
+    return _vit2d(profile, prune_background=False)
+
+@stage("vit2d_forward_pruned")
+def bench_vit2d_forward_pruned(data_dir, profile):
+    return _vit2d(profile, prune_background=True)
+
+@stage("vit3d_forward")
+def bench_vit3d_forward(data_dir, profile):
+    namespace = synthetic.load_notebook_functions(os.path.join(ROOT, "New_Methods", "Transformers3D.ipynb"), ["build_vit_3d_classic"])
+    kwargs = {"transformer_layers": profile["vit_layers"]} if profile["vit_layers"] else {}
+    model = namespace["build_vit_3d_classic"](namespace["INPUT_SHAPE"], **kwargs)
+    batch = np.random.default_rng(0).random((1,) + tuple(namespace["INPUT_SHAPE"]), dtype=np.float32)
+    return lambda: model.predict_on_batch(batch)
+
+@stage("vit3d_tubelet_forward")
+def bench_vit3d_tubelet_forward(data_dir, profile):
+    namespace = synthetic.load_notebook_functions(os.path.join(ROOT, "New_Methods", "Transformers3D.ipynb"), ["build_vit_3d_tubelet"])
+    kwargs = {"transformer_layers": profile["vit_layers"]} if profile["vit_layers"] else {}
+    model = namespace["build_vit_3d_tubelet"](namespace["TUBELET_INPUT_SHAPE"], **kwargs)
+    # Volume de um canal com fundo zerado (a seleção de tubelets de cérebro depende dele)
+    volume = synthetic.synthetic_brain(synthetic.TARGET_SHAPE_3D, seed=3)
+    batch = (volume / volume.max())[np.newaxis, ..., np.newaxis].astype(np.float32)
+    return lambda: model.predict_on_batch(batch)
+
+@stage("patient_inference")
+def bench_patient_inference(data_dir, profile):
+    from patient_inference import predict_patient
+    namespace = synthetic.load_notebook_functions(os.path.join(ROOT, "Old_Methods", "Contrastive_SSCL.ipynb"),
+                                                  ["build_encoder", "build_siamese_model"])
+    model = namespace["build_siamese_model"]((40, 40, 1), namespace["build_encoder"]((40, 40, 1)))
+    volume = _volume(data_dir)
+    return lambda: predict_patient(model, volume)
+
+def _slice_list(data_dir):
+    with open(os.path.join(data_dir, "slices.json")) as f:
+        return json.load(f)
+
+def _volume_paths(data_dir, profile):
+    folder = os.path.join(data_dir, "patients", "T1")
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))][:profile["n_volumes"]]
+
+def prepare_data(data_dir, profile_name):
+    """Gera os dados sintéticos do perfil uma única vez (reaproveitados entre execuções)."""
+    profile = PROFILES[profile_name]
+    marker = os.path.join(data_dir, "ready.json")
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == profile:
+                return
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+    print(f"Gerando dados sintéticos ({profile_name}) em {data_dir}...")
+    synthetic.write_patients(os.path.join(data_dir, "patients"), max(profile["n_volumes"], 1))
+    synthetic.write_patch_stores(os.path.join(data_dir, "patch_stores"), profile["n_patients"])
+    file_list = synthetic.write_slices(os.path.join(data_dir, "slices"), profile["n_slices"])
+    with open(os.path.join(data_dir, "slices.json"), "w") as f:
+        json.dump(file_list, f)
+    with open(marker, "w") as f:
+        json.dump(profile, f)
+
+def run_stage(name, data_dir, profile_name):
+    """Roda uma etapa no processo atual: preparo, aquecimento e execuções medidas."""
+    profile = PROFILES[profile_name]
+    run = STAGES[name](data_dir, profile)
+    # Pico de RSS depois do preparo: a diferença para o pico final é o que a etapa medida acrescenta
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    run()  # aquecimento (traçado do TF, caches do SO)
+    times = []
+    for _ in range(profile["repeats"]):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # Execução extra só pro pico do tracemalloc, fora das medidas de tempo (o traçado pesa em cada alocação)
+    tracemalloc.start()
+    run()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "median_s": float(np.median(times)),
+        "min_s": float(np.min(times)),
+        "repeats": len(times),
+        "setup_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss,
+        "stage_rss_mb": peak_rss - setup_rss,
+        "traced_peak_mb": traced_peak / 2 ** 20,
+    }
+
+def environment():
+    info = {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "numpy": np.__version__}
+    try:
+        import tensorflow as tf
+        info["tensorflow"] = tf.__version__
+    except ImportError:
+        pass
+    return info
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compara as etapas presentes nos dois relatórios.
+    :return: Lista de (etapa, métrica, baseline, atual, razão) das que pioraram mais que a tolerância.
+    """
+    regressions = []
+    print(f"\n{'etapa':<24}{'baseline (s)':>14}{'atual (s)':>12}{'razão':>8}{'tracemalloc (MB)':>22}{'RSS da etapa (MB)':>22}")
+    for name, result in report["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if not base or "median_s" not in result or "median_s" not in base:
+            continue
+        ratio = result["median_s"] / base["median_s"] if base["median_s"] else float("inf")
+        print(f"{name:<24}{base['median_s']:>14.4f}{result['median_s']:>12.4f}{ratio:>8.2f}" +
+              "".join(f"{base.get(metric, 0):>12.0f} -> {result.get(metric, 0):<6.0f}" for metric in MEMORY_METRICS))
+        if ratio > 1 + tolerance:
+            regressions.append((name, "median_s", base["median_s"], result["median_s"], ratio))
+        for metric in MEMORY_METRICS:
+            if metric not in base or metric not in result or result[metric] <= MIN_STAGE_MEMORY_MB:
+                continue
+            memory_ratio = result[metric] / max(base[metric], MIN_STAGE_MEMORY_MB)
+            if memory_ratio > 1 + tolerance:
+                regressions.append((name, metric, base[metric], result[metric], memory_ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks do pipeline com dados sintéticos.")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--stages", nargs="*", default=None, help=f"Etapas (padrão: todas): {', '.join(STAGES)}")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, ".benchmark_data"))
+    parser.add_argument("--output", default=None, help="Relatório JSON (padrão: benchmark_<perfil>.json na pasta atual).")
+    parser.add_argument("--baseline", default=None, help="Relatório de referência para detectar regressões.")
+    parser.add_argument("--save-baseline", default=None, help="Também grava o relatório como novo baseline.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--run-stage", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    data_dir = os.path.join(args.data_dir, args.profile)
+
+    # Processo filho: roda uma etapa e devolve o resultado em JSON na última linha do stdout
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, data_dir, args.profile)))
+        return 0
+
+    names = args.stages or list(STAGES)
+    unknown = [name for name in names if name not in STAGES]
+    if unknown:
+        parser.error(f"Etapas desconhecidas: {unknown}")
+    prepare_data(data_dir, args.profile)
+
+    report = {"profile": args.profile, "environment": environment(), "settings": PROFILES[args.profile], "stages": {}}
+    for name in names:
+        print(f"Etapa {name}...", flush=True)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--profile", args.profile,
+                                  "--data-dir", args.data_dir, "--run-stage", name], capture_output=True, text=True)
+        if process.returncode != 0:
+            print(f"  falhou:\n{process.stderr[-2000:]}")
+            report["stages"][name] = {"error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "erro"}
+            continue
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        report["stages"][name] = result
+        print(f"  mediana {result['median_s']:.4f} s, mínimo {result['min_s']:.4f} s, pico RSS {result['peak_rss_mb']:.0f} MB "
+              f"({result['stage_rss_mb']:.0f} MB da etapa)")
+
+    output = args.output or f"benchmark_{args.profile}.json"
+    for path in filter(None, [output, args.save_baseline]):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    print(f"\nRelatório salvo em {output}.")
+
+    # Etapa que quebrou nunca passa como "sem regressão"
+    failed = [name for name, result in report["stages"].items() if "error" in result]
+    for name in failed:
+        print(f"FALHA: {name}: {report['stages'][name]['error']}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for name, metric, base, current, ratio in regressions:
+            print(f"REGRESSÃO: {name} {metric} {base:.4f} -> {current:.4f} ({ratio:.2f}x)")
+        # Etapas pedidas sem medida válida no baseline não foram comparadas
+        missing = [name for name in names if "median_s" not in baseline.get("stages", {}).get(name, {})]
+        for name in missing:
+            print(f"SEM BASELINE: {name} não está (ou falhou) em {args.baseline}")
+        return 1 if regressions or failed or missing else 0
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
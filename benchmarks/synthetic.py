@@ -0,0 +1,122 @@
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import nrrd
+from scipy import ndimage as ndi
+
+# Módulos do projeto (importados como irmãos, igual nos notebooks)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("Old_Methods", "New_Methods", os.path.join("New_Methods", "pre_processing")):
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Shapes reais do pipeline: volume no espaço MNI após o pré-processamento, fatias do Transformers2D
+# e volume alvo do Transformers3D
+VOLUME_SHAPE = (197, 233, 189)
+SLICE_SHAPE = (233, 197)
+TARGET_SHAPE_3D = (150, 150, 150)
+PATCH_SIZE = 40
+
+
+# FUNÇÕES
+def synthetic_brain(shape=VOLUME_SHAPE, seed=0):
+    """
+    Cérebro sintético: elipsoide com textura suave (substância branca/cinzenta) e fundo zerado,
+    com intensidades na faixa de um T1 pós bias-correction.
+    :return: Volume float32.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+    radius = sum(((axis - size / 2) / (size * 0.42)) ** 2 for axis, size in zip(grid, shape))
+    brain = radius <= 1.0
+    texture = ndi.gaussian_filter(rng.standard_normal(shape).astype(np.float32), 3)
+    volume = 600 + 250 * np.tanh(4 * texture) + 40 * rng.standard_normal(shape).astype(np.float32)
+    return np.where(brain, np.maximum(volume, 1), 0).astype(np.float32)
+
+def synthetic_lesion(shape=VOLUME_SHAPE, seed=0, radius=8):
+    """Máscara binária com uma lesão esférica num dos hemisférios."""
+    rng = np.random.default_rng(seed)
+    center = [int(size * rng.uniform(0.3, 0.45)) if axis == 0 else int(size * rng.uniform(0.4, 0.6))
+              for axis, size in enumerate(shape)]
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+    distance = sum((axis - c) ** 2 for axis, c in zip(grid, center))
+    return (distance <= radius ** 2).astype(np.uint8)
+
+def write_patients(folder, n_patients, shape=VOLUME_SHAPE, modalities=("T1",), seed=0):
+    """
+    Grava pacientes sintéticos no layout do projeto: <folder>/<modalidade>/<paciente>_<modalidade>.nii.gz
+    e a máscara em <folder>/Mascaras/<paciente> mask.nrrd.
+    :return: Lista de ids dos pacientes.
+    """
+    patient_ids = [f"sub-{i:02d}S{seed:02d}" for i in range(n_patients)]
+    os.makedirs(os.path.join(folder, "Mascaras"), exist_ok=True)
+    for i, patient_id in enumerate(patient_ids):
+        for j, modality in enumerate(modalities):
+            os.makedirs(os.path.join(folder, modality), exist_ok=True)
+            volume = synthetic_brain(shape, seed=seed * 1000 + i * 10 + j)
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), os.path.join(folder, modality, f"{patient_id}_{modality}.nii.gz"))
+        nrrd.write(os.path.join(folder, "Mascaras", f"{patient_id} mask.nrrd"), synthetic_lesion(shape, seed=seed + i))
+    return patient_ids
+
+def write_patch_stores(folder, n_patients, shape=VOLUME_SHAPE, size=PATCH_SIZE, overlap=35, seed=0):
+    """
+    PatchStores sintéticos como os do GridCreation (grid esquerda/direita de recortes 40x40).
+    :return: Lista de ids dos pacientes.
+    """
+    from grid_engine import left_right_grid
+    from patch_store import PatchStoreWriter
+
+    patient_ids = []
+    for i in range(n_patients):
+        patient_id = f"sub-{i:02d}P{seed:02d}"
+        volume = np.rot90(synthetic_brain(shape, seed=seed * 1000 + i), k=1)
+        lesion = np.rot90(synthetic_lesion(shape, seed=seed + i), k=1)
+        grids = left_right_grid(volume > 0, size, overlap, 0.05)
+        with PatchStoreWriter(os.path.join(folder, patient_id)) as writer:
+            for k in range(len(grids)):
+                s, y1, y2 = grids.slice[k], grids.y1[k], grids.y2[k]
+                for side, x1, x2 in (("left", grids.x1_l[k], grids.x2_l[k]), ("right", grids.x1_r[k], grids.x2_r[k])):
+                    writer.add(int(s), side, k, (int(y1), int(y2), int(x1), int(x2)),
+                               volume[y1:y2 + 1, x1:x2 + 1, s], lesion[y1:y2 + 1, x1:x2 + 1, s])
+        patient_ids.append(patient_id)
+    return patient_ids
+
+def write_slices(folder, n_slices, shape=SLICE_SHAPE, seed=0):
+    """
+    Fatias 2D sintéticas no formato do SaveAllSlices (um .nii.gz por fatia), já como a lista do load_data.
+    :return: Lista de dicts (image, label, paciente).
+    """
+    rng = np.random.default_rng(seed)
+    volume = synthetic_brain((shape[0], shape[1], 32), seed=seed)
+    os.makedirs(folder, exist_ok=True)
+    file_list = []
+    for i in range(n_slices):
+        path = os.path.join(folder, f"Slice_{i:04d}.nii.gz")
+        nib.save(nib.Nifti1Image(volume[:, :, i % volume.shape[2]], np.eye(4)), path)
+        file_list.append({"image": path, "label": int(rng.random() < 0.3), "paciente": f"sub-{i % 8:02d}"})
+    return file_list
+
+def load_notebook_functions(notebook_path, names, namespace=None):
+    """
+    Executa só as células de código do notebook que definem as funções pedidas (e as de hiperparâmetros
+    que elas usam como default), para medir os modelos exatamente como estão nos notebooks.
+    :param names: Nomes das funções (ex: ["build_vit_2d_classic"]).
+    :return: Namespace com as funções definidas.
+    """
+    import json
+    import tensorflow as tf
+    from keras import layers, models
+    from keras.models import Model, Sequential
+
+    namespace = dict(namespace or {})
+    namespace.update({"np": np, "tf": tf, "layers": layers, "models": models, "Model": Model,
+                      "Sequential": Sequential, "Input": layers.Input})
+    with open(notebook_path, encoding="utf-8") as f:
+        cells = [''.join(cell["source"]) for cell in json.load(f)["cells"] if cell["cell_type"] == "code"]
+    hyperparameters = [source for source in cells if "PROJECTION_DIM =" in source or "# --- Hiperparâmetros" in source]
+    definitions = [source for source in cells if any(f"def {name}(" in source for name in names)]
+    for source in hyperparameters + definitions:
+        exec(compile(source, notebook_path, "exec"), namespace)
+    return namespace
@@ -0,0 +1,65 @@
+import os
+import sys
+import nibabel as nib
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Old_Methods"))
+
+from dataset_catalog import DatasetCatalog
+from patch_store import PatchStoreWriter
+
+PATIENT = "sub-00H10"
+# (slice, lado, recorte, lesão?) de cada recorte; o mesmo conteúdo nos dois formatos
+PATCHES = [(42, "left", 0, True), (42, "right", 0, False), (43, "left", 0, False), (43, "left", 1, False),
+           (43, "right", 0, False), (43, "right", 1, False)]
+
+
+def _patch(lesion):
+    image = np.ones((40, 40), dtype=np.float32)
+    mask = np.zeros((40, 40), dtype=np.int8)
+    if lesion:
+        mask[10:20, 10:20] = 1
+    return image, mask
+
+
+def _write_legacy(folder):
+    # <modalidade>/<paciente>/<lado>/Slice_NNN/<lado>_NNN.nii.gz, com a máscara em lesion_<lado>
+    for slice_idx, side, patch_idx, lesion in PATCHES:
+        image, mask = _patch(lesion)
+        for name, data in ((side, image), (f"lesion_{side}", mask)):
+            path = os.path.join(folder, name, f"Slice_{slice_idx:03}")
+            os.makedirs(path, exist_ok=True)
+            nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(path, f"{name}_{patch_idx + 1:03}.nii.gz"))
+
+
+def _write_store(folder):
+    with PatchStoreWriter(folder) as writer:
+        for slice_idx, side, patch_idx, lesion in PATCHES:
+            writer.add(slice_idx, side, patch_idx, (0, 39, 0, 39), *_patch(lesion))
+
+
+def test_both_formats_answer_the_same_queries(tmp_path):
+    _write_legacy(str(tmp_path / "Contralateral_T1" / PATIENT))
+    _write_store(str(tmp_path / "Contralateral_Flair" / PATIENT))
+
+    with DatasetCatalog.build(str(tmp_path)) as catalog:
+        for modality in ("Contralateral_T1", "Contralateral_Flair"):
+            for side in ("left", "lesion_left"):
+                assert catalog.has_lesion(PATIENT, modality, side, 42)
+                assert not catalog.has_lesion(PATIENT, modality, side, 43)
+            assert not catalog.has_lesion(PATIENT, modality, "right", 42)
+            assert len(catalog.patches(PATIENT, modality, "left", kind="image")) == 3
+            assert len(catalog.patches(PATIENT, modality, "lesion_left")) == 3
+        # Mesmo número de recortes de imagem e de máscara em cada slice dos dois formatos
+        assert catalog.slice_inconsistencies() == []
+
+
+def test_inconsistent_slice_is_reported_once_per_kind(tmp_path):
+    _write_legacy(str(tmp_path / "Contralateral_T1" / PATIENT))
+    _write_store(str(tmp_path / "Contralateral_Flair" / PATIENT))
+    os.remove(str(tmp_path / "Contralateral_T1" / PATIENT / "left" / "Slice_043" / "left_002.nii.gz"))
+
+    with DatasetCatalog.build(str(tmp_path)) as catalog:
+        assert [(side, kind, slice_idx) for _, side, kind, slice_idx, _ in catalog.slice_inconsistencies()] == \
+            [("left", "image", 43)]
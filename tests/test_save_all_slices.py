@@ -0,0 +1,41 @@
+import os
+import sys
+import nibabel as nib
+import nrrd
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Old_Methods"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import synthetic
+from SaveAllSlices import export_patient, load_bulk_slices
+
+
+def _export(tmp_path, image, mask, name, bulk):
+    images, masks = tmp_path / name / "images", tmp_path / name / "masks"
+    count = export_patient(str(image), str(mask), str(images), str(masks), bulk=bulk)
+    return count, images, masks
+
+
+def test_nifti_mask_matches_nrrd_mask(tmp_path):
+    # Mesma máscara gravada em .nrrd (memmap) e em .nii.gz (proxy do nibabel): o export tem que ser idêntico
+    patient_id = synthetic.write_patients(str(tmp_path / "patients"), 1)[0]
+    image = tmp_path / "patients" / "T1" / f"{patient_id}_T1.nii.gz"
+    mask_nrrd = tmp_path / "patients" / "Mascaras" / f"{patient_id} mask.nrrd"
+    mask_nifti = tmp_path / "patients" / "Mascaras" / f"{patient_id} mask.nii.gz"
+    lesion, _ = nrrd.read(str(mask_nrrd))
+    nib.save(nib.Nifti1Image(lesion.astype(np.uint8), np.eye(4)), str(mask_nifti))
+
+    count_nrrd, _, masks_nrrd = _export(tmp_path, image, mask_nrrd, "nrrd", bulk=False)
+    count_nifti, _, masks_nifti = _export(tmp_path, image, mask_nifti, "nifti", bulk=False)
+    assert count_nifti == count_nrrd > 0
+    assert sorted(os.listdir(masks_nifti)) == sorted(os.listdir(masks_nrrd))
+    for name in os.listdir(masks_nrrd):
+        expected = np.asanyarray(nib.load(str(masks_nrrd / name)).dataobj)
+        np.testing.assert_array_equal(np.asanyarray(nib.load(str(masks_nifti / name)).dataobj), expected)
+
+    _, images_bulk, masks_bulk = _export(tmp_path, image, mask_nifti, "nifti_bulk", bulk=True)
+    _, masks, slice_ids = load_bulk_slices(str(images_bulk), str(masks_bulk))
+    assert len(slice_ids) == count_nifti
+    assert masks.sum() > 0